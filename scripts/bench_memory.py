@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""Benchmark harness for tiger.memory and scripts/sqlite_memory.py.
+
+Builds synthetic memory corpora, then times add, search (over a grid of
+window/limit values), hybrid-search and stats both in-process (one long-lived
+connection, like serve mode) and through the CLI (one process per call, like
+the old execFileSync path). Results are written as JSON so runs from
+different releases can be diffed.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tiger import memory  # noqa: E402
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is optional
+    np = None
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sqlite_memory.py")
+WORDS = (
+    "deploy server python node telegram schedule backup database memory agent skill reflection user prefers "
+    "morning report budget invoice meeting project release bug fix test docker kubernetes cache latency "
+    "token api key provider model summary weekly daily travel family music coffee tea book"
+).split()
+GENERATE_BATCH = 5000
+
+
+def percentile(sorted_ms: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_ms:
+        return 0.0
+    rank = max(1, int(math.ceil(pct / 100.0 * len(sorted_ms))))
+    return sorted_ms[rank - 1]
+
+
+def summarize(samples_ms: List[float]) -> Dict[str, Any]:
+    ordered = sorted(samples_ms)
+    total_s = sum(ordered) / 1000.0
+    return {
+        "n": len(ordered),
+        "p50_ms": round(percentile(ordered, 50), 4),
+        "p95_ms": round(percentile(ordered, 95), 4),
+        "p99_ms": round(percentile(ordered, 99), 4),
+        "mean_ms": round(sum(ordered) / len(ordered), 4) if ordered else 0.0,
+        "ops_per_sec": round(len(ordered) / total_s, 2) if total_s else 0.0,
+    }
+
+
+def time_calls(fn: Callable[[int], Any], n: int) -> Tuple[List[float], Any]:
+    samples = []
+    last = None
+    for i in range(n):
+        start = time.perf_counter()
+        last = fn(i)
+        samples.append((time.perf_counter() - start) * 1000.0)
+    return samples, last
+
+
+class Corpus:
+    """Deterministic generator for memories shaped like the agent's real ones.
+
+    Conversation sizes follow a Zipf-like skew (a few busy chats, many quiet
+    ones); a share of rows is global or self_reflection and therefore visible
+    from every conversation.
+    """
+
+    def __init__(self, dim: int, conversations: int, global_ratio: float, reflection_ratio: float, seed: int) -> None:
+        self.dim = dim
+        self.conversations = [f"telegram:{i}" for i in range(conversations)]
+        self.cum_weights = []
+        total = 0.0
+        for i in range(conversations):
+            total += 1.0 / (i + 1)
+            self.cum_weights.append(total)
+        self.global_ratio = global_ratio
+        self.reflection_ratio = reflection_ratio
+        self.rng = random.Random(seed)
+        self.np_rng = np.random.default_rng(seed) if np is not None else None
+        self.clock = 1_700_000_000_000
+
+    def vectors(self, n: int) -> List[List[float]]:
+        if self.np_rng is not None:
+            return self.np_rng.standard_normal((n, self.dim), dtype=np.float32).tolist()
+        return [[self.rng.gauss(0.0, 1.0) for _ in range(self.dim)] for _ in range(n)]
+
+    def text(self) -> str:
+        return " ".join(self.rng.choice(WORDS) for _ in range(self.rng.randint(8, 24)))
+
+    def conversation(self) -> str:
+        return self.rng.choices(self.conversations, cum_weights=self.cum_weights)[0]
+
+    def rows(self, n: int) -> List[memory.MemoryRow]:
+        out = []
+        for emb in self.vectors(n):
+            roll = self.rng.random()
+            if roll < self.reflection_ratio:
+                conv, source = "global", "self_reflection"
+            elif roll < self.reflection_ratio + self.global_ratio:
+                conv, source = "global", "turn_ingest"
+            else:
+                conv = self.conversation()
+                source = "compaction" if self.rng.random() < 0.15 else "turn_ingest"
+            self.clock += self.rng.randint(1, 60_000)
+            out.append((conv, source, self.text(), emb, self.clock))
+        return out
+
+
+def build_corpus(db_path: str, corpus: Corpus, size: int, vec_ext: str) -> float:
+    conn = memory.connect(db_path)
+    try:
+        memory.init_db(conn, vec_ext)
+        start = time.perf_counter()
+        done = 0
+        while done < size:
+            batch = min(GENERATE_BATCH, size - done)
+            memory.insert_memories(conn, corpus.rows(batch))
+            done += batch
+        return time.perf_counter() - start
+    finally:
+        conn.close()
+
+
+# Only the scan backend reads a candidate window; vec0, numpy, mmap, ivf and the
+# quantized backends score whole scopes, so sweeping the window there is noise.
+WINDOWED_BACKENDS = ("scan",)
+
+
+def search_grid(windows: List[int], limits: List[int], backend: str) -> List[Tuple[Any, int, int]]:
+    """(label, window, limit) triples; non-windowed backends run once with window "n/a"."""
+    if backend not in WINDOWED_BACKENDS:
+        return [("n/a", windows[0], limit) for limit in limits]
+    return [(window, window, limit) for window in windows for limit in limits]
+
+
+def bench_in_process(db_path: str, corpus: Corpus, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    conn = memory.connect(db_path)
+    try:
+        memory.load_configured_vec_extension(conn)
+        queries = [json.dumps(q) for q in corpus.vectors(args.queries)]
+        texts = [corpus.text() for _ in range(args.queries)]
+        convs = [corpus.conversation() for _ in range(args.queries)]
+
+        backend = memory.search_memories(conn, convs[0], queries[0], args.limits[0], -1.0, args.windows[0]).get("backend", "")
+        # One untimed query per shape warms the per-connection caches, as the
+        # long-lived serve process would be warm in production.
+        for label, window, limit in search_grid(args.windows, args.limits, backend):
+            memory.search_memories(conn, convs[0], queries[0], limit, -1.0, window)
+
+            def search(i: int, window: int = window, limit: int = limit) -> Dict[str, Any]:
+                return memory.search_memories(conn, convs[i], queries[i], limit, -1.0, window)
+
+            samples, last = time_calls(search, args.queries)
+            results.append(
+                {"op": "search", "window": label, "limit": limit, "backend": last.get("backend", ""), **summarize(samples)}
+            )
+
+        limit = args.limits[0]
+        samples, last = time_calls(
+            lambda i: memory.hybrid_search(conn, convs[i], texts[i], queries[i], limit, -1.0, args.windows[0], 50, memory.RRF_K),
+            args.queries,
+        )
+        results.append({"op": "hybrid-search", "limit": limit, "backend": last.get("backend", ""), **summarize(samples)})
+
+        samples, _ = time_calls(lambda i: memory.stats(conn), args.stats_runs)
+        results.append({"op": "stats", **summarize(samples)})
+
+        rows = corpus.rows(args.adds)
+        samples, _ = time_calls(
+            lambda i: memory.add_memory(conn, rows[i][0], rows[i][1], rows[i][2], json.dumps(rows[i][3]), rows[i][4]),
+            args.adds,
+        )
+        results.append({"op": "add", **summarize(samples)})
+    finally:
+        conn.close()
+    for row in results:
+        row["mode"] = "in-process"
+    return results
+
+
+def run_cli(db_path: str, command: str, *flags: str) -> Dict[str, Any]:
+    proc = subprocess.run(
+        [sys.executable, SCRIPT, command, "--db", db_path, *flags],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=False,
+    )
+    try:
+        return json.loads(proc.stdout or "{}")
+    except ValueError:
+        return {"ok": False, "error": proc.stderr.strip()}
+
+
+def bench_cli(db_path: str, corpus: Corpus, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    n = args.cli_runs
+    queries = [json.dumps(q) for q in corpus.vectors(n)]
+    convs = [corpus.conversation() for _ in range(n)]
+    backend = run_cli(
+        db_path, "search", "--conversation-id", convs[0], "--query-embedding-json", queries[0], "--limit", "1"
+    ).get("backend", "")
+    for label, window, limit in search_grid(args.windows, args.limits, backend):
+        samples, last = time_calls(
+            lambda i, window=window, limit=limit: run_cli(
+                db_path,
+                "search",
+                "--conversation-id",
+                convs[i],
+                "--query-embedding-json",
+                queries[i],
+                "--window",
+                str(window),
+                "--limit",
+                str(limit),
+                "--min-score",
+                "-1",
+            ),
+            n,
+        )
+        results.append(
+            {"op": "search", "window": label, "limit": limit, "backend": last.get("backend", ""), **summarize(samples)}
+        )
+
+    samples, _ = time_calls(lambda i: run_cli(db_path, "stats"), n)
+    results.append({"op": "stats", **summarize(samples)})
+
+    rows = corpus.rows(n)
+    samples, _ = time_calls(
+        lambda i: run_cli(
+            db_path,
+            "add",
+            "--conversation-id",
+            rows[i][0],
+            "--source",
+            rows[i][1],
+            "--content",
+            rows[i][2],
+            "--embedding-json",
+            json.dumps(rows[i][3]),
+            "--created-at",
+            str(rows[i][4]),
+        ),
+        n,
+    )
+    results.append({"op": "add", **summarize(samples)})
+    for row in results:
+        row["mode"] = "cli"
+    return results
+
+
+def int_list(text: str) -> List[int]:
+    return [int(part) for part in text.split(",") if part.strip()]
+
+
+def environment() -> Dict[str, Any]:
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(SCRIPT),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            check=False,
+        ).stdout.strip()
+    except OSError:
+        revision = ""
+    return {
+        "timestamp": int(time.time()),
+        "git_revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sqlite_version": sqlite3.sqlite_version,
+        "numpy": np.__version__ if np is not None else "",
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark sqlite_memory.py add/search/stats")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="corpus sizes, comma separated (up to 1000000)")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--global-ratio", type=float, default=0.1, help="share of conversation_id='global' memories")
+    parser.add_argument("--reflection-ratio", type=float, default=0.05, help="share of self_reflection memories")
+    parser.add_argument(
+        "--windows", default="100,600,2000", help="search windows, comma separated (scan backend only)"
+    )
+    parser.add_argument("--limits", default="6,20", help="search limits, comma separated")
+    parser.add_argument("--queries", type=int, default=200, help="in-process queries per search shape")
+    parser.add_argument("--adds", type=int, default=200, help="in-process single-row adds")
+    parser.add_argument("--stats-runs", type=int, default=20)
+    parser.add_argument("--cli-runs", type=int, default=20, help="CLI calls per operation (0 = skip CLI)")
+    parser.add_argument("--vec-ext", default="", help="sqlite-vec extension to load into each corpus")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--workdir", default="", help="where corpora are built (default: a temp dir)")
+    parser.add_argument("--keep", action="store_true", help="keep generated databases")
+    parser.add_argument("--output", default="bench-memory.json")
+    args = parser.parse_args()
+    args.sizes = int_list(args.sizes)
+    args.windows = int_list(args.windows)
+    args.limits = int_list(args.limits)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="tiger-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    report: Dict[str, Any] = {
+        "environment": environment(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "workdir", "keep")},
+        "runs": [],
+    }
+    try:
+        for size in args.sizes:
+            db_path = os.path.join(workdir, f"memory-{size}-{args.dim}.sqlite")
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+            corpus = Corpus(args.dim, args.conversations, args.global_ratio, args.reflection_ratio, args.seed)
+            build_s = build_corpus(db_path, corpus, size, args.vec_ext)
+            sys.stderr.write(f"corpus {size}x{args.dim}: built in {build_s:.1f}s\n")
+            results = bench_in_process(db_path, corpus, args)
+            if args.cli_runs > 0:
+                results += bench_cli(db_path, corpus, args)
+            for row in results:
+                sys.stderr.write(
+                    f"  {row['mode']:<10} {row['op']:<13} w={row.get('window', '-'):<5} l={row.get('limit', '-'):<3} "
+                    f"p50={row['p50_ms']:.3f}ms p95={row['p95_ms']:.3f}ms p99={row['p99_ms']:.3f}ms "
+                    f"{row['ops_per_sec']:.1f} ops/s {row.get('backend', '')}\n"
+                )
+            report["runs"].append(
+                {
+                    "size": size,
+                    "dim": args.dim,
+                    "build_seconds": round(build_s, 3),
+                    "rows_per_sec": round(size / build_s, 1) if build_s else 0.0,
+                    "db_bytes": os.path.getsize(db_path),
+                    "results": results,
+                }
+            )
+    finally:
+        if args.keep:
+            sys.stderr.write(f"databases kept in {workdir}\n")
+        elif not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, "w", encoding="utf-8") as handle:
+        json.dump(report, handle, indent=2)
+        handle.write("\n")
+    sys.stdout.write(json.dumps({"ok": True, "output": args.output, "runs": len(report["runs"])}))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
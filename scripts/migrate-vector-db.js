@@ -20,6 +20,51 @@ function parseArgs(argv) {
   return out;
 }
 
+function copyDatabase(from, to) {
+  fs.copyFileSync(from, to);
+  // WAL databases keep recent commits in the -wal file until a checkpoint.
+  for (const suffix of ['-wal', '-shm']) {
+    if (fs.existsSync(to + suffix)) fs.unlinkSync(to + suffix);
+  }
+  if (fs.existsSync(`${from}-wal`)) {
+    fs.copyFileSync(`${from}-wal`, `${to}-wal`);
+  }
+}
+
+// Files kept next to each database (main and every shard): the retain
+// archive (itself a SQLite database), the float32 sidecar and the IVF centroids.
+const COMPANION_DATABASES = ['.archive.sqlite'];
+const COMPANION_FILES = ['.emb.f32', '.ivf.npz'];
+
+function copyCompanions(from, to) {
+  const copied = [];
+  for (const suffix of [...COMPANION_DATABASES, ...COMPANION_FILES]) {
+    const source = from + suffix;
+    const target = to + suffix;
+    if (!fs.existsSync(source)) {
+      // A stale sidecar left at the target would be read against the new database.
+      if (fs.existsSync(target)) fs.unlinkSync(target);
+      continue;
+    }
+    if (COMPANION_DATABASES.includes(suffix)) {
+      copyDatabase(source, target);
+    } else {
+      fs.copyFileSync(source, target);
+    }
+    copied.push(path.basename(target));
+  }
+  return copied;
+}
+
+function shardSuffixes(from) {
+  // Sharded databases (MEMORY_SHARDS) keep conversation memories in <db>.shard-N.sqlite.
+  const base = path.basename(from);
+  return fs
+    .readdirSync(path.dirname(from))
+    .filter((name) => name.startsWith(`${base}.shard-`) && /\.shard-\d+\.sqlite$/.test(name))
+    .map((name) => name.slice(base.length));
+}
+
 function main() {
   const args = parseArgs(process.argv.slice(2));
   const from = path.resolve(args.from);
@@ -31,12 +76,20 @@ function main() {
   }
 
   fs.mkdirSync(path.dirname(to), { recursive: true });
-  fs.copyFileSync(from, to);
+  copyDatabase(from, to);
+  const companions = copyCompanions(from, to);
+  const shards = shardSuffixes(from);
+  for (const suffix of shards) {
+    copyDatabase(from + suffix, to + suffix);
+    companions.push(...copyCompanions(from + suffix, to + suffix));
+  }
   process.stdout.write(
     JSON.stringify({
       ok: true,
       from,
-      to
+      to,
+      shards: shards.length,
+      companions
     }) + '\n'
   );
 }
@@ -1,8 +1,19 @@
 const fs = require('fs');
 const path = require('path');
-const { execFileSync } = require('child_process');
+const { execFileSync, spawn } = require('child_process');
 const { ensureDir, cosineSimilarity } = require('../utils');
-const { dbPath, maxMessages, recentMessages, vectorDbPath, sqliteVecExtension } = require('../config');
+const {
+  dbPath,
+  maxMessages,
+  recentMessages,
+  vectorDbPath,
+  sqliteVecExtension,
+  memoryRetention,
+  memoryConsolidation,
+  memoryRecency,
+  embeddingCacheMaxEntries,
+  memoryShards
+} = require('../config');
 
 ensureDir(path.dirname(dbPath));
 ensureDir(path.dirname(vectorDbPath));
@@ -11,6 +22,20 @@ const sqliteMemoryScript = path.resolve(process.cwd(), 'scripts', 'sqlite_memory
 let sqliteMemoryReady = false;
 let sqliteVecLoaded = false;
 let sqliteInitError = '';
+// One serve child for request-path commands and one for maintenance, so a long
+// consolidate or retain run never queues recall behind it.
+const sqliteServers = { request: null, maintenance: null };
+const SQLITE_MAINTENANCE_COMMANDS = new Set([
+  'consolidate',
+  'retain',
+  'reshard',
+  'quantize',
+  'sidecar-build',
+  'ann-build',
+  'checkpoint',
+  'migrate-embeddings'
+]);
+const SQLITE_SERVER_TIMEOUT_MS = { request: 15000, maintenance: 10 * 60 * 1000 };
 
 function runSqliteMemory(args) {
   if (!fs.existsSync(sqliteMemoryScript)) {
@@ -27,6 +52,98 @@ function runSqliteMemory(args) {
   return parsed;
 }
 
+function startSqliteServer(lane) {
+  const args = [sqliteMemoryScript, 'serve', '--db', vectorDbPath];
+  if (sqliteVecExtension) {
+    args.push('--vec-ext', sqliteVecExtension);
+  }
+  const child = spawn('python3', args, { stdio: ['pipe', 'pipe', 'ignore'] });
+  const server = { lane, child, pending: new Map(), nextId: 1, buffer: '' };
+
+  const fail = (err) => {
+    if (sqliteServers[lane] === server) sqliteServers[lane] = null;
+    for (const entry of server.pending.values()) {
+      clearTimeout(entry.timer);
+      entry.reject(err);
+    }
+    server.pending.clear();
+  };
+
+  child.stdout.setEncoding('utf8');
+  child.stdout.on('data', (chunk) => {
+    server.buffer += chunk;
+    let newline = server.buffer.indexOf('\n');
+    while (newline >= 0) {
+      const line = server.buffer.slice(0, newline);
+      server.buffer = server.buffer.slice(newline + 1);
+      newline = server.buffer.indexOf('\n');
+      let message;
+      try {
+        message = JSON.parse(line);
+      } catch (err) {
+        continue;
+      }
+      const entry = server.pending.get(message.id);
+      if (!entry) continue;
+      server.pending.delete(message.id);
+      clearTimeout(entry.timer);
+      const result = message.result || {};
+      if (result.ok === false) {
+        entry.reject(new Error(String(result.error || 'sqlite memory helper failed')));
+      } else {
+        entry.resolve(result);
+      }
+    }
+    if (!server.pending.size) child.stdout.unref();
+  });
+  child.on('error', fail);
+  child.on('exit', () => {
+    // Requests still pending may or may not have been committed before the exit.
+    fail(Object.assign(new Error('sqlite memory server exited'), { outcomeUnknown: true }));
+  });
+  child.stdin.on('error', () => {});
+
+  // The server must not keep the process alive on its own; stdout is re-ref'd
+  // while requests are in flight.
+  child.unref();
+  child.stdout.unref();
+  return server;
+}
+
+function callSqliteMemory(command, args = {}) {
+  if (!fs.existsSync(sqliteMemoryScript)) {
+    return Promise.reject(new Error('sqlite memory helper script is missing'));
+  }
+  const lane = SQLITE_MAINTENANCE_COMMANDS.has(command) ? 'maintenance' : 'request';
+  if (!sqliteServers[lane]) {
+    sqliteServers[lane] = startSqliteServer(lane);
+  }
+  const server = sqliteServers[lane];
+  const id = server.nextId++;
+  return new Promise((resolve, reject) => {
+    const timer = setTimeout(() => {
+      server.pending.delete(id);
+      // The child may still finish this command, so its outcome is unknown. Kill
+      // it (the exit handler rejects everything queued behind) and respawn lazily.
+      if (sqliteServers[lane] === server) sqliteServers[lane] = null;
+      server.child.kill('SIGKILL');
+      reject(Object.assign(new Error(`sqlite memory ${command} timed out`), { outcomeUnknown: true }));
+    }, SQLITE_SERVER_TIMEOUT_MS[lane]);
+    timer.unref();
+    server.pending.set(id, { resolve, reject, timer });
+    server.child.stdout.ref();
+    server.child.stdin.write(`${JSON.stringify({ id, command, args })}\n`);
+  });
+}
+
+// A write whose outcome is unknown may already be in SQLite; writing it to the
+// JSON fallback as well would duplicate it.
+function skipFallbackWrite(command, err) {
+  if (!err || !err.outcomeUnknown) return false;
+  process.stderr.write(`[db] ${command}: ${err.message}; not writing to the JSON fallback\n`);
+  return true;
+}
+
 function ensureSqliteMemoryReady() {
   if (sqliteMemoryReady) return;
   try {
@@ -34,6 +151,9 @@ function ensureSqliteMemoryReady() {
     if (sqliteVecExtension) {
       args.push('--vec-ext', sqliteVecExtension);
     }
+    if (memoryShards > 0) {
+      args.push('--shards', String(memoryShards));
+    }
     const initResult = runSqliteMemory(args);
     sqliteVecLoaded = Boolean(initResult.vec_loaded);
     sqliteInitError = String(initResult.vec_error || '');
@@ -122,9 +242,82 @@ function nextId(rows) {
   return rows[rows.length - 1].id + 1;
 }
 
-function ensureConversation(platform, userId) {
+// Messages live in the SQLite messages table once the helper is available;
+// agent.json keeps them only as a fallback. JSON history is moved over on first
+// use, and again after any write had to fall back to JSON.
+let messageImport = null;
+let jsonMessagesDirty = true;
+
+function sqliteMessagesReady() {
+  ensureSqliteMemoryReady();
+  if (!sqliteMemoryReady) return Promise.resolve(false);
+  if (jsonMessagesDirty && !messageImport) {
+    jsonMessagesDirty = false;
+    messageImport = importJsonMessages().then(
+      () => {
+        messageImport = null;
+        return true;
+      },
+      () => {
+        jsonMessagesDirty = true;
+        messageImport = null;
+        return false;
+      }
+    );
+  }
+  return messageImport || Promise.resolve(true);
+}
+
+// Only the rows read at the start are removed afterwards, so fallback writes
+// made while the import runs stay in agent.json for the next pass.
+async function importJsonMessages() {
+  const conversations = Object.values(state.conversations);
+  const messages = state.messages.slice();
+  for (const c of conversations) {
+    await callSqliteMemory('ensure-conversation', {
+      conversation_id: c.id,
+      platform: String(c.platform || ''),
+      user_id: String(c.user_id || ''),
+      created_at: Number(c.created_at || 0)
+    });
+  }
+  if (messages.length) {
+    await callSqliteMemory('append-messages', {
+      items: messages.map((m) => ({
+        conversation_id: m.conversation_id,
+        role: m.role,
+        content: m.content,
+        created_at: m.created_at
+      }))
+    });
+  }
+  if (conversations.length || messages.length) {
+    for (const c of conversations) {
+      if (state.conversations[c.id] === c) delete state.conversations[c.id];
+    }
+    const imported = new Set(messages);
+    state.messages = state.messages.filter((m) => !imported.has(m));
+    saveState();
+  }
+}
+
+async function ensureConversation(platform, userId) {
   const id = conversationId(platform, userId);
   const ts = now();
+  if (await sqliteMessagesReady()) {
+    try {
+      await callSqliteMemory('ensure-conversation', {
+        conversation_id: id,
+        platform: String(platform || ''),
+        user_id: String(userId || ''),
+        created_at: ts
+      });
+      return id;
+    } catch (err) {
+      if (skipFallbackWrite('ensure-conversation', err)) return id;
+      // Fall back to JSON storage.
+    }
+  }
   const existing = state.conversations[id];
   if (existing) {
     existing.updated_at = ts;
@@ -137,38 +330,88 @@ function ensureConversation(platform, userId) {
       updated_at: ts
     };
   }
+  jsonMessagesDirty = true;
   saveState();
   return id;
 }
 
-function addMessage(conversationIdValue, role, content) {
+async function addMessage(conversationIdValue, role, content) {
+  const createdAt = now();
+  if (await sqliteMessagesReady()) {
+    try {
+      await callSqliteMemory('append-message', {
+        conversation_id: String(conversationIdValue || ''),
+        role: String(role || ''),
+        content: String(content || ''),
+        created_at: createdAt
+      });
+      return;
+    } catch (err) {
+      if (skipFallbackWrite('append-message', err)) return;
+      // Fall back to JSON storage.
+    }
+  }
   state.messages.push({
     id: nextId(state.messages),
     conversation_id: conversationIdValue,
     role,
     content,
-    created_at: now()
+    created_at: createdAt
   });
 
   if (state.conversations[conversationIdValue]) {
-    state.conversations[conversationIdValue].updated_at = now();
+    state.conversations[conversationIdValue].updated_at = createdAt;
   }
+  jsonMessagesDirty = true;
   saveState();
 }
 
-function getRecentMessages(conversationIdValue, limit = recentMessages) {
+async function getRecentMessages(conversationIdValue, limit = recentMessages) {
+  if (await sqliteMessagesReady()) {
+    try {
+      const result = await callSqliteMemory('recent-messages', {
+        conversation_id: String(conversationIdValue || ''),
+        limit
+      });
+      return result.rows.map((m) => ({ role: m.role, content: m.content, created_at: m.created_at }));
+    } catch (err) {
+      // Fall back to JSON storage.
+    }
+  }
   return state.messages
     .filter((m) => m.conversation_id === conversationIdValue)
     .slice(-limit)
     .map((m) => ({ role: m.role, content: m.content, created_at: m.created_at }));
 }
 
-function getMessageCount(conversationIdValue) {
+async function getMessageCount(conversationIdValue) {
+  if (await sqliteMessagesReady()) {
+    try {
+      const result = await callSqliteMemory('message-count', {
+        conversation_id: String(conversationIdValue || '')
+      });
+      return Number(result.count || 0);
+    } catch (err) {
+      // Fall back to JSON storage.
+    }
+  }
   return state.messages.filter((m) => m.conversation_id === conversationIdValue).length;
 }
 
-function getMessagesForCompaction(conversationIdValue) {
-  const count = getMessageCount(conversationIdValue);
+async function getMessagesForCompaction(conversationIdValue) {
+  if (await sqliteMessagesReady()) {
+    try {
+      const result = await callSqliteMemory('compaction-range', {
+        conversation_id: String(conversationIdValue || ''),
+        max_messages: maxMessages,
+        keep_recent: recentMessages
+      });
+      return result.rows;
+    } catch (err) {
+      // Fall back to JSON storage.
+    }
+  }
+  const count = state.messages.filter((m) => m.conversation_id === conversationIdValue).length;
   if (count <= maxMessages) return [];
   const toCompact = Math.max(0, count - recentMessages);
   if (!toCompact) return [];
@@ -178,7 +421,19 @@ function getMessagesForCompaction(conversationIdValue) {
     .map((m) => ({ id: m.id, role: m.role, content: m.content }));
 }
 
-function deleteMessagesUpTo(conversationIdValue, maxId) {
+async function deleteMessagesUpTo(conversationIdValue, maxId) {
+  if (await sqliteMessagesReady()) {
+    try {
+      await callSqliteMemory('delete-up-to', {
+        conversation_id: String(conversationIdValue || ''),
+        max_id: maxId
+      });
+      return;
+    } catch (err) {
+      if (skipFallbackWrite('delete-up-to', err)) return;
+      // Fall back to JSON storage.
+    }
+  }
   state.messages = state.messages.filter((m) => {
     if (m.conversation_id !== conversationIdValue) return true;
     return m.id > maxId;
@@ -186,29 +441,22 @@ function deleteMessagesUpTo(conversationIdValue, maxId) {
   saveState();
 }
 
-function addMemory(conversationIdValue, source, content, embedding) {
+async function addMemory(conversationIdValue, source, content, embedding) {
   const createdAt = now();
   ensureSqliteMemoryReady();
 
   if (sqliteMemoryReady) {
     try {
-      runSqliteMemory([
-        'add',
-        '--db',
-        vectorDbPath,
-        '--conversation-id',
-        String(conversationIdValue || ''),
-        '--source',
-        String(source || ''),
-        '--content',
-        String(content || ''),
-        '--embedding-json',
-        JSON.stringify(Array.isArray(embedding) ? embedding : []),
-        '--created-at',
-        String(createdAt)
-      ]);
+      await callSqliteMemory('add', {
+        conversation_id: String(conversationIdValue || ''),
+        source: String(source || ''),
+        content: String(content || ''),
+        embedding_json: Array.isArray(embedding) ? embedding : [],
+        created_at: createdAt
+      });
       return;
     } catch (err) {
+      if (skipFallbackWrite('add', err)) return;
       // Fall back to legacy JSON memory if sqlite path is unavailable.
     }
   }
@@ -236,17 +484,25 @@ function setMeta(key, value) {
   saveState();
 }
 
-function getRecentMessagesAll(limit = 200) {
-  return state.messages.slice(-limit).map((m) => ({
-    conversation_id: m.conversation_id,
-    role: m.role,
-    content: m.content,
-    created_at: m.created_at
-  }));
+async function getRecentMessagesAll(limit = 200) {
+  return getMessagesSince(0, limit);
 }
 
-function getMessagesSince(sinceTs, limit = 500) {
+async function getMessagesSince(sinceTs, limit = 500) {
   const threshold = Number(sinceTs || 0);
+  if (await sqliteMessagesReady()) {
+    try {
+      const result = await callSqliteMemory('recent-messages', { since: threshold, limit });
+      return result.rows.map((m) => ({
+        conversation_id: m.conversation_id,
+        role: m.role,
+        content: m.content,
+        created_at: m.created_at
+      }));
+    } catch (err) {
+      // Fall back to JSON storage.
+    }
+  }
   return state.messages
     .filter((m) => Number(m.created_at || 0) > threshold)
     .slice(-limit)
@@ -258,25 +514,22 @@ function getMessagesSince(sinceTs, limit = 500) {
     }));
 }
 
-function getRelevantMemories(conversationIdValue, queryEmbedding, limit = 6) {
+async function getRelevantMemories(conversationIdValue, queryEmbedding, limit = 6, queryText = '') {
   ensureSqliteMemoryReady();
   if (sqliteMemoryReady) {
     try {
-      const result = runSqliteMemory([
-        'search',
-        '--db',
-        vectorDbPath,
-        '--conversation-id',
-        String(conversationIdValue || ''),
-        '--query-embedding-json',
-        JSON.stringify(Array.isArray(queryEmbedding) ? queryEmbedding : []),
-        '--limit',
-        String(limit),
-        '--min-score',
-        '0.1',
-        '--window',
-        '600'
-      ]);
+      // BM25 over the memory text is fused with cosine ranking, so recall still
+      // works from the text alone when no query embedding is available.
+      const result = await callSqliteMemory('hybrid-search', {
+        conversation_id: String(conversationIdValue || ''),
+        query_text: String(queryText || ''),
+        query_embedding_json: Array.isArray(queryEmbedding) ? queryEmbedding : [],
+        limit,
+        min_score: 0.1,
+        window: 600,
+        half_life_days: memoryRecency.halfLifeDays,
+        recency_weight: memoryRecency.weight
+      });
       const rows = Array.isArray(result.rows) ? result.rows : [];
       if (rows.length) {
         return rows;
@@ -299,37 +552,89 @@ function getRelevantMemories(conversationIdValue, queryEmbedding, limit = 6) {
       source: m.source,
       content: m.content,
       created_at: m.created_at,
-      score: cosineSimilarity(queryEmbedding, m.embedding || [])
+      score: cosineSimilarity(queryEmbedding || [], m.embedding || [])
     }))
     .filter((m) => m.score > 0.1)
     .sort((a, b) => b.score - a.score)
     .slice(0, limit);
 }
 
-function recordSkillUsage(name, provider = 'tool') {
+async function recordSkillUsage(name, provider = 'tool') {
   const skillName = String(name || '').trim();
   if (!skillName) return;
   ensureSqliteMemoryReady();
   if (!sqliteMemoryReady) return;
   try {
-    runSqliteMemory([
-      'upsert-skill',
-      '--db',
-      vectorDbPath,
-      '--name',
-      skillName,
-      '--provider',
-      String(provider || 'tool'),
-      '--enabled',
-      '1',
-      '--updated-at',
-      String(now())
-    ]);
+    await callSqliteMemory('upsert-skill', {
+      name: skillName,
+      provider: String(provider || 'tool'),
+      enabled: 1,
+      updated_at: now()
+    });
   } catch (err) {
     // Non-blocking telemetry.
   }
 }
 
+async function getCachedEmbedding(model, text) {
+  if (!embeddingCacheMaxEntries) return null;
+  ensureSqliteMemoryReady();
+  if (!sqliteMemoryReady) return null;
+  try {
+    const result = await callSqliteMemory('cache-get', { model: String(model || ''), content: String(text || '') });
+    return result.hit && Array.isArray(result.embedding) ? result.embedding : null;
+  } catch (err) {
+    return null;
+  }
+}
+
+async function putCachedEmbedding(model, text, embedding) {
+  if (!embeddingCacheMaxEntries || !Array.isArray(embedding) || !embedding.length) return;
+  ensureSqliteMemoryReady();
+  if (!sqliteMemoryReady) return;
+  try {
+    await callSqliteMemory('cache-put', {
+      model: String(model || ''),
+      content: String(text || ''),
+      embedding_json: embedding,
+      max_entries: embeddingCacheMaxEntries
+    });
+  } catch (err) {
+    // Caching is best-effort.
+  }
+}
+
+async function consolidateMemories(threshold = memoryConsolidation.threshold) {
+  if (!memoryConsolidation.enabled) return null;
+  ensureSqliteMemoryReady();
+  if (!sqliteMemoryReady) return null;
+  try {
+    // Incremental: only memories added since the previous run are compared,
+    // at most maxRows of them per call.
+    return await callSqliteMemory('consolidate', { threshold, archive: 1, max_rows: memoryConsolidation.maxRows });
+  } catch (err) {
+    return null;
+  }
+}
+
+async function applyMemoryRetention() {
+  const policy = memoryRetention || {};
+  if (!Object.values(policy).some((v) => Number(v) > 0)) return null;
+  ensureSqliteMemoryReady();
+  if (!sqliteMemoryReady) return null;
+  try {
+    return await callSqliteMemory('retain', {
+      max_age_days: policy.maxAgeDays,
+      max_per_conversation: policy.maxPerConversation,
+      max_per_source: policy.maxPerSource,
+      message_max_age_days: policy.messageMaxAgeDays,
+      max_messages_per_conversation: policy.maxMessagesPerConversation
+    });
+  } catch (err) {
+    return null;
+  }
+}
+
 module.exports = {
   db: state,
   ensureConversation,
@@ -345,5 +650,9 @@ module.exports = {
   getRecentMessagesAll,
   getMessagesSince,
   initVectorMemory,
-  recordSkillUsage
+  recordSkillUsage,
+  consolidateMemories,
+  applyMemoryRetention,
+  getCachedEmbedding,
+  putCachedEmbedding
 };
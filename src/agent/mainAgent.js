@@ -1,6 +1,6 @@
 const fs = require('fs');
 const path = require('path');
-const { chatCompletion, embedText } = require('../llmClient');
+const { chatCompletion, embedText, setEmbeddingCache } = require('../llmClient');
 const {
   embeddingsEnabled,
   allowShell,
@@ -24,9 +24,13 @@ const {
   getRelevantMemories,
   getMeta,
   setMeta,
-  recordSkillUsage
+  recordSkillUsage,
+  getCachedEmbedding,
+  putCachedEmbedding
 } = require('./db');
 
+setEmbeddingCache({ get: getCachedEmbedding, put: putCachedEmbedding });
+
 function safeJsonParse(text, fallback = {}) {
   try {
     return JSON.parse(text);
@@ -42,7 +46,7 @@ function renderContextFiles(files) {
 }
 
 async function compactConversation(conversationIdValue) {
-  const rows = getMessagesForCompaction(conversationIdValue);
+  const rows = await getMessagesForCompaction(conversationIdValue);
   if (!rows.length) return;
 
   const raw = rows.map((r) => `${r.role.toUpperCase()}: ${r.content}`).join('\n');
@@ -70,11 +74,11 @@ async function compactConversation(conversationIdValue) {
     }
   }
   if (emb.length) {
-    addMemory(conversationIdValue, 'compaction', summary, emb);
+    await addMemory(conversationIdValue, 'compaction', summary, emb);
   }
 
   const maxId = rows[rows.length - 1].id;
-  deleteMessagesUpTo(conversationIdValue, maxId);
+  await deleteMessagesUpTo(conversationIdValue, maxId);
 }
 
 async function maybeUpdateHumanFile(userText, assistantText) {
@@ -141,7 +145,7 @@ function shouldRefreshOwnSkill() {
 async function maybeUpdateOwnSkillSummary(conversationIdValue) {
   if (!shouldRefreshByMeta(OWNSKILL_META_KEY, ownSkillUpdateHours)) return;
 
-  const recent = getRecentMessages(conversationIdValue, 80);
+  const recent = await getRecentMessages(conversationIdValue, 80);
   const transcript = recent
     .map((m) => `${String(m.role || '').toUpperCase()}: ${String(m.content || '')}`)
     .join('\n');
@@ -181,7 +185,7 @@ async function maybeUpdateOwnSkillSummary(conversationIdValue) {
 async function maybeUpdateSoulSummary(conversationIdValue) {
   if (!shouldRefreshByMeta(SOUL_META_KEY, soulUpdateHours)) return;
 
-  const recent = getRecentMessages(conversationIdValue, 80);
+  const recent = await getRecentMessages(conversationIdValue, 80);
   const transcript = recent
     .map((m) => `${String(m.role || '').toUpperCase()}: ${String(m.content || '')}`)
     .join('\n');
@@ -215,7 +219,7 @@ async function maybeUpdateSoulSummary(conversationIdValue) {
 }
 
 async function maybeIngestTurnMemory(conversationIdValue, userText, assistantText) {
-  const recent = getRecentMessages(conversationIdValue, 120);
+  const recent = await getRecentMessages(conversationIdValue, 120);
   const messageCount = recent.length;
   const key = `turn_ingest_last_count:${conversationIdValue}`;
   const lastCount = Number(getMeta(key, 0) || 0);
@@ -260,7 +264,7 @@ async function maybeIngestTurnMemory(conversationIdValue, userText, assistantTex
       emb = [];
     }
   }
-  addMemory(conversationIdValue, 'turn_ingest', summary, emb);
+  await addMemory(conversationIdValue, 'turn_ingest', summary, emb);
   setMeta(key, messageCount);
 }
 
@@ -341,8 +345,8 @@ async function runWithTools(initialMessages) {
 }
 
 async function handleMessage({ platform, userId, text }) {
-  const conversationIdValue = ensureConversation(platform, userId);
-  addMessage(conversationIdValue, 'user', text);
+  const conversationIdValue = await ensureConversation(platform, userId);
+  await addMessage(conversationIdValue, 'user', text);
 
   try {
     await compactConversation(conversationIdValue);
@@ -352,20 +356,26 @@ async function handleMessage({ platform, userId, text }) {
 
   const contextFiles = loadContextFiles();
   const contextText = renderContextFiles(contextFiles);
-  const recent = getRecentMessages(conversationIdValue);
+  const recent = await getRecentMessages(conversationIdValue);
 
   let memoryText = '';
+  let qEmb = null;
   if (embeddingsEnabled) {
     try {
-      const qEmb = await embedText(text);
-      const relevant = getRelevantMemories(conversationIdValue, qEmb, 6);
-      memoryText = relevant
-        .map((m) => `- (${m.source}) ${m.content}`)
-        .join('\n');
+      qEmb = await embedText(text);
     } catch (err) {
-      memoryText = '';
+      // Lexical recall below still works without an embedding.
+      qEmb = null;
     }
   }
+  try {
+    const relevant = await getRelevantMemories(conversationIdValue, qEmb, 6, text);
+    memoryText = relevant
+      .map((m) => `- (${m.source}) ${m.content}`)
+      .join('\n');
+  } catch (err) {
+    memoryText = '';
+  }
 
   const system = buildSystemPrompt(contextText, memoryText);
   const messages = [
@@ -374,7 +384,7 @@ async function handleMessage({ platform, userId, text }) {
   ];
 
   const reply = (await runWithTools(messages)).trim() || 'No response generated.';
-  addMessage(conversationIdValue, 'assistant', reply);
+  await addMessage(conversationIdValue, 'assistant', reply);
 
   try {
     await maybeUpdateHumanFile(text, reply);
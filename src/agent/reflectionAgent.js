@@ -1,10 +1,22 @@
 const fs = require('fs');
 const path = require('path');
-const { chatCompletion, embedText } = require('../llmClient');
+const { chatCompletion, embedText, setEmbeddingCache } = require('../llmClient');
 const { dataDir, embeddingsEnabled, reflectionUpdateHours } = require('../config');
-const { addMemory, getMeta, setMeta, getMessagesSince, getRecentMessagesAll } = require('./db');
+const {
+  addMemory,
+  applyMemoryRetention,
+  consolidateMemories,
+  getMeta,
+  setMeta,
+  getMessagesSince,
+  getRecentMessagesAll,
+  getCachedEmbedding,
+  putCachedEmbedding
+} = require('./db');
 const { writeContextFile } = require('./contextFileMirrors');
 
+setEmbeddingCache({ get: getCachedEmbedding, put: putCachedEmbedding });
+
 const REFLECTION_META_KEY = 'memory_reflection_last_run_ts';
 const MAX_MESSAGE_SCAN = 600;
 
@@ -139,8 +151,8 @@ async function maybeRunReflectionCycle({ force = false } = {}) {
   }
 
   const rows = lastRunTs
-    ? getMessagesSince(lastRunTs, MAX_MESSAGE_SCAN)
-    : getRecentMessagesAll(Math.min(MAX_MESSAGE_SCAN, 240));
+    ? await getMessagesSince(lastRunTs, MAX_MESSAGE_SCAN)
+    : await getRecentMessagesAll(Math.min(MAX_MESSAGE_SCAN, 240));
   if (!rows.length && !force) {
     return { ok: true, skipped: true, reason: 'no_new_messages' };
   }
@@ -193,8 +205,10 @@ async function maybeRunReflectionCycle({ force = false } = {}) {
         emb = [];
       }
     }
-    addMemory('global', 'self_reflection', memoryPayload, emb);
+    await addMemory('global', 'self_reflection', memoryPayload, emb);
   }
+  await consolidateMemories();
+  await applyMemoryRetention();
 
   setMeta(REFLECTION_META_KEY, startedAt);
   console.log(`[ReflectionCycle] Completed at ${stampIso} (${rows.length} messages processed)`);
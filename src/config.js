@@ -101,6 +101,29 @@ const vectorDbPath = path.resolve(process.env.VECTOR_DB_PATH || './db/memory.sql
 const sqliteVecExtension = cleanEnvValue(process.env.SQLITE_VEC_EXTENSION || '');
 const memoryIngestEveryTurns = Math.max(1, Number(process.env.MEMORY_INGEST_EVERY_TURNS || 2));
 const memoryIngestMinChars = Math.max(20, Number(process.env.MEMORY_INGEST_MIN_CHARS || 140));
+const embeddingCacheMaxEntries = Math.max(0, Number(process.env.EMBEDDING_CACHE_MAX_ENTRIES || 20000));
+// Conversation memories split over <VECTOR_DB_PATH>.shard-N.sqlite files (0 = one file).
+const memoryShards = Math.max(0, Math.floor(Number(process.env.MEMORY_SHARDS || 0)));
+// Recall adds weight * 0.5^(age / half-life) to cosine scores (half-life 0 = off).
+const memoryRecency = {
+  halfLifeDays: Math.max(0, Number(process.env.MEMORY_RECENCY_HALF_LIFE_DAYS || 0)),
+  weight: Math.max(0, Number(process.env.MEMORY_RECENCY_WEIGHT || 0.1))
+};
+// Near-duplicate consolidation after each reflection cycle (off unless MEMORY_CONSOLIDATE=1).
+const memoryConsolidation = {
+  enabled: ['1', 'true', 'yes', 'on'].includes(cleanEnvValue(process.env.MEMORY_CONSOLIDATE || '').toLowerCase()),
+  threshold: Math.min(1, Math.max(0, Number(process.env.MEMORY_CONSOLIDATE_THRESHOLD || 0.95))),
+  maxRows: Math.max(0, Math.floor(Number(process.env.MEMORY_CONSOLIDATE_MAX_ROWS || 2000)))
+};
+// Retention limits for memory.sqlite; 0 disables a limit. Expired rows move to
+// <VECTOR_DB_PATH>.archive.sqlite after each reflection cycle.
+const memoryRetention = {
+  maxAgeDays: Math.max(0, Number(process.env.MEMORY_RETENTION_DAYS || 0)),
+  maxPerConversation: Math.max(0, Number(process.env.MEMORY_MAX_PER_CONVERSATION || 0)),
+  maxPerSource: Math.max(0, Number(process.env.MEMORY_MAX_PER_SOURCE || 0)),
+  messageMaxAgeDays: Math.max(0, Number(process.env.MESSAGE_RETENTION_DAYS || 0)),
+  maxMessagesPerConversation: Math.max(0, Number(process.env.MESSAGE_MAX_PER_CONVERSATION || 0))
+};
 const swarmAgentTimeoutMs = Math.max(0, Number(process.env.SWARM_AGENT_TIMEOUT_MS || 0));
 const swarmRouteOnProviderError =
   ['1', 'true', 'yes', 'on'].includes(cleanEnvValue(process.env.SWARM_ROUTE_ON_PROVIDER_ERROR || '').toLowerCase());
@@ -138,6 +161,11 @@ module.exports = {
   sqliteVecExtension,
   memoryIngestEveryTurns,
   memoryIngestMinChars,
+  memoryRetention,
+  memoryConsolidation,
+  memoryRecency,
+  embeddingCacheMaxEntries,
+  memoryShards,
   swarmAgentTimeoutMs,
   swarmRouteOnProviderError,
   swarmDefaultFlow,
@@ -8,6 +8,7 @@
  * Exported API (identical to kimiClient):
  *   chatCompletion(messages, options) → message object
  *   embedText(input, model?)          → number[]
+ *   setEmbeddingCache({ get, put })   → use an embedding cache (or null for none)
  *
  * Auto-switch behaviour:
  *   - Before each request:  skip providers that are over their token limit.
@@ -19,6 +20,14 @@
 const { getProvider } = require('./apiProviders');
 const tokenManager = require('./tokenManager');
 
+// Optional embedding cache, injected by the agent layer so this client does not
+// depend on the memory database.
+let embeddingCache = null;
+
+function setEmbeddingCache(cache) {
+  embeddingCache = cache && typeof cache.get === 'function' && typeof cache.put === 'function' ? cache : null;
+}
+
 // ─── Low-level fetch wrapper ─────────────────────────────────────────────────
 
 function sleep(ms) {
@@ -159,6 +168,14 @@ async function embedText(input, model) {
   const embedModel = model || provider.embedModel;
   if (!embedModel) throw new Error(`No embedding model configured for "${provider.name}".`);
 
+  // Vectors from different providers/models are not comparable, so both are part of the cache key.
+  const cacheModel = `${providerId}/${embedModel}`;
+  const cache = typeof input === 'string' ? embeddingCache : null;
+  if (cache) {
+    const cached = await cache.get(cacheModel, input);
+    if (cached) return cached;
+  }
+
   const data = await fetchProvider(provider, provider.embedPath, { model: embedModel, input });
 
   const vector = data.data?.[0]?.embedding;
@@ -167,7 +184,11 @@ async function embedText(input, model) {
   }
 
   tokenManager.recordTokens(providerId, data.usage?.total_tokens || 0);
+  if (cache) {
+    // Not awaited: the write is off the request path and never rejects.
+    cache.put(cacheModel, input, vector);
+  }
   return vector;
 }
 
-module.exports = { chatCompletion, embedText };
+module.exports = { chatCompletion, embedText, setEmbeddingCache };
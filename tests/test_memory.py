@@ -0,0 +1,174 @@
+"""Focused tests for tiger.memory command dispatch.
+
+Run from the repository root: python3 -m unittest discover -s tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from tiger import memory
+
+
+class MemoryStoreTestCase(unittest.TestCase):
+    shards = 0
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.mkdtemp(prefix="tiger-memory-")
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.db_path = os.path.join(self.tmp, "memory.sqlite")
+        self.store = self.open_store()
+        if self.shards:
+            self.assertTrue(self.store.execute("init", shards=self.shards)["ok"])
+
+    def open_store(self, pool_size: int = 2) -> memory.MemoryStore:
+        store = memory.MemoryStore(self.db_path, pool_size=pool_size)
+        self.addCleanup(store.close)
+        return store
+
+    def count(self, store: memory.MemoryStore) -> int:
+        with store.connection() as conn:
+            return sum(
+                int(c.execute("SELECT COUNT(*) FROM memories").fetchone()[0]) for c in memory.memory_connections(conn)
+            )
+
+    def contents(self, result):
+        return [row["content"] for row in result["rows"]]
+
+
+class InsertSearchTest(MemoryStoreTestCase):
+    shards = 2
+
+    def test_conversation_memories_land_in_their_shard(self):
+        self.store.add("c1", "compaction", "user likes green tea", [1.0, 0.0, 0.0])
+        self.store.add("global", "compaction", "shared fact about tea", [0.9, 0.1, 0.0])
+        with self.store.connection() as conn:
+            expected = conn.shards.index("c1")
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM memories").fetchone()[0], 1)
+            self.assertEqual(conn.shards.get(expected).execute("SELECT COUNT(*) FROM memories").fetchone()[0], 1)
+
+    def test_search_is_scoped_to_conversation_and_shared(self):
+        self.store.add("c1", "compaction", "user likes green tea", [1.0, 0.0, 0.0])
+        self.store.add("c2", "compaction", "other user likes tea", [1.0, 0.0, 0.0])
+        self.store.add("global", "compaction", "shared fact about tea", [0.9, 0.1, 0.0])
+        result = self.store.execute("search", conversation_id="c1", query_embedding_json=[1, 0, 0], limit=5)
+        self.assertTrue(result["ok"])
+        self.assertEqual(self.contents(result), ["user likes green tea", "shared fact about tea"])
+
+
+class HybridSearchTest(MemoryStoreTestCase):
+    def test_lexical_and_vector_rankings_are_fused(self):
+        self.store.add("c1", "compaction", "user likes green tea", [1.0, 0.0, 0.0])
+        self.store.add("c1", "compaction", "user owns a bicycle", [0.0, 1.0, 0.0])
+        result = self.store.execute(
+            "hybrid-search", conversation_id="c1", query_text="green tea", query_embedding_json=[1, 0, 0], limit=5
+        )
+        self.assertTrue(result["ok"])
+        top = result["rows"][0]
+        self.assertEqual(top["content"], "user likes green tea")
+        self.assertEqual((top["lexical_rank"], top["vector_rank"]), (1, 1))
+        self.assertNotIn("user owns a bicycle", self.contents(result))
+
+
+class ConsolidateTest(MemoryStoreTestCase):
+    def test_near_duplicates_keep_the_newest(self):
+        self.store.add("c1", "compaction", "tea, newer", [1.0, 0.01, 0.0], created_at=2000)
+        self.store.add("c1", "compaction", "tea, older", [1.0, 0.0, 0.0], created_at=1000)
+        self.store.add("c1", "compaction", "bicycle", [0.0, 1.0, 0.0], created_at=1500)
+        result = self.store.execute("consolidate", threshold=0.95)
+        self.assertTrue(result["ok"])
+        self.assertEqual(result["merged"], 1)
+        with self.store.connection() as conn:
+            rows = [row["content"] for row in conn.execute("SELECT content FROM memories ORDER BY id")]
+        self.assertEqual(rows, ["tea, newer", "bicycle"])
+
+    def test_max_rows_caps_each_run(self):
+        for i in range(4):
+            self.store.add("c1", "compaction", f"tea {i}", [1.0, i / 1000.0, 0.0], created_at=1000 + i)
+        first = self.store.execute("consolidate", threshold=0.95, max_rows=2)
+        self.assertEqual(first["scanned"], 2)
+        self.store.execute("consolidate", threshold=0.95, max_rows=2)
+        self.store.execute("consolidate", threshold=0.95, max_rows=2)
+        self.assertEqual(self.count(self.store), 1)
+
+
+class RetainTest(MemoryStoreTestCase):
+    def test_per_conversation_cap_archives_the_oldest(self):
+        for i in range(3):
+            self.store.add("c1", "compaction", f"note {i}", [1.0, float(i), 0.0], created_at=1000 + i)
+        result = self.store.execute("retain", max_per_conversation=2)
+        self.assertEqual(result["archived_memories"], 1)
+        with self.store.connection() as conn:
+            rows = [row["content"] for row in conn.execute("SELECT content FROM memories ORDER BY created_at")]
+        self.assertEqual(rows, ["note 1", "note 2"])
+        archived = self.store.execute(
+            "search", conversation_id="c1", query_embedding_json=[1, 0, 0], limit=5, include_archive=1
+        )
+        self.assertIn("note 0", self.contents(archived))
+
+
+class EmbeddingCacheTest(MemoryStoreTestCase):
+    def test_hits_are_read_only_and_puts_evict_periodically(self):
+        store = self.open_store(pool_size=1)
+        for i in range(memory.EMBEDDING_CACHE_EVICT_EVERY + 1):
+            store.execute("cache-put", model="m", content=f"text {i}", embedding_json=[1.0, float(i)], max_entries=10)
+        with store.connection() as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0], 10)
+            before = conn.total_changes
+        for _ in range(3):
+            self.assertTrue(store.execute("cache-get", model="m", content="text 64")["hit"])
+        with store.connection() as conn:
+            self.assertEqual(conn.total_changes, before)
+
+
+class ReshardTest(MemoryStoreTestCase):
+    def add_rows(self, n: int) -> None:
+        for i in range(n):
+            self.store.add(f"c{i % 5}", "compaction", f"note {i}", [1.0, i / n, 0.0], created_at=1000 + i)
+
+    def test_reshard_and_back(self):
+        self.add_rows(20)
+        result = self.store.execute("reshard", shards=3)
+        self.assertEqual((result["shards"], result["moved"]), (3, 20))
+        self.assertEqual(self.count(self.store), 20)
+        result = self.store.execute("reshard", shards=0)
+        self.assertEqual(result["moved"], 20)
+        with self.store.connection() as conn:
+            self.assertIsNone(conn.shards)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM memories").fetchone()[0], 20)
+
+    def test_rerun_after_interruption_does_not_duplicate(self):
+        self.add_rows(20)
+        with self.store.connection() as conn:
+            memory.set_meta(conn, "shard_count", "3")
+            conn.commit()
+            memory.load_configured_shards(conn)
+            # Copy half the rows as an interrupted run would, without deleting them.
+            for row in conn.execute("SELECT * FROM memories ORDER BY id LIMIT 10").fetchall():
+                target = conn.shards.for_memory(row["conversation_id"], row["source"])
+                memory.insert_memories(
+                    target,
+                    [(row["conversation_id"], row["source"], row["content"], memory.row_embedding(row), row["created_at"])],
+                )
+        self.store.execute("reshard", shards=3)
+        self.assertEqual(self.count(self.store), 20)
+
+    def test_other_store_sees_the_new_shard_count(self):
+        self.add_rows(10)
+        self.assertEqual(len(self.store.execute("search", conversation_id="c1", query_embedding_json=[1, 0, 0])["rows"]), 2)
+        other = self.open_store()
+        other.execute("reshard", shards=2)
+        result = self.store.execute("search", conversation_id="c1", query_embedding_json=[1, 0, 0])
+        self.assertEqual(len(result["rows"]), 2)
+        self.assertTrue(all("shard" in row for row in result["rows"]))
+        self.store.add("c1", "compaction", "after reshard", [1.0, 0.0, 0.0])
+        with other.connection() as conn:
+            target = conn.shards.get(conn.shards.index("c1"))
+            self.assertEqual(
+                target.execute("SELECT COUNT(*) FROM memories WHERE content = 'after reshard'").fetchone()[0], 1
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
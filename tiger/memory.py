@@ -0,0 +1,3622 @@
+"""
+Tiger Bot - Memory Store
+SQLite-backed conversation memory: vector search, messages and maintenance.
+
+In-process callers use MemoryStore; scripts/sqlite_memory.py is the CLI and
+NDJSON server the Node agent talks to.
+"""
+import argparse
+import array
+import asyncio
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import functools
+import hashlib
+import json
+import math
+import os
+import queue
+import re
+import secrets
+import socketserver
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is optional
+    np = None
+
+# sqlite3 keeps compiled statements in a per-connection LRU keyed by SQL text,
+# so a long-lived connection (serve mode) reuses prepared statements for free.
+STATEMENT_CACHE_SIZE = 256
+
+# Per-connection tuning. The Telegram bot, CLI and reflection scheduler share
+# one file, so writers wait for the lock instead of failing with
+# "database is locked"; WAL itself is persistent and set once by init_db().
+BUSY_TIMEOUT_MS = 10000
+CACHE_SIZE_KIB = 32768
+MMAP_SIZE_BYTES = 256 * 1024 * 1024
+CHECKPOINT_MODES = ("PASSIVE", "FULL", "RESTART", "TRUNCATE")
+
+# Memories visible from every conversation share one vec0 partition.
+SHARED_SCOPE = "shared"
+
+# Archived rows live in a separate "<db>.archive.sqlite" file (attached as
+# "archive") so the hot file stays small. Rows keep their original id;
+# merged_into points at the memory that superseded them (consolidate) and is
+# NULL for rows expired by a retention policy.
+ARCHIVE_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS archive.memories_archive (
+      id INTEGER PRIMARY KEY,
+      conversation_id TEXT NOT NULL,
+      source TEXT NOT NULL,
+      content TEXT NOT NULL,
+      embedding_json TEXT NOT NULL,
+      embedding BLOB,
+      created_at INTEGER NOT NULL,
+      merged_into INTEGER,
+      archived_at INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS archive.messages_archive (
+      id INTEGER PRIMARY KEY,
+      conversation_id TEXT NOT NULL,
+      role TEXT NOT NULL,
+      content TEXT NOT NULL,
+      created_at INTEGER NOT NULL,
+      archived_at INTEGER NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS archive.idx_memories_archive_conv_time ON memories_archive(conversation_id, created_at)",
+)
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+class MemoryConnection(sqlite3.Connection):
+    """sqlite3 connection that remembers whether sqlite-vec was loaded into it."""
+
+    vec_loaded = False
+    matrix_cache: Optional["MatrixCache"] = None
+    ivf_index: Optional["IvfIndex"] = None
+    sidecar: Optional["EmbeddingSidecar"] = None
+    profile: Optional["CommandProfile"] = None
+    timings: Optional["TimingStats"] = None
+    shards: Optional["ShardSet"] = None
+    shard_index = 0
+    cache_puts = 0
+
+    def close(self) -> None:
+        if self.shards is not None:
+            self.shards.close()
+            self.shards = None
+        super().close()
+
+
+PHASES = ("connect", "query", "decode", "score", "sort", "serialize")
+TIMING_WINDOW = 512
+
+
+class CommandProfile:
+    """Exclusive wall-clock time per phase for one command.
+
+    Phases may nest (a cache miss inside "score" runs a "query"); the outer
+    phase is paused meanwhile so every second is charged exactly once.
+    """
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.mark = self.started
+        self.stack: List[str] = []
+        self.seconds: Dict[str, float] = {}
+
+    def _charge(self) -> None:
+        now = time.perf_counter()
+        if self.stack:
+            name = self.stack[-1]
+            self.seconds[name] = self.seconds.get(name, 0.0) + now - self.mark
+        self.mark = now
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        self._charge()
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self._charge()
+            self.stack.pop()
+
+    def report(self) -> Dict[str, Any]:
+        total = time.perf_counter() - self.started
+        phases = {name: round(self.seconds.get(name, 0.0) * 1000.0, 4) for name in PHASES}
+        phases["other"] = round(max(0.0, total - sum(self.seconds.values())) * 1000.0, 4)
+        return {"total_ms": round(total * 1000.0, 4), "phases": phases}
+
+
+class TimingStats:
+    """Rolling per-command latency window kept for the life of a MemoryStore (serve mode)."""
+
+    def __init__(self, window: int = TIMING_WINDOW) -> None:
+        self.window = window
+        self.samples: Dict[str, Deque[Dict[str, Any]]] = {}
+        self.lock = threading.Lock()
+
+    def record(self, command: str, report: Dict[str, Any]) -> None:
+        with self.lock:
+            self.samples.setdefault(command, collections.deque(maxlen=self.window)).append(report)
+
+    def report(self) -> Dict[str, Any]:
+        out = {}
+        with self.lock:
+            snapshot = [(command, list(samples)) for command, samples in sorted(self.samples.items())]
+        for command, samples in snapshot:
+            totals = sorted(sample["total_ms"] for sample in samples)
+            n = len(totals)
+            out[command] = {
+                "n": n,
+                "p50_ms": totals[(n - 1) // 2],
+                "p95_ms": totals[min(n - 1, int(n * 0.95))],
+                "p99_ms": totals[min(n - 1, int(n * 0.99))],
+                "mean_phases_ms": {
+                    name: round(sum(sample["phases"][name] for sample in samples) / n, 4)
+                    for name in (*PHASES, "other")
+                },
+            }
+        return out
+
+
+NO_PHASE = contextlib.nullcontext()
+
+
+def phase(conn: MemoryConnection, name: str) -> Any:
+    """Time a block against the running command's profile (a no-op outside run_command)."""
+    profile = conn.profile
+    return profile.phase(name) if profile is not None else NO_PHASE
+
+
+def connect(db_path: str, check_same_thread: bool = True) -> MemoryConnection:
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(
+        db_path,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=check_same_thread,
+        factory=MemoryConnection,
+        timeout=BUSY_TIMEOUT_MS / 1000.0,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    # NORMAL is durable across application crashes in WAL mode; only an OS
+    # crash can lose the last transactions, never corrupt the database.
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE_BYTES}")
+    return conn
+
+
+def load_vec_extension(conn: MemoryConnection, vec_ext_path: str) -> str:
+    """Load sqlite-vec into this connection; returns the load error, if any."""
+    conn.vec_loaded = False
+    if not vec_ext_path:
+        return ""
+    try:
+        conn.enable_load_extension(True)
+        conn.load_extension(vec_ext_path)
+        conn.vec_loaded = True
+        return ""
+    except Exception as err:  # pragma: no cover
+        return str(err)
+    finally:
+        try:
+            conn.enable_load_extension(False)
+        except Exception:
+            pass
+
+
+def load_configured_vec_extension(conn: MemoryConnection) -> None:
+    """Non-init commands reuse the extension path that init recorded in meta."""
+    try:
+        vec_ext_path = get_meta(conn, "sqlite_vec_extension_path")
+    except sqlite3.OperationalError:
+        return
+    load_vec_extension(conn, vec_ext_path)
+
+
+def set_meta(conn: MemoryConnection, key: str, value: str) -> None:
+    conn.execute(
+        "INSERT INTO meta(key, value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+        (key, value),
+    )
+
+
+def get_meta(conn: MemoryConnection, key: str, default: str = "") -> str:
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return str(row["value"]) if row else default
+
+
+def ensure_column(conn: MemoryConnection, table: str, column: str, decl: str) -> None:
+    cols = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+    if column not in cols:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def init_db(conn: MemoryConnection, vec_ext_path: str) -> Dict[str, Any]:
+    # Lets retain hand freed pages back to the OS a batch at a time. New files
+    # get it immediately; existing ones after their next full VACUUM
+    # (migrate-embeddings --vacuum 1).
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    journal_mode = str(conn.execute("PRAGMA journal_mode = WAL").fetchone()[0])
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS conversations (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          conversation_id TEXT NOT NULL UNIQUE,
+          platform TEXT DEFAULT '',
+          user_id TEXT DEFAULT '',
+          created_at INTEGER NOT NULL,
+          updated_at INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          conversation_id TEXT NOT NULL,
+          role TEXT NOT NULL,
+          content TEXT NOT NULL,
+          created_at INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_conv_time ON messages(conversation_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_time ON messages(created_at)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS skills (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          name TEXT NOT NULL UNIQUE,
+          provider TEXT DEFAULT '',
+          enabled INTEGER DEFAULT 1,
+          updated_at INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS memories (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          conversation_id TEXT NOT NULL,
+          source TEXT NOT NULL,
+          content TEXT NOT NULL,
+          embedding_json TEXT NOT NULL,
+          created_at INTEGER NOT NULL,
+          embedding BLOB
+        )
+        """
+    )
+    ensure_column(conn, "memories", "embedding", "BLOB")
+    ensure_column(conn, "memories", "embedding_q", "BLOB")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_memories_conv_time ON memories(conversation_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_memories_source_time ON memories(source, created_at)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS memory_ivf (
+          memory_id INTEGER PRIMARY KEY,
+          scope TEXT NOT NULL,
+          list_id INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_memory_ivf_list_scope ON memory_ivf(list_id, scope)")
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_memories_ivf_delete AFTER DELETE ON memories
+        BEGIN
+          DELETE FROM memory_ivf WHERE memory_id = old.id;
+        END
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS meta (
+          key TEXT PRIMARY KEY,
+          value TEXT NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS embedding_cache (
+          key TEXT PRIMARY KEY,
+          model TEXT NOT NULL,
+          embedding BLOB NOT NULL,
+          created_at INTEGER NOT NULL,
+          last_used_at INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_embedding_cache_used ON embedding_cache(last_used_at)")
+    fts_error = ensure_fts_index(conn)
+
+    vec_error = load_vec_extension(conn, vec_ext_path)
+    vec_loaded = conn.vec_loaded
+    vec_index_error = ""
+    if vec_loaded:
+        try:
+            sync_vec_index(conn)
+        except sqlite3.Error as err:
+            vec_index_error = str(err)
+
+    set_meta(conn, "sqlite_vec_extension_path", vec_ext_path or "")
+    set_meta(conn, "sqlite_vec_loaded", "1" if vec_loaded else "0")
+    set_meta(conn, "sqlite_vec_error", vec_error or vec_index_error)
+    conn.commit()
+    return {
+        "ok": True,
+        "vec_loaded": vec_loaded,
+        "vec_error": vec_error,
+        "vec_index_error": vec_index_error,
+        "fts_error": fts_error,
+        "journal_mode": journal_mode,
+    }
+
+
+def stats(conn: MemoryConnection) -> Dict[str, Any]:
+    out = {}
+    for table in ["memories", "conversations", "messages", "skills", "embedding_cache"]:
+        row = conn.execute(f"SELECT COUNT(*) AS c FROM {table}").fetchone()
+        out[table] = int(row["c"] if row else 0)
+    legacy = conn.execute("SELECT COUNT(*) AS c FROM memories WHERE embedding IS NULL AND embedding_json != ''").fetchone()
+    return {
+        "ok": True,
+        "counts": out,
+        "journal_mode": str(conn.execute("PRAGMA journal_mode").fetchone()[0]),
+        "embedding_dim": int(get_meta(conn, "embedding_dim", "0") or 0),
+        "legacy_json_embeddings": int(legacy["c"] if legacy else 0),
+        "ann": ann_stats(conn),
+        "sidecar": sidecar_stats(conn),
+        "quant": quant_stats(conn),
+        "fts": fts_available(conn),
+        "timings": conn.timings.report() if conn.timings is not None else {},
+    }
+
+
+def checkpoint(conn: MemoryConnection, mode: str, optimize: bool) -> Dict[str, Any]:
+    """checkpoint: fold the WAL back into the main file (TRUNCATE also empties it)."""
+    mode = mode.upper()
+    if mode not in CHECKPOINT_MODES:
+        return {"ok": False, "error": f"unknown checkpoint mode: {mode}"}
+    busy, wal_pages, checkpointed = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    if optimize:
+        conn.execute("PRAGMA optimize")
+    return {
+        "ok": True,
+        "mode": mode,
+        "busy": bool(busy),
+        "wal_pages": int(wal_pages),
+        "checkpointed_pages": int(checkpointed),
+    }
+
+
+def upsert_skill(conn: MemoryConnection, name: str, provider: str, enabled: int, updated_at: int) -> Dict[str, Any]:
+    conn.execute(
+        """
+        INSERT INTO skills(name, provider, enabled, updated_at)
+        VALUES(?, ?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET
+          provider=excluded.provider,
+          enabled=excluded.enabled,
+          updated_at=excluded.updated_at
+        """,
+        (name, provider, int(enabled), int(updated_at)),
+    )
+    conn.commit()
+    return {"ok": True}
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def ensure_conversation(
+    conn: MemoryConnection, conversation_id: str, platform: str, user_id: str, ts: int
+) -> Dict[str, Any]:
+    ts = int(ts) or now_ms()
+    conn.execute(
+        """
+        INSERT INTO conversations(conversation_id, platform, user_id, created_at, updated_at)
+        VALUES(?, ?, ?, ?, ?)
+        ON CONFLICT(conversation_id) DO UPDATE SET updated_at=excluded.updated_at
+        """,
+        (conversation_id, platform, user_id, ts, ts),
+    )
+    conn.commit()
+    return {"ok": True, "conversation_id": conversation_id}
+
+
+# (conversation_id, role, content, created_at)
+MessageRow = Tuple[str, str, str, int]
+
+
+def append_messages(conn: MemoryConnection, rows: List[MessageRow]) -> List[int]:
+    """Append messages in one transaction and return their ids (see insert_memories)."""
+    if not rows:
+        return []
+    rows = [(conv, role, content, int(ts) or now_ms()) for conv, role, content, ts in rows]
+    try:
+        conn.executemany(
+            "INSERT INTO messages(conversation_id, role, content, created_at) VALUES(?, ?, ?, ?)",
+            rows,
+        )
+        last_id = int(conn.execute("SELECT last_insert_rowid()").fetchone()[0])
+        latest: Dict[str, int] = {}
+        for conv, _, _, ts in rows:
+            latest[conv] = max(ts, latest.get(conv, 0))
+        conn.executemany(
+            "UPDATE conversations SET updated_at = ? WHERE conversation_id = ?",
+            [(ts, conv) for conv, ts in latest.items()],
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return list(range(last_id - len(rows) + 1, last_id + 1))
+
+
+def append_message(conn: MemoryConnection, conversation_id: str, role: str, content: str, created_at: int) -> Dict[str, Any]:
+    ids = append_messages(conn, [(conversation_id, role, content, created_at)])
+    return {"ok": True, "id": ids[0]}
+
+
+def append_messages_batch(conn: MemoryConnection, items: List[Any]) -> List[Dict[str, Any]]:
+    """append-messages: bulk form of append-message (used to import agent.json history)."""
+    results: List[Dict[str, Any]] = [{} for _ in items]
+    positions = []
+    rows: List[MessageRow] = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[i] = {"ok": False, "error": item_error(item)}
+            continue
+        positions.append(i)
+        rows.append(
+            (
+                str(param(item, "conversation_id", "")),
+                str(param(item, "role", "")),
+                str(param(item, "content", "")),
+                int(param(item, "created_at", 0)),
+            )
+        )
+    for i, message_id in zip(positions, append_messages(conn, rows)):
+        results[i] = {"ok": True, "id": message_id}
+    return results
+
+
+def recent_messages(conn: MemoryConnection, conversation_id: str, limit: int, since: int) -> Dict[str, Any]:
+    """recent-messages: the newest `limit` messages, oldest first.
+
+    Scoped to one conversation when conversation_id is set (served by
+    idx_messages_conv_time), otherwise across all conversations.
+    """
+    where = ["created_at > ?"]
+    args: List[Any] = [int(since)]
+    if conversation_id:
+        where.append("conversation_id = ?")
+        args.append(conversation_id)
+    rows = conn.execute(
+        f"""
+        SELECT id, conversation_id, role, content, created_at FROM messages
+        WHERE {" AND ".join(where)}
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
+        """,
+        (*args, int(limit)),
+    ).fetchall()
+    return {"ok": True, "rows": [dict(row) for row in reversed(rows)]}
+
+
+def message_count(conn: MemoryConnection, conversation_id: str) -> Dict[str, Any]:
+    row = conn.execute("SELECT COUNT(*) FROM messages WHERE conversation_id = ?", (conversation_id,)).fetchone()
+    return {"ok": True, "count": int(row[0])}
+
+
+def compaction_range(conn: MemoryConnection, conversation_id: str, max_messages: int, keep_recent: int) -> Dict[str, Any]:
+    """compaction-range: once a conversation exceeds max_messages, every message but the newest keep_recent."""
+    count = message_count(conn, conversation_id)["count"]
+    to_compact = max(0, count - int(keep_recent))
+    if count <= int(max_messages) or not to_compact:
+        return {"ok": True, "count": count, "rows": []}
+    rows = conn.execute(
+        """
+        SELECT id, role, content FROM messages
+        WHERE conversation_id = ?
+        ORDER BY created_at, id
+        LIMIT ?
+        """,
+        (conversation_id, to_compact),
+    ).fetchall()
+    return {"ok": True, "count": count, "rows": [dict(row) for row in rows]}
+
+
+def delete_messages_up_to(conn: MemoryConnection, conversation_id: str, max_id: int) -> Dict[str, Any]:
+    cur = conn.execute("DELETE FROM messages WHERE conversation_id = ? AND id <= ?", (conversation_id, int(max_id)))
+    conn.commit()
+    return {"ok": True, "deleted": max(cur.rowcount, 0)}
+
+
+EMBEDDING_CACHE_MAX_ENTRIES = 20000
+# A hit only rewrites last_used_at once it is this stale, so repeated lookups
+# stay read-only; LRU order is kept to this granularity.
+EMBEDDING_CACHE_TOUCH_MS = 10 * 60 * 1000
+# cache-put counts rows and evicts on the first put of a connection and then
+# every N puts, so the cache may run up to N entries over max_entries.
+EMBEDDING_CACHE_EVICT_EVERY = 64
+
+
+def embedding_cache_key(model: str, text: str) -> str:
+    """sha256 over the model and the NFC-normalized, whitespace-collapsed text."""
+    normalized = " ".join(unicodedata.normalize("NFC", text).split())
+    return hashlib.sha256(f"{model}\0{normalized}".encode("utf-8")).hexdigest()
+
+
+def cache_get(conn: MemoryConnection, model: str, text: str) -> Dict[str, Any]:
+    """cache-get: return the cached embedding for (model, text) and mark it recently used."""
+    key = embedding_cache_key(model, text)
+    row = conn.execute("SELECT embedding, last_used_at FROM embedding_cache WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return {"ok": True, "hit": False}
+    ts = now_ms()
+    if ts - int(row["last_used_at"]) >= EMBEDDING_CACHE_TOUCH_MS:
+        conn.execute("UPDATE embedding_cache SET last_used_at = ? WHERE key = ?", (ts, key))
+        conn.commit()
+    return {"ok": True, "hit": True, "embedding": unpack_embedding(row["embedding"])}
+
+
+def cache_put(conn: MemoryConnection, model: str, text: str, embedding_json: str, max_entries: int) -> Dict[str, Any]:
+    """cache-put: store an embedding, evicting least-recently-used entries beyond max_entries."""
+    emb = parse_embedding(embedding_json)
+    if not emb:
+        return {"ok": False, "error": "embedding is empty"}
+    ts = now_ms()
+    conn.execute(
+        """
+        INSERT INTO embedding_cache(key, model, embedding, created_at, last_used_at)
+        VALUES(?, ?, ?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET embedding=excluded.embedding, last_used_at=excluded.last_used_at
+        """,
+        (embedding_cache_key(model, text), model, pack_embedding(emb), ts, ts),
+    )
+    evicted = 0
+    sweep = conn.cache_puts % EMBEDDING_CACHE_EVICT_EVERY == 0
+    conn.cache_puts += 1
+    count = int(conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]) if sweep else 0
+    if count > int(max_entries):
+        cur = conn.execute(
+            """
+            DELETE FROM embedding_cache WHERE key IN (
+              SELECT key FROM embedding_cache ORDER BY last_used_at LIMIT ?
+            )
+            """,
+            (count - int(max_entries),),
+        )
+        evicted = max(cur.rowcount, 0)
+    conn.commit()
+    return {"ok": True, "evicted": evicted}
+
+
+def parse_embedding(text: str) -> List[float]:
+    try:
+        data = json.loads(text or "[]")
+        if not isinstance(data, list):
+            return []
+        out = []
+        for v in data:
+            try:
+                out.append(float(v))
+            except Exception:
+                pass
+        return out
+    except Exception:
+        return []
+
+
+def pack_embedding(values: List[float]) -> bytes:
+    """Encode a vector as little-endian float32, the on-disk format of memories.embedding."""
+    packed = array.array("f", values)
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_embedding(blob: bytes) -> List[float]:
+    packed = array.array("f")
+    packed.frombytes(blob or b"")
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return packed.tolist()
+
+
+def row_embedding(row: sqlite3.Row) -> List[float]:
+    """Prefer the packed column; rows written before the migration only have JSON."""
+    if row["embedding"] is not None:
+        return unpack_embedding(row["embedding"])
+    return parse_embedding(row["embedding_json"])
+
+
+def record_embedding_dim(conn: MemoryConnection, dim: int) -> None:
+    if dim and not get_meta(conn, "embedding_dim"):
+        set_meta(conn, "embedding_dim", str(dim))
+
+
+def cosine_similarity(a: List[float], b: List[float]) -> float:
+    if not a or not b or len(a) != len(b):
+        return -1.0
+    dot = 0.0
+    aa = 0.0
+    bb = 0.0
+    for i in range(len(a)):
+        av = float(a[i])
+        bv = float(b[i])
+        dot += av * bv
+        aa += av * av
+        bb += bv * bv
+    if aa <= 0.0 or bb <= 0.0:
+        return -1.0
+    return dot / (math.sqrt(aa) * math.sqrt(bb))
+
+
+def memory_scope(conversation_id: str, source: str) -> str:
+    if conversation_id == "global" or source == "self_reflection":
+        return SHARED_SCOPE
+    return conversation_id
+
+
+def vec_index_dim(conn: MemoryConnection) -> int:
+    """Dimension of the memories_vec table, or 0 when it is unavailable on this connection."""
+    if not conn.vec_loaded:
+        return 0
+    return int(get_meta(conn, "vec_index_dim", "0") or 0)
+
+
+def sync_vec_index(conn: MemoryConnection) -> int:
+    """Create memories_vec once the embedding dimension is known and backfill missing rows.
+
+    Rows whose packed embedding has a different dimension (or that still only
+    have legacy JSON) are skipped; they remain reachable through the scan path.
+    """
+    dim = int(get_meta(conn, "embedding_dim", "0") or 0)
+    if not conn.vec_loaded or not dim:
+        return 0
+    conn.execute(
+        f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS memories_vec USING vec0(
+          scope TEXT PARTITION KEY,
+          embedding FLOAT[{dim}] distance_metric=cosine
+        )
+        """
+    )
+    set_meta(conn, "vec_index_dim", str(dim))
+    cur = conn.execute(
+        """
+        INSERT INTO memories_vec(rowid, scope, embedding)
+        SELECT id,
+               CASE WHEN conversation_id = 'global' OR source = 'self_reflection' THEN ? ELSE conversation_id END,
+               embedding
+        FROM memories
+        WHERE embedding IS NOT NULL AND length(embedding) = ?
+          AND id NOT IN (SELECT rowid FROM memories_vec)
+        """,
+        (SHARED_SCOPE, dim * 4),
+    )
+    # Rows deleted while the extension was not loaded leave orphans behind.
+    conn.execute("DELETE FROM memories_vec WHERE rowid NOT IN (SELECT id FROM memories)")
+    return max(cur.rowcount, 0)
+
+
+# (conversation_id, source, content, embedding, created_at)
+MemoryRow = Tuple[str, str, str, List[float], int]
+
+
+def insert_memories(conn: MemoryConnection, rows: List[MemoryRow]) -> List[int]:
+    """Insert rows with one executemany in a single transaction and return their ids.
+
+    The write lock is held from the first INSERT until commit, so AUTOINCREMENT
+    hands out a contiguous id range ending at last_insert_rowid().
+    """
+    if not rows:
+        return []
+    packed = [pack_embedding(emb) for _, _, _, emb, _ in rows]
+    mode = get_meta(conn, "quant_mode")
+    codes = [quantize_vector(emb, mode) if emb else None for _, _, _, emb, _ in rows]
+    try:
+        conn.executemany(
+            "INSERT INTO memories(conversation_id, source, content, embedding_json, embedding, embedding_q, created_at) "
+            "VALUES(?, ?, ?, '', ?, ?, ?)",
+            [
+                (conv, source, content, blob, code, int(ts))
+                for (conv, source, content, _, ts), blob, code in zip(rows, packed, codes)
+            ],
+        )
+        last_id = int(conn.execute("SELECT last_insert_rowid()").fetchone()[0])
+        ids = list(range(last_id - len(rows) + 1, last_id + 1))
+        for _, _, _, emb, _ in rows:
+            record_embedding_dim(conn, len(emb))
+        if conn.vec_loaded:
+            dim = vec_index_dim(conn)
+            if not dim:
+                sync_vec_index(conn)
+            else:
+                conn.executemany(
+                    "INSERT INTO memories_vec(rowid, scope, embedding) VALUES(?, ?, ?)",
+                    [
+                        (memory_id, memory_scope(conv, source), blob)
+                        for memory_id, (conv, source, _, emb, _), blob in zip(ids, rows, packed)
+                        if len(emb) == dim
+                    ],
+                )
+        sync_ivf(conn)
+        sync_sidecar(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    for memory_id, (conv, source, _, emb, ts), code in zip(ids, rows, codes):
+        append_to_matrix_cache(conn, memory_id, memory_scope(conv, source), emb, mode, code, int(ts))
+    return ids
+
+
+def add_memory(
+    conn: MemoryConnection, conversation_id: str, source: str, content: str, embedding_json: str, created_at: int
+) -> Dict[str, Any]:
+    ids = store_memories(conn, [(conversation_id, source, content, parse_embedding(embedding_json), created_at)])
+    return {"ok": True, "id": ids[0]}
+
+
+def item_error(item: Any) -> str:
+    if isinstance(item, Exception):
+        return str(item)
+    return "item must be a JSON object"
+
+
+def add_memories(conn: MemoryConnection, items: List[Any]) -> List[Dict[str, Any]]:
+    """add-batch: one result per item, in input order; malformed items are reported, not inserted."""
+    results: List[Dict[str, Any]] = [{} for _ in items]
+    positions = []
+    rows: List[MemoryRow] = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[i] = {"ok": False, "error": item_error(item)}
+            continue
+        positions.append(i)
+        rows.append(
+            (
+                str(param(item, "conversation_id", "")),
+                str(param(item, "source", "")),
+                str(param(item, "content", "")),
+                parse_embedding(json_text(param(item, "embedding_json", "[]"))),
+                int(param(item, "created_at", 0)),
+            )
+        )
+    for i, memory_id in zip(positions, store_memories(conn, rows)):
+        results[i] = {"ok": True, "id": memory_id}
+    return results
+
+
+def delete_memories(conn: MemoryConnection, ids: List[int]) -> None:
+    """Delete memories and every index entry derived from them, then commit.
+
+    Pending writes the caller made in the same transaction (archive copies,
+    meta updates) commit or roll back together with the delete. Triggers
+    clean memory_ivf and memories_fts; memories_vec and the sidecar are
+    handled here.
+    """
+    params = [(int(memory_id),) for memory_id in ids]
+    try:
+        if conn.vec_loaded and vec_index_dim(conn):
+            conn.executemany("DELETE FROM memories_vec WHERE rowid = ?", params)
+        conn.executemany("DELETE FROM memories WHERE id = ?", params)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    # Cached scope matrices would still hold the deleted rows, and our own
+    # commits do not bump PRAGMA data_version for this connection.
+    conn.matrix_cache = None
+    sidecar = load_sidecar(conn)
+    if sidecar is not None:
+        synced_id = int(get_meta(conn, "emb_sidecar_synced_id", "0") or 0)
+        zero = bytes(sidecar.stride)
+        sidecar.write((memory_id, zero) for memory_id in ids if memory_id <= synced_id)
+
+
+def migrate_embeddings(conn: MemoryConnection, batch_size: int, vacuum: bool) -> Dict[str, Any]:
+    """Convert legacy embedding_json rows to packed float32 in place, one batch per transaction."""
+    converted = 0
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            """
+            SELECT id, embedding_json FROM memories
+            WHERE id > ? AND embedding IS NULL
+            ORDER BY id
+            LIMIT ?
+            """,
+            (last_id, int(batch_size)),
+        ).fetchall()
+        if not rows:
+            break
+        updates = []
+        for row in rows:
+            emb = parse_embedding(row["embedding_json"])
+            record_embedding_dim(conn, len(emb))
+            updates.append((pack_embedding(emb), row["id"]))
+        conn.executemany("UPDATE memories SET embedding = ?, embedding_json = '' WHERE id = ?", updates)
+        conn.commit()
+        converted += len(updates)
+        last_id = rows[-1]["id"]
+    if converted and conn.vec_loaded:
+        sync_vec_index(conn)
+        conn.commit()
+    if vacuum and converted:
+        conn.execute("VACUUM")
+    return {"ok": True, "converted": converted, "embedding_dim": int(get_meta(conn, "embedding_dim", "0") or 0)}
+
+
+RECENCY_WEIGHT = 0.1
+# Backends that cannot add the recency bonus inside their top-k (vec0, IVF,
+# quantized) fetch this many times more candidates and re-rank them.
+RECENCY_OVERFETCH = 4
+
+
+class RecencyDecay:
+    """Freshness bonus weight * 0.5 ** (age / half_life) added to cosine scores.
+
+    The bonus is additive and at most weight, so an old memory that matches
+    well still beats a fresh one that does not.
+    """
+
+    def __init__(self, half_life_days: float, weight: float) -> None:
+        self.half_life_ms = float(half_life_days) * DAY_MS
+        self.weight = float(weight)
+        self.now = now_ms()
+
+    def boost(self, created_at: int) -> float:
+        age = max(0.0, self.now - float(created_at))
+        return self.weight * 0.5 ** (age / self.half_life_ms)
+
+    def boosts(self, created_at: "np.ndarray") -> "np.ndarray":
+        age = np.maximum(0.0, self.now - created_at.astype(np.float64))
+        return (self.weight * np.exp2(-age / self.half_life_ms)).astype(np.float32)
+
+
+def recency_decay(params: Dict[str, Any]) -> Optional[RecencyDecay]:
+    """--half-life-days enables the bonus; 0 (the default) ranks by similarity alone."""
+    half_life_days = float(param(params, "half_life_days", 0))
+    weight = float(param(params, "recency_weight", RECENCY_WEIGHT))
+    if half_life_days <= 0 or weight <= 0:
+        return None
+    return RecencyDecay(half_life_days, weight)
+
+
+SCAN_COLUMNS = "id, conversation_id, source, content, embedding_json, embedding, created_at"
+
+
+def scan_candidates(
+    conn: MemoryConnection, conversation_id: str, window: int, shared_window: int = 0
+) -> List[Tuple[sqlite3.Row, List[float]]]:
+    """Newest rows of each visible scope, each with its own budget.
+
+    One UNION ALL of per-scope subqueries, each walking its own index
+    newest-first: the conversation and global rows on
+    idx_memories_conv_time, self_reflection rows on idx_memories_source_time.
+    A busy shared scope therefore cannot crowd the conversation's rows out
+    of the window. shared_window (default: window) caps global and
+    self_reflection separately.
+    """
+    shared_window = int(shared_window) or int(window)
+    subqueries = []
+    args: List[Any] = []
+    if memory_scope(conversation_id, "") != SHARED_SCOPE:
+        subqueries.append(CONVERSATION_SCOPE_SQL)
+        args += [conversation_id, int(window)]
+    subqueries.append("conversation_id = 'global'")
+    args.append(shared_window)
+    subqueries.append("source = 'self_reflection' AND conversation_id != 'global'")
+    args.append(shared_window)
+    sql = " UNION ALL ".join(
+        f"SELECT * FROM (SELECT {SCAN_COLUMNS} FROM memories WHERE {where} ORDER BY created_at DESC LIMIT ?)"
+        for where in subqueries
+    )
+    with phase(conn, "query"):
+        rows = conn.execute(sql, args).fetchall()
+    with phase(conn, "decode"):
+        return [(row, row_embedding(row)) for row in rows]
+
+
+def rank_candidates(
+    conn: MemoryConnection,
+    candidates: List[Tuple[sqlite3.Row, List[float]]],
+    q_emb: List[float],
+    limit: int,
+    min_score: float,
+    recency: Optional[RecencyDecay] = None,
+) -> List[Dict[str, Any]]:
+    ranked = []
+    with phase(conn, "score"):
+        for row, emb in candidates:
+            score = cosine_similarity(q_emb, emb)
+            if recency is not None:
+                score += recency.boost(row["created_at"])
+            if score > float(min_score):
+                ranked.append(
+                    {
+                        "id": row["id"],
+                        "source": row["source"],
+                        "content": row["content"],
+                        "created_at": row["created_at"],
+                        "score": score,
+                    }
+                )
+
+    with phase(conn, "sort"):
+        ranked.sort(key=lambda r: r["score"], reverse=True)
+    return ranked[: int(limit)]
+
+
+def search_memories(
+    conn: MemoryConnection,
+    conversation_id: str,
+    query_embedding_json: str,
+    limit: int,
+    min_score: float,
+    window: int,
+    nprobe: int = 8,
+    max_candidates: int = 4096,
+    quant: str = "",
+    rerank: int = 0,
+    recency: Optional[RecencyDecay] = None,
+    shared_window: int = 0,
+) -> Dict[str, Any]:
+    with phase(conn, "decode"):
+        q_emb = parse_embedding(query_embedding_json)
+    if not q_emb:
+        return {"ok": True, "rows": []}
+
+    if len(q_emb) == vec_index_dim(conn):
+        return search_memories_vec(conn, conversation_id, q_emb, limit, min_score, recency)
+    index = load_ivf(conn) if nprobe > 0 else None
+    if index is not None and index.dim == len(q_emb):
+        return search_memories_ivf(
+            conn, index, conversation_id, q_emb, limit, min_score, nprobe, max_candidates, recency
+        )
+    if np is not None:
+        mode = quant or get_meta(conn, "quant_mode")
+        if mode in QUANT_MODES:
+            return search_memories_quant(conn, mode, conversation_id, q_emb, limit, min_score, rerank, recency)
+        return search_memories_numpy(conn, conversation_id, q_emb, limit, min_score, recency)
+
+    candidates = scan_candidates(conn, conversation_id, window, shared_window)
+    return {"ok": True, "backend": "scan", "rows": rank_candidates(conn, candidates, q_emb, limit, min_score, recency)}
+
+
+def search_memories_batch(conn: MemoryConnection, items: List[Any]) -> List[Dict[str, Any]]:
+    """search-batch: queries sharing a conversation and dimension are scored in one pass."""
+    results: List[Dict[str, Any]] = [{} for _ in items]
+    groups: Dict[Tuple[str, int, str, int, float, float], List[Tuple[int, List[float], int, float, int, int]]] = {}
+    stored_mode = get_meta(conn, "quant_mode")
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[i] = {"ok": False, "error": item_error(item)}
+            continue
+        q_emb = parse_embedding(json_text(param(item, "query_embedding_json", "[]")))
+        if not q_emb:
+            results[i] = {"ok": True, "rows": []}
+            continue
+        conversation_id = str(param(item, "conversation_id", ""))
+        recency = recency_decay(item)
+        nprobe = int(param(item, "nprobe", 8))
+        index = load_ivf(conn) if nprobe > 0 else None
+        if len(q_emb) != vec_index_dim(conn) and index is not None and index.dim == len(q_emb):
+            results[i] = search_memories_ivf(
+                conn,
+                index,
+                conversation_id,
+                q_emb,
+                int(param(item, "limit", 6)),
+                float(param(item, "min_score", 0.1)),
+                nprobe,
+                int(param(item, "max_candidates", 4096)),
+                recency,
+            )
+            continue
+        mode = str(param(item, "quant", "")) or stored_mode
+        group = (
+            conversation_id,
+            len(q_emb),
+            mode,
+            int(param(item, "rerank", 0)),
+            recency.half_life_ms if recency is not None else 0.0,
+            recency.weight if recency is not None else 0.0,
+        )
+        groups.setdefault(group, []).append(
+            (
+                i,
+                q_emb,
+                int(param(item, "limit", 6)),
+                float(param(item, "min_score", 0.1)),
+                int(param(item, "window", 600)),
+                int(param(item, "shared_window", 0)),
+            )
+        )
+
+    for (conversation_id, dim, mode, rerank, half_life_ms, weight), queries in groups.items():
+        recency = RecencyDecay(half_life_ms / DAY_MS, weight) if half_life_ms else None
+        if dim == vec_index_dim(conn):
+            for i, q_emb, limit, min_score, _, _ in queries:
+                results[i] = search_memories_vec(conn, conversation_id, q_emb, limit, min_score, recency)
+        elif np is not None and mode in QUANT_MODES:
+            limits = [recency_fetch_size(q[2], recency) for q in queries]
+            scored = quant_rank(conn, mode, conversation_id, [q[1] for q in queries], limits, rerank)
+            for (i, _, limit, min_score, _, _), top in zip(queries, scored):
+                rows = fetch_ranked_rows(conn, top, min_score, recency, limit)
+                results[i] = {"ok": True, "backend": mode, "rows": rows}
+        elif np is not None:
+            backend, scored = numpy_rank(
+                conn, conversation_id, [q[1] for q in queries], [q[2] for q in queries], recency
+            )
+            for (i, _, _, min_score, _, _), top in zip(queries, scored):
+                results[i] = {"ok": True, "backend": backend, "rows": fetch_ranked_rows(conn, top, min_score)}
+        else:
+            windows: Dict[Tuple[int, int], List[Tuple[sqlite3.Row, List[float]]]] = {}
+            for i, q_emb, limit, min_score, window, shared_window in queries:
+                if (window, shared_window) not in windows:
+                    windows[(window, shared_window)] = scan_candidates(conn, conversation_id, window, shared_window)
+                rows = rank_candidates(conn, windows[(window, shared_window)], q_emb, limit, min_score, recency)
+                results[i] = {"ok": True, "backend": "scan", "rows": rows}
+    return results
+
+
+def search_memories_vec(
+    conn: MemoryConnection,
+    conversation_id: str,
+    q_emb: List[float],
+    limit: int,
+    min_score: float,
+    recency: Optional[RecencyDecay] = None,
+) -> Dict[str, Any]:
+    """Native KNN over the whole corpus: one partition-scoped query per visible scope."""
+    packed = pack_embedding(q_emb)
+    scopes = {memory_scope(conversation_id, ""), SHARED_SCOPE}
+    ranked = []
+    for scope in scopes:
+        # vec0 scores inside the query, so KNN time is reported under "query".
+        with phase(conn, "query"):
+            rows = conn.execute(
+                """
+                SELECT m.id, m.source, m.content, m.created_at, knn.distance
+                FROM (
+                  SELECT rowid, distance FROM memories_vec
+                  WHERE embedding MATCH ? AND k = ? AND scope = ?
+                ) AS knn
+                JOIN memories AS m ON m.id = knn.rowid
+                """,
+                (packed, recency_fetch_size(limit, recency), scope),
+            ).fetchall()
+        for row in rows:
+            score = 1.0 - float(row["distance"])
+            if recency is not None:
+                score += recency.boost(row["created_at"])
+            if score > float(min_score):
+                ranked.append(
+                    {
+                        "id": row["id"],
+                        "source": row["source"],
+                        "content": row["content"],
+                        "created_at": row["created_at"],
+                        "score": score,
+                    }
+                )
+
+    with phase(conn, "sort"):
+        ranked.sort(key=lambda r: r["score"], reverse=True)
+    return {"ok": True, "backend": "vec0", "rows": ranked[: int(limit)]}
+
+
+# SQL predicates selecting the memories that belong to one scope (see memory_scope).
+SHARED_SCOPE_SQL = "(conversation_id = 'global' OR source = 'self_reflection')"
+CONVERSATION_SCOPE_SQL = "(conversation_id = ? AND conversation_id != 'global' AND source != 'self_reflection')"
+
+
+class ScopeMatrix:
+    """Unit-normalized float32 vectors for one scope, grown in place on append."""
+
+    def __init__(self, dim: int) -> None:
+        self.dim = dim
+        self.size = 0
+        self.ids = np.empty(0, dtype=np.int64)
+        self.created = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+
+    def append(self, ids: "np.ndarray", vectors: "np.ndarray", created: "np.ndarray") -> None:
+        needed = self.size + len(ids)
+        if needed > len(self.ids):
+            capacity = max(needed, 2 * len(self.ids), 64)
+            grown_ids = np.empty(capacity, dtype=np.int64)
+            grown_created = np.empty(capacity, dtype=np.int64)
+            grown_vectors = np.empty((capacity, self.dim), dtype=np.float32)
+            grown_ids[: self.size] = self.ids[: self.size]
+            grown_created[: self.size] = self.created[: self.size]
+            grown_vectors[: self.size] = self.vectors[: self.size]
+            self.ids, self.created, self.vectors = grown_ids, grown_created, grown_vectors
+        self.ids[self.size : needed] = ids
+        self.created[self.size : needed] = created
+        self.vectors[self.size : needed] = normalize_rows(vectors)
+        self.size = needed
+
+    def scores(self, unit_queries: "np.ndarray") -> Tuple["np.ndarray", "np.ndarray"]:
+        """Cosine scores of shape (size, n_queries) for row-stacked unit queries."""
+        return self.ids[: self.size], self.vectors[: self.size] @ unit_queries.T
+
+
+class ScopeMembers:
+    """Ids and created_at of one scope, cached beside the matrices for the mmap sidecar."""
+
+    def __init__(self, ids: "np.ndarray", created: "np.ndarray") -> None:
+        self.ids = ids
+        self.created = created
+
+    def append(self, ids: "np.ndarray", created: "np.ndarray") -> None:
+        self.ids = np.concatenate([self.ids, ids])
+        self.created = np.concatenate([self.created, created])
+
+
+class MatrixCache:
+    """Per-connection ScopeMatrix cache, dropped when another connection commits.
+
+    The "members" mode holds a scope's ScopeMembers (dim 0), so sidecar
+    searches skip the per-query id lookup under the same invalidation.
+    """
+
+    def __init__(self) -> None:
+        self.blocks: Dict[Tuple[str, int, str], Any] = {}
+        self.data_version = -1
+
+    def validate(self, conn: MemoryConnection) -> None:
+        # data_version only changes for commits made by *other* connections, so
+        # our own incremental appends keep the cache warm.
+        version = int(conn.execute("PRAGMA data_version").fetchone()[0])
+        if version != self.data_version:
+            self.blocks.clear()
+            self.data_version = version
+
+    def block(self, conn: MemoryConnection, scope: str, dim: int, mode: str = "float32") -> Any:
+        key = (scope, dim, mode)
+        if key not in self.blocks:
+            if mode == "float32":
+                self.blocks[key] = load_scope_matrix(conn, scope, dim)
+            elif mode == "members":
+                with phase(conn, "query"):
+                    self.blocks[key] = ScopeMembers(*scope_members(conn, scope))
+            else:
+                self.blocks[key] = load_quant_block(conn, scope, dim, mode)
+        return self.blocks[key]
+
+
+def normalize_rows(vectors: "np.ndarray") -> "np.ndarray":
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0.0] = 1.0
+    return vectors / norms
+
+
+def load_scope_matrix(conn: MemoryConnection, scope: str, dim: int) -> ScopeMatrix:
+    if scope == SHARED_SCOPE:
+        where, args = SHARED_SCOPE_SQL, ()
+    else:
+        where, args = CONVERSATION_SCOPE_SQL, (scope,)
+    with phase(conn, "query"):
+        rows = conn.execute(
+            f"SELECT id, embedding, embedding_json, created_at FROM memories WHERE {where} ORDER BY id", args
+        ).fetchall()
+
+    with phase(conn, "decode"):
+        ids: List[int] = []
+        created: List[int] = []
+        chunks: List[bytes] = []
+        for row in rows:
+            blob = row["embedding"]
+            if blob is None:
+                # Legacy JSON rows are re-packed once here rather than on every query.
+                blob = pack_embedding(parse_embedding(row["embedding_json"]))
+            if len(blob) == dim * 4:
+                ids.append(row["id"])
+                created.append(row["created_at"])
+                chunks.append(blob)
+
+        block = ScopeMatrix(dim)
+        if ids:
+            vectors = np.frombuffer(b"".join(chunks), dtype="<f4").reshape(len(ids), dim)
+            block.append(np.asarray(ids, dtype=np.int64), vectors, np.asarray(created, dtype=np.int64))
+    return block
+
+
+def matrix_cache(conn: MemoryConnection) -> "MatrixCache":
+    if conn.matrix_cache is None:
+        conn.matrix_cache = MatrixCache()
+    conn.matrix_cache.validate(conn)
+    return conn.matrix_cache
+
+
+def append_to_matrix_cache(
+    conn: MemoryConnection,
+    memory_id: int,
+    scope: str,
+    emb: List[float],
+    mode: str,
+    code: Optional[bytes],
+    created_at: int,
+) -> None:
+    if np is None or conn.matrix_cache is None:
+        return
+    ids = np.asarray([memory_id], dtype=np.int64)
+    members = conn.matrix_cache.blocks.get((scope, 0, "members"))
+    if members is not None:
+        members.append(ids, np.asarray([created_at], dtype=np.int64))
+    block = conn.matrix_cache.blocks.get((scope, len(emb), "float32"))
+    if block is not None:
+        block.append(ids, np.asarray([emb], dtype=np.float32), np.asarray([created_at], dtype=np.int64))
+    quant_block = conn.matrix_cache.blocks.get((scope, len(emb), mode))
+    if quant_block is not None and code is not None:
+        quant_block.append(ids, [code])
+
+
+def top_k(ids: "np.ndarray", scores: "np.ndarray", k: int) -> List[Tuple[int, float]]:
+    if not len(ids) or k <= 0:
+        return []
+    if k < len(ids):
+        picked = np.argpartition(scores, -k)[-k:]
+    else:
+        picked = np.arange(len(ids))
+    picked = picked[np.argsort(scores[picked])[::-1]]
+    return [(int(ids[i]), float(scores[i])) for i in picked]
+
+
+def recency_fetch_size(limit: int, recency: Optional[RecencyDecay]) -> int:
+    return int(limit) * RECENCY_OVERFETCH if recency is not None else int(limit)
+
+
+def fetch_ranked_rows(
+    conn: MemoryConnection,
+    scored: List[Tuple[int, float]],
+    min_score: float,
+    recency: Optional[RecencyDecay] = None,
+    limit: int = 0,
+) -> List[Dict[str, Any]]:
+    """Load rows for (id, score) pairs; with recency, add the bonus and re-rank down to limit."""
+    if recency is None:
+        scored = [(memory_id, score) for memory_id, score in scored if score > float(min_score)]
+    if not scored:
+        return []
+    placeholders = ",".join("?" for _ in scored)
+    with phase(conn, "query"):
+        rows = conn.execute(
+            f"SELECT id, source, content, created_at FROM memories WHERE id IN ({placeholders})",
+            [memory_id for memory_id, _ in scored],
+        ).fetchall()
+    by_id = {row["id"]: row for row in rows}
+    ranked = []
+    for memory_id, score in scored:
+        row = by_id.get(memory_id)
+        if row is not None:
+            ranked.append(
+                {
+                    "id": row["id"],
+                    "source": row["source"],
+                    "content": row["content"],
+                    "created_at": row["created_at"],
+                    "score": score,
+                }
+            )
+    if recency is not None:
+        for row in ranked:
+            row["score"] += recency.boost(row["created_at"])
+        ranked = [row for row in ranked if row["score"] > float(min_score)]
+        with phase(conn, "sort"):
+            ranked.sort(key=lambda r: r["score"], reverse=True)
+        ranked = ranked[: int(limit)]
+    return ranked
+
+
+def numpy_rank(
+    conn: MemoryConnection,
+    conversation_id: str,
+    queries: List[List[float]],
+    limits: List[int],
+    recency: Optional[RecencyDecay] = None,
+) -> Tuple[str, List[List[Tuple[int, float]]]]:
+    """Score every query against the visible scopes with one matrix product per scope.
+
+    Vectors come from the shared mmap sidecar when it matches the query
+    dimension, otherwise from this connection's MatrixCache. The recency
+    bonus is one more vector added to each scope's score block before top-k.
+    """
+    unit_queries = normalize_rows(np.asarray(queries, dtype=np.float32))
+    dim = unit_queries.shape[1]
+    sidecar = load_sidecar(conn)
+    if sidecar is not None and sidecar.dim != dim:
+        sidecar = None
+    cache = matrix_cache(conn)
+    id_parts = []
+    score_parts = []
+    with phase(conn, "score"):
+        for scope in {memory_scope(conversation_id, ""), SHARED_SCOPE}:
+            if sidecar is not None:
+                members = cache.block(conn, scope, 0, "members")
+                visible = sidecar.visible(members.ids)
+                created = members.created[visible]
+                ids, scores = sidecar.scores(members.ids[visible], unit_queries)
+            else:
+                block = cache.block(conn, scope, dim)
+                created = block.created[: block.size]
+                ids, scores = block.scores(unit_queries)
+            if recency is not None:
+                scores = scores + recency.boosts(created)[:, None]
+            id_parts.append(ids)
+            score_parts.append(scores)
+        ids = np.concatenate(id_parts)
+        scores = np.concatenate(score_parts)
+    backend = "mmap" if sidecar is not None else "numpy"
+    with phase(conn, "sort"):
+        return backend, [top_k(ids, scores[:, j], int(limit)) for j, limit in enumerate(limits)]
+
+
+def search_memories_numpy(
+    conn: MemoryConnection,
+    conversation_id: str,
+    q_emb: List[float],
+    limit: int,
+    min_score: float,
+    recency: Optional[RecencyDecay] = None,
+) -> Dict[str, Any]:
+    """One matrix-vector product per visible scope plus argpartition top-k."""
+    backend, scored = numpy_rank(conn, conversation_id, [q_emb], [limit], recency)
+    return {"ok": True, "backend": backend, "rows": fetch_ranked_rows(conn, scored[0], min_score)}
+
+
+def unit_float32(emb: List[float]) -> bytes:
+    """Normalize without numpy so every writer can maintain the sidecar."""
+    norm = math.sqrt(sum(v * v for v in emb)) or 1.0
+    return pack_embedding([v / norm for v in emb])
+
+
+# Score a contiguous slice when at least 1/ratio of its rows belong to the ids.
+SIDECAR_DENSE_RATIO = 2
+
+
+class EmbeddingSidecar:
+    """Fixed-stride float32 file of unit vectors where row i holds memory id i.
+
+    Rows without a vector (gaps, other dimensions) are zero and score 0. The
+    file is mapped read-only with np.memmap, so every process reading it shares
+    the same page-cache copy and nothing is parsed per query.
+    """
+
+    def __init__(self, path: str, dim: int) -> None:
+        self.path = path
+        self.dim = dim
+        self.stride = dim * 4
+        self.stat_key: Tuple[int, int] = (-1, -1)
+        self.view: Optional["np.ndarray"] = None
+
+    def rows(self) -> "np.ndarray":
+        st = os.stat(self.path)
+        key = (st.st_ino, st.st_size)
+        if key != self.stat_key:
+            count = st.st_size // self.stride
+            if count:
+                self.view = np.memmap(self.path, dtype="<f4", mode="r", shape=(count, self.dim))
+            else:
+                self.view = np.empty((0, self.dim), dtype=np.float32)
+            self.stat_key = key
+        return self.view
+
+    def visible(self, ids: "np.ndarray") -> "np.ndarray":
+        """Mask of ids that have a slot in the file (newer rows wait for the next sync)."""
+        return ids < len(self.rows())
+
+    def gather(self, ids: "np.ndarray") -> Tuple["np.ndarray", "np.ndarray"]:
+        rows = self.rows()
+        ids = ids[self.visible(ids)]
+        return ids, rows[ids]
+
+    def scores(self, ids: "np.ndarray", unit_queries: "np.ndarray") -> Tuple["np.ndarray", "np.ndarray"]:
+        ids = ids[self.visible(ids)]
+        if not len(ids):
+            return ids, np.empty((0, len(unit_queries)), dtype=np.float32)
+        low, high = int(ids.min()), int(ids.max()) + 1
+        if len(ids) * SIDECAR_DENSE_RATIO >= high - low:
+            # Dense id range: score the mapped slice in place instead of copying rows out.
+            return ids, (self.rows()[low:high] @ unit_queries.T)[ids - low]
+        ids, vectors = self.gather(ids)
+        return ids, vectors @ unit_queries.T
+
+    def write(self, items: Iterable[Tuple[int, bytes]]) -> None:
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            for memory_id, unit_blob in items:
+                os.pwrite(fd, unit_blob, memory_id * self.stride)
+        finally:
+            os.close(fd)
+
+
+def sidecar_path(conn: MemoryConnection) -> str:
+    path = database_path(conn)
+    return f"{path}.emb.f32" if path else ""
+
+
+def load_sidecar(conn: MemoryConnection) -> Optional[EmbeddingSidecar]:
+    """The sidecar is enabled by sidecar-build; deleting the file disables it again."""
+    dim = int(get_meta(conn, "emb_sidecar_dim", "0") or 0)
+    path = sidecar_path(conn)
+    if not dim or not path or not os.path.exists(path):
+        conn.sidecar = None
+        return None
+    if conn.sidecar is None or conn.sidecar.dim != dim or conn.sidecar.path != path:
+        conn.sidecar = EmbeddingSidecar(path, dim)
+    return conn.sidecar
+
+
+def sync_sidecar(conn: MemoryConnection) -> int:
+    """Write vectors for memories newer than meta.emb_sidecar_synced_id.
+
+    Runs inside the inserting transaction; slot writes are idempotent, so a
+    crash or rollback between the file write and commit is repaired on the
+    next sync.
+    """
+    dim = int(get_meta(conn, "emb_sidecar_dim", "0") or 0)
+    path = sidecar_path(conn)
+    if not dim or not path or not os.path.exists(path):
+        return 0
+    synced_id = int(get_meta(conn, "emb_sidecar_synced_id", "0") or 0)
+    max_row = conn.execute("SELECT MAX(id) AS m FROM memories").fetchone()
+    max_id = int(max_row["m"] or 0)
+    if max_id <= synced_id:
+        return 0
+    rows = conn.execute(
+        "SELECT id, embedding FROM memories WHERE id > ? AND id <= ? AND embedding IS NOT NULL AND length(embedding) = ?",
+        (synced_id, max_id, dim * 4),
+    ).fetchall()
+    EmbeddingSidecar(path, dim).write((row["id"], unit_float32(unpack_embedding(row["embedding"]))) for row in rows)
+    set_meta(conn, "emb_sidecar_synced_id", str(max_id))
+    return len(rows)
+
+
+def build_sidecar(conn: MemoryConnection) -> Dict[str, Any]:
+    """sidecar-build: (re)write the whole file from the table and enable it."""
+    if np is None:
+        return {"ok": False, "error": "sidecar-build requires numpy"}
+    path = sidecar_path(conn)
+    if not path:
+        return {"ok": False, "error": "sidecar-build requires a file-backed database"}
+    dim = int(get_meta(conn, "embedding_dim", "0") or 0)
+    if not dim:
+        return {"ok": False, "error": "no packed embeddings to store"}
+
+    max_row = conn.execute("SELECT MAX(id) AS m FROM memories").fetchone()
+    max_id = int(max_row["m"] or 0)
+    tmp_path = f"{path}.tmp"
+    written = 0
+    with open(tmp_path, "wb") as fh:
+        fh.truncate((max_id + 1) * dim * 4)
+    if max_id:
+        out = np.memmap(tmp_path, dtype="<f4", mode="r+", shape=(max_id + 1, dim))
+        for ids, _, vectors in iter_packed_embeddings(conn, "id <= ?", (max_id,), dim):
+            out[ids] = normalize_rows(vectors)
+            written += len(ids)
+        out.flush()
+        del out
+    os.replace(tmp_path, path)
+    set_meta(conn, "emb_sidecar_dim", str(dim))
+    set_meta(conn, "emb_sidecar_synced_id", str(max_id))
+    conn.sidecar = None
+    sync_sidecar(conn)
+    conn.commit()
+    return {"ok": True, "path": path, "dim": dim, "rows": max_id + 1, "written": written}
+
+
+def sidecar_stats(conn: MemoryConnection) -> Dict[str, Any]:
+    dim = int(get_meta(conn, "emb_sidecar_dim", "0") or 0)
+    path = sidecar_path(conn)
+    if not dim or not path or not os.path.exists(path):
+        return {"enabled": False}
+    size = os.path.getsize(path)
+    return {
+        "enabled": True,
+        "dim": dim,
+        "rows": size // (dim * 4),
+        "bytes": size,
+        "synced_id": int(get_meta(conn, "emb_sidecar_synced_id", "0") or 0),
+    }
+
+
+def scope_members(conn: MemoryConnection, scope: str) -> Tuple["np.ndarray", "np.ndarray"]:
+    """Ids and created_at of one scope's memories, read from the covering indexes."""
+    if scope == SHARED_SCOPE:
+        where, args = SHARED_SCOPE_SQL, ()
+    else:
+        where, args = CONVERSATION_SCOPE_SQL, (scope,)
+    rows = conn.execute(f"SELECT id, created_at FROM memories WHERE {where}", args).fetchall()
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    created = np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows))
+    return ids, created
+
+
+QUANT_MODES = ("int8", "binary")
+
+if np is not None:
+    POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+
+def quant_code_size(dim: int, mode: str) -> int:
+    return 4 + dim if mode == "int8" else (dim + 7) // 8
+
+
+def quantize_vector(emb: List[float], mode: str) -> Optional[bytes]:
+    """Pure-Python encoder used on insert, so writers don't need numpy.
+
+    int8: float32 scale then one signed byte per component of the unit vector.
+    binary: one sign bit per component, packed MSB-first like np.packbits.
+    """
+    if mode not in QUANT_MODES or not emb:
+        return None
+    if mode == "binary":
+        out = bytearray((len(emb) + 7) // 8)
+        for i, v in enumerate(emb):
+            if v > 0:
+                out[i // 8] |= 0x80 >> (i % 8)
+        return bytes(out)
+    norm = math.sqrt(sum(v * v for v in emb)) or 1.0
+    unit = [v / norm for v in emb]
+    scale = max(abs(v) for v in unit) / 127.0 or 1.0
+    codes = array.array("b", [max(-127, min(127, round(v / scale))) for v in unit])
+    return pack_embedding([scale]) + codes.tobytes()
+
+
+def quantize_rows(vectors: "np.ndarray", mode: str) -> List[bytes]:
+    if mode == "binary":
+        return [row.tobytes() for row in np.packbits(vectors > 0, axis=1)]
+    unit = normalize_rows(vectors)
+    scales = np.abs(unit).max(axis=1) / 127.0
+    scales[scales == 0.0] = 1.0
+    codes = np.clip(np.rint(unit / scales[:, None]), -127, 127).astype(np.int8)
+    return [scale.astype("<f4").tobytes() + row.tobytes() for scale, row in zip(scales, codes)]
+
+
+class QuantBlock:
+    """Quantized codes for one scope; scores approximate cosine for candidate generation."""
+
+    def __init__(self, dim: int, mode: str) -> None:
+        self.dim = dim
+        self.mode = mode
+        self.width = dim if mode == "int8" else (dim + 7) // 8
+        self.dtype = np.int8 if mode == "int8" else np.uint8
+        self.size = 0
+        self.ids = np.empty(0, dtype=np.int64)
+        self.codes = np.empty((0, self.width), dtype=self.dtype)
+        self.scales = np.empty(0, dtype=np.float32)
+
+    def append(self, ids: "np.ndarray", codes: List[bytes]) -> None:
+        needed = self.size + len(ids)
+        if needed > len(self.ids):
+            capacity = max(needed, 2 * len(self.ids), 64)
+            grown_ids = np.empty(capacity, dtype=np.int64)
+            grown_codes = np.empty((capacity, self.width), dtype=self.dtype)
+            grown_scales = np.empty(capacity, dtype=np.float32)
+            grown_ids[: self.size] = self.ids[: self.size]
+            grown_codes[: self.size] = self.codes[: self.size]
+            grown_scales[: self.size] = self.scales[: self.size]
+            self.ids, self.codes, self.scales = grown_ids, grown_codes, grown_scales
+        raw = np.frombuffer(b"".join(codes), dtype=np.uint8).reshape(len(codes), -1)
+        if self.mode == "int8":
+            self.scales[self.size : needed] = raw[:, :4].copy().view("<f4").ravel()
+            self.codes[self.size : needed] = raw[:, 4:].view(np.int8)
+        else:
+            self.codes[self.size : needed] = raw
+        self.ids[self.size : needed] = ids
+        self.size = needed
+
+    def scores(self, unit_queries: "np.ndarray", chunk: int = 8192) -> Tuple["np.ndarray", "np.ndarray"]:
+        ids = self.ids[: self.size]
+        out = np.empty((self.size, len(unit_queries)), dtype=np.float32)
+        if self.mode == "binary":
+            query_bits = np.packbits(unit_queries > 0, axis=1)
+            for j, bits in enumerate(query_bits):
+                hamming = POPCOUNT[np.bitwise_xor(self.codes[: self.size], bits)].sum(axis=1)
+                out[:, j] = np.cos(np.pi * hamming / self.dim)
+            return ids, out
+        # Convert int8 codes in bounded chunks instead of materializing a float copy.
+        for start in range(0, self.size, chunk):
+            stop = min(start + chunk, self.size)
+            block = self.codes[start:stop].astype(np.float32) @ unit_queries.T
+            out[start:stop] = block * self.scales[start:stop, None]
+        return ids, out
+
+
+def load_quant_block(conn: MemoryConnection, scope: str, dim: int, mode: str) -> QuantBlock:
+    if scope == SHARED_SCOPE:
+        where, args = SHARED_SCOPE_SQL, ()
+    else:
+        where, args = CONVERSATION_SCOPE_SQL, (scope,)
+    rows = conn.execute(
+        f"SELECT id, embedding_q FROM memories WHERE {where} AND length(embedding_q) = ? ORDER BY id",
+        (*args, quant_code_size(dim, mode)),
+    ).fetchall()
+    block = QuantBlock(dim, mode)
+    if rows:
+        block.append(np.asarray([row["id"] for row in rows], dtype=np.int64), [row["embedding_q"] for row in rows])
+    return block
+
+
+def full_vectors(conn: MemoryConnection, ids: List[int], dim: int) -> Tuple["np.ndarray", "np.ndarray"]:
+    """Unit float32 vectors for a candidate list, from the mmap sidecar when possible."""
+    id_array = np.asarray(ids, dtype=np.int64)
+    sidecar = load_sidecar(conn)
+    if sidecar is not None and sidecar.dim == dim:
+        return sidecar.gather(id_array)
+    placeholders = ",".join("?" for _ in ids)
+    rows = conn.execute(
+        f"SELECT id, embedding FROM memories WHERE id IN ({placeholders}) AND length(embedding) = ?",
+        (*ids, dim * 4),
+    ).fetchall()
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty((0, dim), dtype=np.float32)
+    vectors = np.frombuffer(b"".join(row["embedding"] for row in rows), dtype="<f4").reshape(len(rows), dim)
+    return np.asarray([row["id"] for row in rows], dtype=np.int64), normalize_rows(vectors)
+
+
+def rerank_size(limit: int, rerank: int) -> int:
+    return rerank if rerank > 0 else max(10 * int(limit), 100)
+
+
+def quant_rank(
+    conn: MemoryConnection, mode: str, conversation_id: str, queries: List[List[float]], limits: List[int], rerank: int
+) -> List[List[Tuple[int, float]]]:
+    """First pass over quantized codes, then exact cosine on the top candidates."""
+    cache = matrix_cache(conn)
+    unit_queries = normalize_rows(np.asarray(queries, dtype=np.float32))
+    dim = unit_queries.shape[1]
+    id_parts = []
+    score_parts = []
+    with phase(conn, "score"):
+        for scope in {memory_scope(conversation_id, ""), SHARED_SCOPE}:
+            ids, scores = cache.block(conn, scope, dim, mode).scores(unit_queries)
+            id_parts.append(ids)
+            score_parts.append(scores)
+        ids = np.concatenate(id_parts)
+        scores = np.concatenate(score_parts)
+    out = []
+    for j, limit in enumerate(limits):
+        with phase(conn, "sort"):
+            candidates = [memory_id for memory_id, _ in top_k(ids, scores[:, j], rerank_size(limit, rerank))]
+        if not candidates:
+            out.append([])
+            continue
+        with phase(conn, "query"):
+            cand_ids, vectors = full_vectors(conn, candidates, dim)
+        with phase(conn, "score"):
+            exact = vectors @ unit_queries[j]
+        with phase(conn, "sort"):
+            out.append(top_k(cand_ids, exact, int(limit)))
+    return out
+
+
+def search_memories_quant(
+    conn: MemoryConnection,
+    mode: str,
+    conversation_id: str,
+    q_emb: List[float],
+    limit: int,
+    min_score: float,
+    rerank: int,
+    recency: Optional[RecencyDecay] = None,
+) -> Dict[str, Any]:
+    scored = quant_rank(conn, mode, conversation_id, [q_emb], [recency_fetch_size(limit, recency)], rerank)[0]
+    return {"ok": True, "backend": mode, "rows": fetch_ranked_rows(conn, scored, min_score, recency, limit)}
+
+
+def evaluate_quant_recall(conn: MemoryConnection, mode: str, dim: int, rerank: int, k: int = 10) -> float:
+    """recall@k of quantized search + re-rank against exact search on a corpus sample."""
+    rows = conn.execute(
+        "SELECT embedding FROM memories WHERE length(embedding) = ? ORDER BY random() LIMIT 20000", (dim * 4,)
+    ).fetchall()
+    if len(rows) <= k:
+        return 1.0
+    vectors = normalize_rows(np.frombuffer(b"".join(row["embedding"] for row in rows), dtype="<f4").reshape(-1, dim))
+    block = QuantBlock(dim, mode)
+    block.append(np.arange(len(vectors), dtype=np.int64), quantize_rows(vectors, mode))
+    rng = np.random.default_rng(len(vectors))
+    # Perturbed corpus vectors stand in for queries that are near, but not equal to, stored memories.
+    picks = rng.choice(len(vectors), size=min(100, len(vectors)), replace=False)
+    queries = normalize_rows(vectors[picks] + 0.5 * rng.standard_normal((len(picks), dim)).astype(np.float32) / math.sqrt(dim))
+    exact = vectors @ queries.T
+    _, approx = block.scores(queries)
+    hits = 0
+    for j in range(len(queries)):
+        truth = {i for i, _ in top_k(np.arange(len(vectors)), exact[:, j], k)}
+        candidates = np.asarray([i for i, _ in top_k(np.arange(len(vectors)), approx[:, j], rerank_size(k, rerank))])
+        found = {int(candidates[i]) for i, _ in top_k(np.arange(len(candidates)), exact[candidates, j], k)}
+        hits += len(truth & found)
+    return hits / float(k * len(queries))
+
+
+def quantize_memories(conn: MemoryConnection, mode: str, rerank: int) -> Dict[str, Any]:
+    """quantize: (re)encode every memory for the given mode ("none" drops the codes)."""
+    if mode not in (*QUANT_MODES, "none"):
+        return {"ok": False, "error": f"unknown quantization mode: {mode}"}
+    if mode != "none" and np is None:
+        return {"ok": False, "error": "quantize requires numpy"}
+    dim = int(get_meta(conn, "embedding_dim", "0") or 0)
+    try:
+        conn.execute("UPDATE memories SET embedding_q = NULL")
+        encoded = 0
+        if mode != "none" and dim:
+            for ids, _, vectors in iter_packed_embeddings(conn, "1 = 1", (), dim):
+                conn.executemany(
+                    "UPDATE memories SET embedding_q = ? WHERE id = ?",
+                    list(zip(quantize_rows(vectors, mode), (int(i) for i in ids))),
+                )
+                encoded += len(ids)
+        set_meta(conn, "quant_mode", "" if mode == "none" else mode)
+        recall = evaluate_quant_recall(conn, mode, dim, rerank) if encoded else None
+        set_meta(conn, "quant_recall_at_10", "" if recall is None else f"{recall:.4f}")
+        set_meta(conn, "quant_eval_rerank", str(rerank_size(10, rerank)))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    conn.matrix_cache = None
+    return {"ok": True, "mode": mode, "encoded": encoded, "recall_at_10": recall}
+
+
+def quant_stats(conn: MemoryConnection) -> Dict[str, Any]:
+    mode = get_meta(conn, "quant_mode")
+    if not mode:
+        return {"mode": "none"}
+    recall_text = get_meta(conn, "quant_recall_at_10")
+    recall = float(recall_text) if recall_text else None
+    return {
+        "mode": mode,
+        "recall_at_10": recall,
+        "recall_loss": None if recall is None else round(1.0 - recall, 4),
+        "eval_rerank": int(get_meta(conn, "quant_eval_rerank", "0") or 0),
+    }
+
+
+class IvfIndex:
+    """Inverted-file ANN index: spherical k-means centroids plus per-list membership.
+
+    Centroids live in a sidecar "<db>.ivf.npz" next to the database; each memory's
+    list assignment lives in the memory_ivf table so it commits atomically with
+    the memory itself. meta.ivf_version ties the two together.
+    """
+
+    def __init__(self, version: str, centroids: "np.ndarray") -> None:
+        self.version = version
+        self.centroids = centroids
+
+    @property
+    def dim(self) -> int:
+        return int(self.centroids.shape[1])
+
+    def assign(self, vectors: "np.ndarray") -> "np.ndarray":
+        return np.argmax(normalize_rows(vectors) @ self.centroids.T, axis=1)
+
+    def probe(self, unit_query: "np.ndarray", nprobe: int) -> List[int]:
+        sims = self.centroids @ unit_query
+        nprobe = min(max(int(nprobe), 1), len(sims))
+        picked = np.argpartition(sims, -nprobe)[-nprobe:]
+        return [int(i) for i in picked[np.argsort(sims[picked])[::-1]]]
+
+
+def database_path(conn: MemoryConnection) -> str:
+    for row in conn.execute("PRAGMA database_list").fetchall():
+        if row["name"] == "main":
+            return str(row["file"] or "")
+    return ""
+
+
+def ivf_sidecar_path(conn: MemoryConnection) -> str:
+    path = database_path(conn)
+    return f"{path}.ivf.npz" if path else ""
+
+
+def load_ivf(conn: MemoryConnection) -> Optional[IvfIndex]:
+    """Return the connection's IVF index, reloading it if another process rebuilt it."""
+    if np is None:
+        return None
+    version = get_meta(conn, "ivf_version")
+    if not version:
+        conn.ivf_index = None
+        return None
+    if conn.ivf_index is not None and conn.ivf_index.version == version:
+        return conn.ivf_index
+    path = ivf_sidecar_path(conn)
+    try:
+        with np.load(path) as data:
+            if str(data["version"]) != version:
+                return None
+            conn.ivf_index = IvfIndex(version, np.ascontiguousarray(data["centroids"], dtype=np.float32))
+    except (OSError, KeyError, ValueError):
+        conn.ivf_index = None
+    return conn.ivf_index
+
+
+def iter_packed_embeddings(
+    conn: MemoryConnection, where: str, args: Tuple[Any, ...], dim: int, batch_size: int = 5000
+) -> Iterable[Tuple["np.ndarray", List[str], "np.ndarray"]]:
+    """Yield (ids, scopes, vectors) chunks for rows whose packed embedding has dimension dim."""
+    cur = conn.execute(
+        f"""
+        SELECT id, conversation_id, source, embedding FROM memories
+        WHERE embedding IS NOT NULL AND length(embedding) = ? AND {where}
+        ORDER BY id
+        """,
+        (dim * 4, *args),
+    )
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            return
+        ids = np.asarray([row["id"] for row in rows], dtype=np.int64)
+        scopes = [memory_scope(row["conversation_id"], row["source"]) for row in rows]
+        vectors = np.frombuffer(b"".join(row["embedding"] for row in rows), dtype="<f4").reshape(len(rows), dim)
+        yield ids, scopes, vectors
+
+
+def sync_ivf(conn: MemoryConnection) -> int:
+    """Assign memories newer than meta.ivf_synced_id to their nearest IVF list."""
+    index = load_ivf(conn)
+    if index is None:
+        return 0
+    synced_id = int(get_meta(conn, "ivf_synced_id", "0") or 0)
+    max_row = conn.execute("SELECT MAX(id) AS m FROM memories").fetchone()
+    max_id = int(max_row["m"] or 0)
+    if max_id <= synced_id:
+        return 0
+    assigned = 0
+    for ids, scopes, vectors in iter_packed_embeddings(conn, "id > ? AND id <= ?", (synced_id, max_id), index.dim):
+        lists = index.assign(vectors)
+        conn.executemany(
+            "INSERT OR REPLACE INTO memory_ivf(memory_id, scope, list_id) VALUES(?, ?, ?)",
+            [(int(i), scope, int(list_id)) for i, scope, list_id in zip(ids, scopes, lists)],
+        )
+        assigned += len(ids)
+    set_meta(conn, "ivf_synced_id", str(max_id))
+    return assigned
+
+
+def train_centroids(sample: "np.ndarray", nlist: int, iterations: int, seed: int) -> "np.ndarray":
+    """Spherical k-means: cosine assignment, re-normalized means, empty lists re-seeded."""
+    rng = np.random.default_rng(seed)
+    sample = normalize_rows(sample)
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+    for _ in range(max(int(iterations), 1)):
+        labels = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        counts = np.bincount(labels, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    return np.ascontiguousarray(centroids, dtype=np.float32)
+
+
+def build_ivf(conn: MemoryConnection, nlist: int, sample_size: int, iterations: int) -> Dict[str, Any]:
+    """ann-build: train centroids on a sample, write the sidecar, then assign every memory."""
+    if np is None:
+        return {"ok": False, "error": "ann-build requires numpy"}
+    path = ivf_sidecar_path(conn)
+    if not path:
+        return {"ok": False, "error": "ann-build requires a file-backed database"}
+    dim = int(get_meta(conn, "embedding_dim", "0") or 0)
+    if not dim:
+        return {"ok": False, "error": "no packed embeddings to index"}
+
+    rows = conn.execute(
+        "SELECT embedding FROM memories WHERE embedding IS NOT NULL AND length(embedding) = ? "
+        "ORDER BY random() LIMIT ?",
+        (dim * 4, int(sample_size)),
+    ).fetchall()
+    if not rows:
+        return {"ok": False, "error": "no packed embeddings to index"}
+    sample = np.frombuffer(b"".join(row["embedding"] for row in rows), dtype="<f4").reshape(len(rows), dim)
+    total = int(conn.execute("SELECT COUNT(*) FROM memories").fetchone()[0])
+    if nlist <= 0:
+        nlist = int(math.sqrt(total)) or 1
+    nlist = min(nlist, len(sample))
+    centroids = train_centroids(sample, nlist, iterations, seed=total)
+
+    version = secrets.token_hex(8)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as fh:
+        np.savez(fh, version=np.asarray(version), centroids=centroids)
+    os.replace(tmp_path, path)
+
+    try:
+        conn.execute("DELETE FROM memory_ivf")
+        set_meta(conn, "ivf_version", version)
+        set_meta(conn, "ivf_nlist", str(nlist))
+        set_meta(conn, "ivf_synced_id", "0")
+        conn.ivf_index = IvfIndex(version, centroids)
+        assigned = sync_ivf(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return {"ok": True, "path": path, "nlist": nlist, "dim": dim, "trained_on": len(sample), "assigned": assigned}
+
+
+def ann_stats(conn: MemoryConnection) -> Dict[str, Any]:
+    version = get_meta(conn, "ivf_version")
+    if not version:
+        return {"built": False}
+    sizes = [
+        int(row["c"])
+        for row in conn.execute("SELECT COUNT(*) AS c FROM memory_ivf GROUP BY list_id").fetchall()
+    ]
+    return {
+        "built": True,
+        "loaded": load_ivf(conn) is not None,
+        "nlist": int(get_meta(conn, "ivf_nlist", "0") or 0),
+        "assigned": sum(sizes),
+        "largest_list": max(sizes) if sizes else 0,
+    }
+
+
+def search_memories_ivf(
+    conn: MemoryConnection,
+    index: IvfIndex,
+    conversation_id: str,
+    q_emb: List[float],
+    limit: int,
+    min_score: float,
+    nprobe: int,
+    max_candidates: int,
+    recency: Optional[RecencyDecay] = None,
+) -> Dict[str, Any]:
+    """Probe the nprobe closest lists (closest first) until max_candidates, then score exactly.
+
+    nprobe and max_candidates trade recall for latency; cost stays bounded by
+    max_candidates regardless of how many memories are stored.
+    """
+    sync_ivf(conn)
+    if conn.in_transaction:
+        conn.commit()
+    unit_query = normalize_rows(np.asarray(q_emb, dtype=np.float32))
+    scopes = sorted({memory_scope(conversation_id, ""), SHARED_SCOPE})
+    sidecar = load_sidecar(conn)
+    if sidecar is not None and sidecar.dim != index.dim:
+        sidecar = None
+    ids: List[int] = []
+    chunks: List[bytes] = []
+    with phase(conn, "score"):
+        probes = index.probe(unit_query, nprobe)
+    for list_id in probes:
+        with phase(conn, "query"):
+            if sidecar is not None:
+                rows = conn.execute(
+                    "SELECT memory_id AS id FROM memory_ivf WHERE list_id = ? AND scope IN (?, ?)",
+                    (list_id, scopes[0], scopes[-1]),
+                ).fetchall()
+            else:
+                rows = conn.execute(
+                    """
+                    SELECT m.id, m.embedding
+                    FROM memory_ivf AS f
+                    JOIN memories AS m ON m.id = f.memory_id
+                    WHERE f.list_id = ? AND f.scope IN (?, ?)
+                    """,
+                    (list_id, scopes[0], scopes[-1]),
+                ).fetchall()
+        for row in rows:
+            ids.append(row["id"])
+            if sidecar is None:
+                chunks.append(row["embedding"])
+        if len(ids) >= max_candidates:
+            break
+    if not ids:
+        return {"ok": True, "backend": "ivf", "rows": []}
+    with phase(conn, "score"):
+        if sidecar is not None:
+            id_array, scores = sidecar.scores(np.asarray(ids, dtype=np.int64), unit_query)
+        else:
+            with phase(conn, "decode"):
+                vectors = np.frombuffer(b"".join(chunks), dtype="<f4").reshape(len(ids), index.dim)
+            id_array, scores = np.asarray(ids, dtype=np.int64), normalize_rows(vectors) @ unit_query
+    with phase(conn, "sort"):
+        scored = top_k(id_array, scores, recency_fetch_size(limit, recency))
+    return {"ok": True, "backend": "ivf", "rows": fetch_ranked_rows(conn, scored, min_score, recency, limit)}
+
+
+# Lexical index over memories.content. It is an external-content FTS5 table, so
+# the text is stored once (in memories) and triggers keep the index in step.
+FTS_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_memories_fts_insert AFTER INSERT ON memories
+    BEGIN
+      INSERT INTO memories_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_memories_fts_delete AFTER DELETE ON memories
+    BEGIN
+      INSERT INTO memories_fts(memories_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_memories_fts_update AFTER UPDATE OF content ON memories
+    BEGIN
+      INSERT INTO memories_fts(memories_fts, rowid, content) VALUES ('delete', old.id, old.content);
+      INSERT INTO memories_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+)
+FTS_MAX_TERMS = 32
+# Function words that would otherwise let any memory match any question.
+FTS_STOPWORDS = frozenset(
+    """
+    a about after all also am an and any are as at be been before being but by can could did do does
+    for from had has have he her here him his how i if in into is it its just me more my no not now
+    of on or our out she so some than that the their them then there these they this those to too
+    up us was we were what when where which who why will with would you your
+    """.split()
+)
+RRF_K = 60
+
+
+def fts_available(conn: MemoryConnection) -> bool:
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'memories_fts'").fetchone()
+    return row is not None
+
+
+def ensure_fts_index(conn: MemoryConnection) -> str:
+    """Create memories_fts and its triggers, backfilling existing rows once.
+
+    Returns an error string when this SQLite build lacks FTS5; hybrid-search
+    then falls back to the vector side alone.
+    """
+    if fts_available(conn):
+        return ""
+    try:
+        conn.execute(
+            """
+            CREATE VIRTUAL TABLE memories_fts USING fts5(
+              content, content='memories', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+            )
+            """
+        )
+    except sqlite3.OperationalError as err:
+        return str(err)
+    for trigger in FTS_TRIGGERS:
+        conn.execute(trigger)
+    conn.execute("INSERT INTO memories_fts(memories_fts) VALUES ('rebuild')")
+    return ""
+
+
+def fts_query(text: str) -> str:
+    """Turn free text into an FTS5 OR-query of quoted terms (no operator injection).
+
+    Stopwords are dropped, so a question made only of them matches nothing.
+    """
+    terms: List[str] = []
+    for term in re.findall(r"\w+", text.lower()):
+        if term not in terms and term not in FTS_STOPWORDS:
+            terms.append(term)
+    return " OR ".join(f'"{term}"' for term in terms[:FTS_MAX_TERMS])
+
+
+def lexical_rank(conn: MemoryConnection, conversation_id: str, query_text: str, limit: int) -> List[Dict[str, Any]]:
+    match = fts_query(query_text)
+    if not match or not fts_available(conn):
+        return []
+    with phase(conn, "query"):
+        rows = conn.execute(
+            """
+            SELECT m.id, m.source, m.content, m.created_at, bm25(memories_fts) AS bm25
+            FROM memories_fts
+            JOIN memories AS m ON m.id = memories_fts.rowid
+            WHERE memories_fts MATCH ?
+              AND (m.conversation_id = ? OR m.conversation_id = 'global' OR m.source = 'self_reflection')
+            ORDER BY bm25
+            LIMIT ?
+            """,
+            (match, conversation_id, int(limit)),
+        ).fetchall()
+    return [
+        {
+            "id": row["id"],
+            "source": row["source"],
+            "content": row["content"],
+            "created_at": row["created_at"],
+            # bm25() is "lower is better"; flip it so larger means more relevant.
+            "score": -float(row["bm25"]),
+        }
+        for row in rows
+    ]
+
+
+def gate_lexical(
+    conn: MemoryConnection,
+    lexical: List[Dict[str, Any]],
+    vector: List[Dict[str, Any]],
+    query_embedding_json: str,
+    min_score: float,
+) -> List[Dict[str, Any]]:
+    """Drop lexical-only hits whose embedding is at or below min_score against the query."""
+    seen = {row["id"] for row in vector}
+    unseen = [row["id"] for row in lexical if row["id"] not in seen]
+    if not unseen:
+        return lexical
+    q_emb = parse_embedding(query_embedding_json)
+    with phase(conn, "score"):
+        placeholders = ",".join("?" * len(unseen))
+        rows = conn.execute(
+            f"SELECT id, embedding_json, embedding FROM memories WHERE id IN ({placeholders})", unseen
+        ).fetchall()
+        rejected = set()
+        for row in rows:
+            emb = row_embedding(row)
+            # Embeddings from another model (different dim) cannot be compared; keep those.
+            if len(emb) == len(q_emb) and cosine_similarity(q_emb, emb) <= float(min_score):
+                rejected.add(row["id"])
+    return [row for row in lexical if row["id"] not in rejected]
+
+
+def hybrid_search(
+    conn: MemoryConnection,
+    conversation_id: str,
+    query_text: str,
+    query_embedding_json: str,
+    limit: int,
+    min_score: float,
+    window: int,
+    candidates: int,
+    rrf_k: int,
+    recency: Optional[RecencyDecay] = None,
+    shared_window: int = 0,
+) -> Dict[str, Any]:
+    """hybrid-search: fuse BM25 and cosine rankings with reciprocal rank fusion.
+
+    Either side may be empty, so a text-only query needs no embedding call and
+    an embedding-only query behaves like search (with fused scores). The
+    recency bonus applies to the vector ranking. When there is a query
+    embedding, lexical hits the vector side did not return must still reach
+    min_score by cosine; only memories without an embedding skip that check.
+    """
+    candidates = max(int(candidates), int(limit))
+    rankings: List[Tuple[str, List[Dict[str, Any]]]] = []
+    backends: List[str] = []
+    if query_text.strip():
+        rankings.append(("lexical", lexical_rank(conn, conversation_id, query_text, candidates)))
+        backends.append("fts")
+    if parse_embedding(query_embedding_json):
+        vector = search_memories(
+            conn,
+            conversation_id,
+            query_embedding_json,
+            candidates,
+            min_score,
+            window,
+            recency=recency,
+            shared_window=shared_window,
+        )
+        rankings.append(("vector", vector["rows"]))
+        backends.append(str(vector.get("backend", "scan")))
+
+    if len(rankings) == 2:
+        rankings[0] = ("lexical", gate_lexical(conn, rankings[0][1], rankings[1][1], query_embedding_json, min_score))
+
+    fused: Dict[int, Dict[str, Any]] = {}
+    for name, rows in rankings:
+        for rank, row in enumerate(rows, start=1):
+            entry = fused.get(row["id"])
+            if entry is None:
+                entry = fused[row["id"]] = {
+                    "id": row["id"],
+                    "source": row["source"],
+                    "content": row["content"],
+                    "created_at": row["created_at"],
+                    "score": 0.0,
+                }
+            entry["score"] += 1.0 / (rrf_k + rank)
+            entry[f"{name}_rank"] = rank
+            entry[f"{name}_score"] = row["score"]
+
+    with phase(conn, "sort"):
+        ranked = sorted(fused.values(), key=lambda r: r["score"], reverse=True)
+    return {"ok": True, "backend": "+".join(backends), "rows": ranked[: int(limit)]}
+
+
+CONSOLIDATE_CHUNK = 64
+
+
+def consolidate_scope(
+    conn: MemoryConnection, scope: str, dim: int, synced_id: int, max_id: int, threshold: float
+) -> Dict[int, int]:
+    """Map each superseded memory id in one scope to the id that supersedes it.
+
+    Only memories newer than synced_id start comparisons, but they are compared
+    against the whole scope. When a new memory is at least `threshold` similar
+    to older live ones, the group keeps its newest member by created_at (later
+    summaries supersede earlier ones; id breaks ties) and the others are merged
+    into it.
+    """
+    block = load_scope_matrix(conn, scope, dim)
+    ids = block.ids[: block.size]
+    created = block.created[: block.size]
+    vectors = block.vectors[: block.size]
+    keep = ids <= max_id
+    ids, created, vectors = ids[keep], created[keep], vectors[keep]
+    alive = np.ones(len(ids), dtype=bool)
+    merged: Dict[int, int] = {}
+    new_positions = np.nonzero(ids > synced_id)[0]
+    for start in range(0, len(new_positions), CONSOLIDATE_CHUNK):
+        chunk = new_positions[start : start + CONSOLIDATE_CHUNK]
+        sims = vectors[chunk] @ vectors.T
+        for row, pos in zip(sims, chunk):
+            if not alive[pos]:
+                continue
+            dupes = np.nonzero((row[:pos] >= threshold) & alive[:pos])[0]
+            if len(dupes):
+                group = np.append(dupes, pos)
+                survivor = max(group, key=lambda i: (int(created[i]), int(ids[i])))
+                for dupe in group:
+                    if dupe != survivor:
+                        alive[dupe] = False
+                        merged[int(ids[dupe])] = int(ids[survivor])
+    # Re-point chains (a -> b, then b -> c) at the final survivor.
+    for memory_id, target in merged.items():
+        while target in merged:
+            target = merged[target]
+        merged[memory_id] = target
+    return merged
+
+
+def consolidate(conn: MemoryConnection, threshold: float, archive: bool, max_rows: int = 0) -> Dict[str, Any]:
+    """consolidate: merge near-duplicate memories added since meta.consolidate_synced_id.
+
+    max_rows (0 = no cap) bounds how many new memories one run compares, so a
+    large backlog is worked off over several runs instead of one long one.
+    """
+    if np is None:
+        return {"ok": False, "error": "consolidate requires numpy"}
+    dim = int(get_meta(conn, "embedding_dim", "0") or 0)
+    synced_id = int(get_meta(conn, "consolidate_synced_id", "0") or 0)
+    max_row = conn.execute("SELECT MAX(id) AS m FROM memories").fetchone()
+    max_id = int(max_row["m"] or 0)
+    if int(max_rows) > 0:
+        capped = conn.execute(
+            "SELECT id FROM memories WHERE id > ? ORDER BY id LIMIT 1 OFFSET ?", (synced_id, int(max_rows) - 1)
+        ).fetchone()
+        if capped is not None:
+            max_id = int(capped["id"])
+    if not dim or max_id <= synced_id:
+        return {"ok": True, "scanned": 0, "scopes": 0, "merged": 0, "synced_id": synced_id}
+
+    scanned = int(
+        conn.execute("SELECT COUNT(*) FROM memories WHERE id > ? AND id <= ?", (synced_id, max_id)).fetchone()[0]
+    )
+    scopes = [
+        row[0]
+        for row in conn.execute(
+            """
+            SELECT DISTINCT CASE WHEN conversation_id = 'global' OR source = 'self_reflection' THEN ? ELSE conversation_id END
+            FROM memories WHERE id > ? AND id <= ?
+            """,
+            (SHARED_SCOPE, synced_id, max_id),
+        ).fetchall()
+    ]
+    merged: Dict[int, int] = {}
+    for scope in scopes:
+        merged.update(consolidate_scope(conn, scope, dim, synced_id, max_id, float(threshold)))
+
+    if archive and merged:
+        with attached_archive(conn, archive_path(conn, "")):
+            archive_memories(conn, merged)
+            set_meta(conn, "consolidate_synced_id", str(max_id))
+            delete_memories(conn, list(merged))
+    else:
+        set_meta(conn, "consolidate_synced_id", str(max_id))
+        delete_memories(conn, list(merged))
+    return {
+        "ok": True,
+        "scanned": scanned,
+        "scopes": len(scopes),
+        "merged": len(merged),
+        "archived": bool(archive and merged),
+        "synced_id": max_id,
+    }
+
+
+def archive_path(conn: MemoryConnection, override: str) -> str:
+    if override:
+        # Shards archive next to the override instead of sharing one id space.
+        return shard_path(override, conn.shard_index) if conn.shard_index else override
+    path = database_path(conn)
+    return f"{path}.archive.sqlite" if path else ""
+
+
+@contextlib.contextmanager
+def attached_archive(conn: MemoryConnection, path: str) -> Iterator[str]:
+    """ATTACH the archive file as "archive" (creating its tables) for the duration of the block.
+
+    path must already be resolved with archive_path().
+    """
+    if not path:
+        raise ValueError("archiving requires a file-backed database")
+    conn.execute("ATTACH DATABASE ? AS archive", (path,))
+    try:
+        for sql in ARCHIVE_SCHEMA:
+            conn.execute(sql)
+        yield path
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute("DETACH DATABASE archive")
+
+
+def archive_memories(conn: MemoryConnection, merged_into: Dict[int, Optional[int]]) -> None:
+    """Copy memories into archive.memories_archive (ATTACHed) without committing."""
+    archived_at = now_ms()
+    conn.executemany(
+        """
+        INSERT OR REPLACE INTO archive.memories_archive(
+          id, conversation_id, source, content, embedding_json, embedding, created_at, merged_into, archived_at
+        )
+        SELECT id, conversation_id, source, content, embedding_json, embedding, created_at, ?, ?
+        FROM memories WHERE id = ?
+        """,
+        [(target, archived_at, memory_id) for memory_id, target in merged_into.items()],
+    )
+
+
+def expired_memory_ids(
+    conn: MemoryConnection, now: int, max_age_days: float, max_per_conversation: int, max_per_source: int
+) -> List[int]:
+    expired = set()
+    if max_age_days > 0:
+        cutoff = now - int(max_age_days * DAY_MS)
+        expired.update(row[0] for row in conn.execute("SELECT id FROM memories WHERE created_at < ?", (cutoff,)))
+    for column, keep in (("conversation_id", max_per_conversation), ("source", max_per_source)):
+        if keep > 0:
+            rows = conn.execute(
+                f"""
+                SELECT id FROM (
+                  SELECT id, ROW_NUMBER() OVER (PARTITION BY {column} ORDER BY created_at DESC, id DESC) AS rn
+                  FROM memories
+                ) WHERE rn > ?
+                """,
+                (int(keep),),
+            )
+            expired.update(row[0] for row in rows)
+    return sorted(expired)
+
+
+def expired_message_ids(conn: MemoryConnection, now: int, max_age_days: float, max_per_conversation: int) -> List[int]:
+    expired = set()
+    if max_age_days > 0:
+        cutoff = now - int(max_age_days * DAY_MS)
+        expired.update(row[0] for row in conn.execute("SELECT id FROM messages WHERE created_at < ?", (cutoff,)))
+    if max_per_conversation > 0:
+        rows = conn.execute(
+            """
+            SELECT id FROM (
+              SELECT id, ROW_NUMBER() OVER (PARTITION BY conversation_id ORDER BY created_at DESC, id DESC) AS rn
+              FROM messages
+            ) WHERE rn > ?
+            """,
+            (int(max_per_conversation),),
+        )
+        expired.update(row[0] for row in rows)
+    return sorted(expired)
+
+
+def retain(
+    conn: MemoryConnection,
+    max_age_days: float,
+    max_per_conversation: int,
+    max_per_source: int,
+    message_max_age_days: float,
+    max_messages_per_conversation: int,
+    archive_db: str,
+    batch_size: int,
+) -> Dict[str, Any]:
+    """retain: move rows outside the retention policy to the archive file.
+
+    Every limit defaults to 0 (off). Rows move in batches of batch_size, one
+    transaction each, so the writer lock is never held for long; freed pages
+    are then released with incremental_vacuum.
+    """
+    batch_size = max(1, int(batch_size))
+    now = now_ms()
+    memory_ids = expired_memory_ids(conn, now, max_age_days, max_per_conversation, max_per_source)
+    message_ids = expired_message_ids(conn, now, message_max_age_days, max_messages_per_conversation)
+    if not memory_ids and not message_ids:
+        return {"ok": True, "archived_memories": 0, "archived_messages": 0, "freed_pages": 0}
+
+    with attached_archive(conn, archive_path(conn, archive_db)) as path:
+        for start in range(0, len(memory_ids), batch_size):
+            batch = memory_ids[start : start + batch_size]
+            archive_memories(conn, {memory_id: None for memory_id in batch})
+            delete_memories(conn, batch)
+        for start in range(0, len(message_ids), batch_size):
+            batch = [(memory_id,) for memory_id in message_ids[start : start + batch_size]]
+            conn.executemany(
+                """
+                INSERT OR REPLACE INTO archive.messages_archive(id, conversation_id, role, content, created_at, archived_at)
+                SELECT id, conversation_id, role, content, created_at, ? FROM messages WHERE id = ?
+                """,
+                [(now, memory_id) for (memory_id,) in batch],
+            )
+            conn.executemany("DELETE FROM messages WHERE id = ?", batch)
+            conn.commit()
+
+    freed = int(conn.execute("PRAGMA freelist_count").fetchone()[0])
+    auto_vacuum = int(conn.execute("PRAGMA auto_vacuum").fetchone()[0])
+    if auto_vacuum == 2:
+        # execute() steps a row-less statement only once (one page); the
+        # script API runs it to completion.
+        conn.executescript("PRAGMA incremental_vacuum;")
+        freed -= int(conn.execute("PRAGMA freelist_count").fetchone()[0])
+    else:
+        freed = 0
+    return {
+        "ok": True,
+        "archive": path,
+        "archived_memories": len(memory_ids),
+        "archived_messages": len(message_ids),
+        "freed_pages": freed,
+        "incremental_vacuum": auto_vacuum == 2,
+    }
+
+
+def search_archive(
+    conn: MemoryConnection, conversation_id: str, q_emb: List[float], limit: int, min_score: float, archive_db: str = ""
+) -> List[Dict[str, Any]]:
+    """Brute-force cosine over archived memories visible from a conversation."""
+    path = archive_path(conn, archive_db)
+    if not path or not os.path.exists(path):
+        return []
+    with attached_archive(conn, path):
+        rows = conn.execute(
+            """
+            SELECT id, source, content, embedding_json, embedding, created_at
+            FROM archive.memories_archive
+            WHERE (conversation_id = ? OR conversation_id = 'global' OR source = 'self_reflection')
+            """,
+            (conversation_id,),
+        ).fetchall()
+    ranked = rank_candidates(conn, [(row, row_embedding(row)) for row in rows], q_emb, limit, min_score)
+    for row in ranked:
+        row["archived"] = True
+    return ranked
+
+
+def with_archive(
+    conn: MemoryConnection, result: Dict[str, Any], conversation_id: str, query_embedding_json: str, limit: int, min_score: float
+) -> Dict[str, Any]:
+    """Merge archived matches into a live search result (search --include-archive 1)."""
+    q_emb = parse_embedding(query_embedding_json)
+    if not result.get("ok") or not q_emb:
+        return result
+    rows = result["rows"] + search_archive(conn, conversation_id, q_emb, limit, min_score)
+    rows.sort(key=lambda r: r["score"], reverse=True)
+    return {**result, "rows": rows[: int(limit)]}
+
+
+def shard_path(base: str, index: int) -> str:
+    return f"{base}.shard-{index}.sqlite"
+
+
+class ShardSet:
+    """Conversation shards of a database split with init --shards N.
+
+    The main file is shard 0: it keeps global and self_reflection memories
+    (the shared scope) together with conversations, messages, skills and the
+    embedding cache. Conversation memories live in shard 1..N picked by a
+    stable hash of the conversation id, so each user's working set and write
+    lock are confined to one small file. Shard connections open lazily and
+    memory ids are only unique within a file.
+    """
+
+    def __init__(self, main: MemoryConnection, count: int) -> None:
+        self.main = main
+        self.count = count
+        self.base = database_path(main)
+        self.vec_ext_path = get_meta(main, "sqlite_vec_extension_path")
+        self.conns: Dict[int, MemoryConnection] = {}
+
+    def index(self, conversation_id: str) -> int:
+        if self.count <= 0:
+            return 0
+        digest = hashlib.blake2b(conversation_id.encode("utf-8"), digest_size=8).digest()
+        return 1 + int.from_bytes(digest, "big") % self.count
+
+    def get(self, index: int) -> MemoryConnection:
+        if index == 0:
+            return self.main
+        conn = self.conns.get(index)
+        if conn is None:
+            path = shard_path(self.base, index)
+            exists = os.path.exists(path)
+            conn = connect(path, check_same_thread=False)
+            conn.shard_index = index
+            if exists:
+                load_vec_extension(conn, self.vec_ext_path)
+            else:
+                init_db(conn, self.vec_ext_path)
+            self.conns[index] = conn
+        conn.profile = self.main.profile
+        return conn
+
+    def for_memory(self, conversation_id: str, source: str) -> MemoryConnection:
+        if memory_scope(conversation_id, source) == SHARED_SCOPE:
+            return self.main
+        return self.get(self.index(conversation_id))
+
+    def items(self) -> List[Tuple[int, MemoryConnection]]:
+        return [(index, self.get(index)) for index in range(1, self.count + 1)]
+
+    def on_disk(self) -> List[int]:
+        """Shard files present next to the main file, including ones beyond count."""
+        folder = os.path.dirname(self.base) or "."
+        pattern = re.compile(re.escape(os.path.basename(self.base)) + r"\.shard-(\d+)\.sqlite$")
+        found = (pattern.match(name) for name in os.listdir(folder))
+        return sorted(int(match.group(1)) for match in found if match)
+
+    def close(self) -> None:
+        for conn in self.conns.values():
+            conn.close()
+        self.conns = {}
+
+
+def load_configured_shards(conn: MemoryConnection) -> None:
+    """Non-init commands pick up the shard count that init recorded in meta."""
+    try:
+        count = int(get_meta(conn, "shard_count", "0") or 0)
+    except sqlite3.OperationalError:
+        return
+    if conn.shards is not None:
+        conn.shards.close()
+    conn.shards = ShardSet(conn, count) if count > 0 else None
+
+
+def refresh_configured_shards(conn: MemoryConnection) -> None:
+    """Reload conn.shards when another connection or process resharded the database."""
+    try:
+        count = int(get_meta(conn, "shard_count", "0") or 0)
+    except sqlite3.OperationalError:
+        return
+    current = conn.shards.count if conn.shards is not None else 0
+    if count != current:
+        load_configured_shards(conn)
+
+
+def memory_connections(conn: MemoryConnection) -> List[MemoryConnection]:
+    if conn.shards is None:
+        return [conn]
+    return [conn] + [shard for _, shard in conn.shards.items()]
+
+
+def init_command(conn: MemoryConnection, vec_ext_path: str, shards: int) -> Dict[str, Any]:
+    """init: create the schema; --shards N (once) splits conversation memories over N files."""
+    result = init_db(conn, vec_ext_path)
+    current = int(get_meta(conn, "shard_count", "0") or 0)
+    if shards and current and shards != current:
+        return {"ok": False, "error": f"database is split into {current} shards; use reshard --shards {shards}"}
+    if shards and not current:
+        # Conversation rows already in the main file stay searchable there;
+        # reshard moves them.
+        set_meta(conn, "shard_count", str(shards))
+        conn.commit()
+    load_configured_shards(conn)
+    if conn.shards is not None:
+        result["shards"] = {str(index): init_db(shard, vec_ext_path) for index, shard in conn.shards.items()}
+    return result
+
+
+def store_memories(conn: MemoryConnection, rows: List[MemoryRow]) -> List[int]:
+    """insert_memories, routed to each row's shard when the database is sharded."""
+    if conn.shards is None:
+        return insert_memories(conn, rows)
+    groups: Dict[int, List[int]] = {}
+    for i, (conversation_id, source, _, _, _) in enumerate(rows):
+        target = conn.shards.for_memory(conversation_id, source).shard_index
+        groups.setdefault(target, []).append(i)
+    ids = [0] * len(rows)
+    for index, positions in groups.items():
+        inserted = insert_memories(conn.shards.get(index), [rows[i] for i in positions])
+        for i, memory_id in zip(positions, inserted):
+            ids[i] = memory_id
+    return ids
+
+
+def merge_shard_results(results: List[Tuple[int, Dict[str, Any]]], limit: int) -> Dict[str, Any]:
+    """Combine per-file search results by score; rows are tagged with their shard."""
+    for _, result in results:
+        if not result.get("ok"):
+            return result
+    rows = []
+    backends = []
+    for index, result in results:
+        for row in result.get("rows", []):
+            row["shard"] = index
+            rows.append(row)
+        if result.get("backend") and result["backend"] not in backends:
+            backends.append(result["backend"])
+    rows.sort(key=lambda r: r["score"], reverse=True)
+    merged = {**results[0][1], "rows": rows[: int(limit)]}
+    if backends:
+        merged["backend"] = ",".join(backends)
+    return merged
+
+
+def sharded_search(
+    conn: MemoryConnection, conversation_id: str, limit: int, run: Callable[[MemoryConnection], Dict[str, Any]]
+) -> Dict[str, Any]:
+    """Run a search on the main file (shared scope) and on the conversation's shard."""
+    if conn.shards is None:
+        return run(conn)
+    index = conn.shards.index(conversation_id)
+    return merge_shard_results([(0, run(conn)), (index, run(conn.shards.get(index)))], limit)
+
+
+def sharded_search_batch(conn: MemoryConnection, items: List[Any]) -> List[Dict[str, Any]]:
+    """search-batch against the main file, then each shard for the items routed to it."""
+    results = search_memories_batch(conn, items)
+    if conn.shards is None:
+        return results
+    groups: Dict[int, List[int]] = {}
+    for i, item in enumerate(items):
+        if isinstance(item, dict):
+            groups.setdefault(conn.shards.index(str(param(item, "conversation_id", ""))), []).append(i)
+    for index, positions in groups.items():
+        shard_results = search_memories_batch(conn.shards.get(index), [items[i] for i in positions])
+        for i, shard_result in zip(positions, shard_results):
+            limit = int(param(items[i], "limit", 6))
+            results[i] = merge_shard_results([(0, results[i]), (index, shard_result)], limit)
+    return results
+
+
+def each_shard(
+    handler: Callable[[MemoryConnection, Dict[str, Any]], Dict[str, Any]]
+) -> Callable[[MemoryConnection, Dict[str, Any]], Dict[str, Any]]:
+    """Run a maintenance command on the main file and, when sharded, on every shard."""
+
+    def run(conn: MemoryConnection, p: Dict[str, Any]) -> Dict[str, Any]:
+        result = handler(conn, p)
+        if conn.shards is None:
+            return result
+        shards = {str(index): handler(shard, p) for index, shard in conn.shards.items()}
+        ok = bool(result.get("ok")) and all(r.get("ok") for r in shards.values())
+        return {**result, "ok": ok, "shards": shards}
+
+    return run
+
+
+def already_moved(conn: MemoryConnection, row: sqlite3.Row) -> bool:
+    """True when an interrupted reshard already copied this row into conn."""
+    return (
+        conn.execute(
+            """
+            SELECT 1 FROM memories
+            WHERE conversation_id = ? AND created_at = ? AND source = ? AND content = ?
+            LIMIT 1
+            """,
+            (row["conversation_id"], row["created_at"], row["source"], row["content"]),
+        ).fetchone()
+        is not None
+    )
+
+
+def reshard(conn: MemoryConnection, shards: int, batch_size: int) -> Dict[str, Any]:
+    """reshard: change the shard count (0 = unshard) and move memories to their new files.
+
+    Each batch is committed in its destination before it is deleted from its
+    source, so an interrupted run leaves duplicates rather than gaps. Rows
+    already present in the target (same conversation, source, content and
+    created_at) are not copied again, so running reshard again finishes the
+    move without duplicating them.
+    """
+    shards = max(0, int(shards))
+    batch_size = max(1, int(batch_size))
+    set_meta(conn, "shard_count", str(shards))
+    conn.commit()
+    load_configured_shards(conn)
+    target_set = conn.shards if conn.shards is not None else ShardSet(conn, 0)
+    sources = [0] + target_set.on_disk()
+    moved = 0
+    try:
+        for index in sources:
+            source = target_set.get(index)
+            last_id = 0
+            while True:
+                rows = source.execute(
+                    """
+                    SELECT id, conversation_id, source, content, embedding_json, embedding, created_at
+                    FROM memories WHERE id > ? ORDER BY id LIMIT ?
+                    """,
+                    (last_id, batch_size),
+                ).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1]["id"]
+                groups: Dict[int, List[sqlite3.Row]] = {}
+                for row in rows:
+                    target = target_set.for_memory(row["conversation_id"], row["source"]).shard_index
+                    if target != index:
+                        groups.setdefault(target, []).append(row)
+                for target, group in groups.items():
+                    destination = target_set.get(target)
+                    insert_memories(
+                        destination,
+                        [
+                            (row["conversation_id"], row["source"], row["content"], row_embedding(row), row["created_at"])
+                            for row in group
+                            if not already_moved(destination, row)
+                        ],
+                    )
+                    delete_memories(source, [row["id"] for row in group])
+                    moved += len(group)
+    finally:
+        if target_set is not conn.shards:
+            target_set.close()
+    stale = [index for index in sources if index > shards]
+    return {"ok": True, "shards": shards, "moved": moved, "empty_shard_files": stale}
+
+
+EMBEDDING_FORMATS = ("json", "f32", "none")
+IMPORT_ERROR_SAMPLE = 10
+
+
+def memory_filter_sql(conversation_id: str, source: str, since: int, until: int) -> Tuple[str, List[Any]]:
+    """WHERE clause for export; every filter is optional (empty / 0 = off)."""
+    clauses = []
+    args: List[Any] = []
+    if conversation_id:
+        clauses.append("conversation_id = ?")
+        args.append(conversation_id)
+    if source:
+        clauses.append("source = ?")
+        args.append(source)
+    if since:
+        clauses.append("created_at >= ?")
+        args.append(int(since))
+    if until:
+        clauses.append("created_at < ?")
+        args.append(int(until))
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", args
+
+
+def encode_export_embedding(row: sqlite3.Row, embedding_format: str) -> Any:
+    if embedding_format == "none":
+        return None
+    if embedding_format == "f32":
+        blob = row["embedding"] if row["embedding"] is not None else pack_embedding(parse_embedding(row["embedding_json"]))
+        return base64.b64encode(blob).decode("ascii")
+    return row_embedding(row)
+
+
+def decode_import_embedding(value: Any, embedding_format: str) -> List[float]:
+    """Decode either export encoding (a JSON array or base64 little-endian float32).
+
+    An empty format accepts both; json or f32 rejects the other one.
+    """
+    if value is None or embedding_format == "none":
+        return []
+    if isinstance(value, str) and embedding_format != "json":
+        blob = base64.b64decode(value, validate=True)
+        if len(blob) % 4:
+            raise ValueError("f32 embedding length is not a multiple of 4")
+        return unpack_embedding(blob)
+    if isinstance(value, list) and embedding_format != "f32":
+        return [float(v) for v in value]
+    raise ValueError(f"embedding is not in {embedding_format or 'json or f32'} format")
+
+
+@contextlib.contextmanager
+def ndjson_stream(path: str, mode: str) -> Iterator[Any]:
+    """Open an NDJSON file; "-" is stdin/stdout on the CLI."""
+    if not path:
+        raise ValueError("file is required")
+    if path == "-":
+        yield sys.stdin if mode == "r" else sys.stdout
+        return
+    with open(path, mode, encoding="utf-8") as handle:
+        yield handle
+
+
+def export_memories(
+    conn: MemoryConnection,
+    path: str,
+    conversation_id: str,
+    source: str,
+    since: int,
+    until: int,
+    embedding_format: str,
+    batch_size: int,
+) -> Dict[str, Any]:
+    """export: stream memories as NDJSON, one object per line, oldest first.
+
+    Rows are pulled with fetchmany so memory use does not grow with the corpus.
+    f32 embeddings are base64 of the on-disk float32 bytes (lossless, about a
+    third of the JSON size); none drops them, e.g. before re-embedding.
+    """
+    if embedding_format not in EMBEDDING_FORMATS:
+        raise ValueError(f"embedding format must be one of {', '.join(EMBEDDING_FORMATS)}")
+    where, args = memory_filter_sql(conversation_id, source, since, until)
+    exported = 0
+    with ndjson_stream(path, "w") as out:
+        for shard in memory_connections(conn):
+            cur = shard.execute(
+                "SELECT id, conversation_id, source, content, embedding_json, embedding, created_at FROM memories"
+                + where
+                + " ORDER BY id",
+                args,
+            )
+            while True:
+                rows = cur.fetchmany(max(1, int(batch_size)))
+                if not rows:
+                    break
+                for row in rows:
+                    record = {
+                        "id": row["id"],
+                        "conversation_id": row["conversation_id"],
+                        "source": row["source"],
+                        "content": row["content"],
+                        "created_at": row["created_at"],
+                    }
+                    if embedding_format != "none":
+                        record["embedding"] = encode_export_embedding(row, embedding_format)
+                    out.write(json.dumps(record) + "\n")
+                exported += len(rows)
+        out.flush()
+    return {"ok": True, "exported": exported, "embedding_format": embedding_format}
+
+
+def import_memories(
+    conn: MemoryConnection,
+    path: str,
+    conversation_id: str,
+    source: str,
+    since: int,
+    until: int,
+    embedding_format: str,
+    batch_size: int,
+) -> Dict[str, Any]:
+    """import: insert NDJSON records written by export, batch_size rows per transaction.
+
+    Embeddings arrive as JSON arrays or f32 base64 and are stored as packed
+    float32 either way; --embedding-format none drops them so the rows can be
+    re-embedded. The same filters as export select which records are kept.
+    Memories get new ids; malformed lines are counted and skipped.
+    """
+    if embedding_format and embedding_format not in EMBEDDING_FORMATS:
+        raise ValueError(f"embedding format must be one of {', '.join(EMBEDDING_FORMATS)}")
+    batch_size = max(1, int(batch_size))
+    imported = 0
+    filtered = 0
+    skipped = 0
+    errors: List[str] = []
+    batch: List[MemoryRow] = []
+    with ndjson_stream(path, "r") as reader:
+        for number, line in enumerate(reader, start=1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                if not isinstance(item, dict):
+                    raise ValueError("record must be a JSON object")
+                row: MemoryRow = (
+                    str(item.get("conversation_id") or ""),
+                    str(item.get("source") or ""),
+                    str(item.get("content") or ""),
+                    decode_import_embedding(item.get("embedding"), embedding_format),
+                    int(item.get("created_at") or 0),
+                )
+                if not row[0] or not row[2]:
+                    raise ValueError("conversation_id and content are required")
+            except (ValueError, TypeError) as err:
+                skipped += 1
+                if len(errors) < IMPORT_ERROR_SAMPLE:
+                    errors.append(f"line {number}: {err}")
+                continue
+            if (
+                (conversation_id and row[0] != conversation_id)
+                or (source and row[1] != source)
+                or (since and row[4] < int(since))
+                or (until and row[4] >= int(until))
+            ):
+                filtered += 1
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                imported += len(store_memories(conn, batch))
+                batch = []
+    imported += len(store_memories(conn, batch))
+    return {"ok": True, "imported": imported, "filtered": filtered, "skipped": skipped, "errors": errors}
+
+
+def json_text(value: Any) -> str:
+    """Serve-mode clients may send embeddings as JSON arrays instead of pre-encoded text."""
+    if isinstance(value, str):
+        return value
+    return json.dumps(value if value is not None else [])
+
+
+def param(params: Dict[str, Any], key: str, default: Any) -> Any:
+    value = params.get(key)
+    return default if value is None or value == "" else value
+
+
+def search_command(conn: MemoryConnection, p: Dict[str, Any]) -> Dict[str, Any]:
+    conversation_id = str(param(p, "conversation_id", ""))
+    query = json_text(param(p, "query_embedding_json", "[]"))
+    limit = int(param(p, "limit", 6))
+    min_score = float(param(p, "min_score", 0.1))
+    include_archive = str(param(p, "include_archive", "0")).lower() in ("1", "true", "yes")
+    recency = recency_decay(p)
+
+    def run(shard: MemoryConnection) -> Dict[str, Any]:
+        result = search_memories(
+            shard,
+            conversation_id,
+            query,
+            limit,
+            min_score,
+            int(param(p, "window", 600)),
+            int(param(p, "nprobe", 8)),
+            int(param(p, "max_candidates", 4096)),
+            str(param(p, "quant", "")),
+            int(param(p, "rerank", 0)),
+            recency,
+            int(param(p, "shared_window", 0)),
+        )
+        if include_archive:
+            result = with_archive(shard, result, conversation_id, query, limit, min_score)
+        return result
+
+    return sharded_search(conn, conversation_id, limit, run)
+
+
+def hybrid_search_command(conn: MemoryConnection, p: Dict[str, Any]) -> Dict[str, Any]:
+    conversation_id = str(param(p, "conversation_id", ""))
+    limit = int(param(p, "limit", 6))
+    return sharded_search(
+        conn,
+        conversation_id,
+        limit,
+        lambda shard: hybrid_search(
+            shard,
+            conversation_id,
+            str(param(p, "query_text", "")),
+            json_text(param(p, "query_embedding_json", "[]")),
+            limit,
+            float(param(p, "min_score", 0.1)),
+            int(param(p, "window", 600)),
+            int(param(p, "candidates", 50)),
+            int(param(p, "rrf_k", RRF_K)),
+            recency_decay(p),
+            int(param(p, "shared_window", 0)),
+        ),
+    )
+
+
+# Each handler takes an open connection plus a params dict whose keys mirror the
+# CLI flags (dashes replaced by underscores). CLI values arrive as strings and
+# serve-mode values as JSON scalars, so handlers coerce explicitly.
+COMMANDS: Dict[str, Callable[[MemoryConnection, Dict[str, Any]], Dict[str, Any]]] = {
+    "init": lambda conn, p: init_command(conn, str(param(p, "vec_ext", "")), int(param(p, "shards", 0))),
+    "reshard": lambda conn, p: reshard(conn, int(param(p, "shards", 0)), int(param(p, "batch_size", 500))),
+    "add": lambda conn, p: add_memory(
+        conn,
+        str(param(p, "conversation_id", "")),
+        str(param(p, "source", "")),
+        str(param(p, "content", "")),
+        json_text(param(p, "embedding_json", "[]")),
+        int(param(p, "created_at", 0)),
+    ),
+    "search": lambda conn, p: search_command(conn, p),
+    "hybrid-search": lambda conn, p: hybrid_search_command(conn, p),
+    "consolidate": each_shard(
+        lambda conn, p: consolidate(
+            conn,
+            float(param(p, "threshold", 0.95)),
+            str(param(p, "archive", "1")).lower() not in ("0", "false", "no"),
+            int(param(p, "max_rows", 0)),
+        )
+    ),
+    "retain": each_shard(
+        lambda conn, p: retain(
+            conn,
+            float(param(p, "max_age_days", 0)),
+            int(param(p, "max_per_conversation", 0)),
+            int(param(p, "max_per_source", 0)),
+            float(param(p, "message_max_age_days", 0)),
+            int(param(p, "max_messages_per_conversation", 0)),
+            str(param(p, "archive_db", "")),
+            int(param(p, "batch_size", 500)),
+        )
+    ),
+    "ensure-conversation": lambda conn, p: ensure_conversation(
+        conn,
+        str(param(p, "conversation_id", "")),
+        str(param(p, "platform", "")),
+        str(param(p, "user_id", "")),
+        int(param(p, "created_at", 0)),
+    ),
+    "append-message": lambda conn, p: append_message(
+        conn,
+        str(param(p, "conversation_id", "")),
+        str(param(p, "role", "")),
+        str(param(p, "content", "")),
+        int(param(p, "created_at", 0)),
+    ),
+    "append-messages": lambda conn, p: {"ok": True, "results": append_messages_batch(conn, list(p.get("items") or []))},
+    "recent-messages": lambda conn, p: recent_messages(
+        conn,
+        str(param(p, "conversation_id", "")),
+        int(param(p, "limit", 40)),
+        int(param(p, "since", 0)),
+    ),
+    "message-count": lambda conn, p: message_count(conn, str(param(p, "conversation_id", ""))),
+    "compaction-range": lambda conn, p: compaction_range(
+        conn,
+        str(param(p, "conversation_id", "")),
+        int(param(p, "max_messages", 200)),
+        int(param(p, "keep_recent", 40)),
+    ),
+    "delete-up-to": lambda conn, p: delete_messages_up_to(
+        conn, str(param(p, "conversation_id", "")), int(param(p, "max_id", 0))
+    ),
+    "cache-get": lambda conn, p: cache_get(conn, str(param(p, "model", "")), str(param(p, "content", ""))),
+    "cache-put": lambda conn, p: cache_put(
+        conn,
+        str(param(p, "model", "")),
+        str(param(p, "content", "")),
+        json_text(param(p, "embedding_json", "[]")),
+        int(param(p, "max_entries", EMBEDDING_CACHE_MAX_ENTRIES)),
+    ),
+    "export": lambda conn, p: export_memories(
+        conn,
+        str(param(p, "file", "")),
+        str(param(p, "conversation_id", "")),
+        str(param(p, "source", "")),
+        int(param(p, "since", 0)),
+        int(param(p, "until", 0)),
+        str(param(p, "embedding_format", "f32")),
+        int(param(p, "batch_size", 500)),
+    ),
+    "import": lambda conn, p: import_memories(
+        conn,
+        str(param(p, "file", "")),
+        str(param(p, "conversation_id", "")),
+        str(param(p, "source", "")),
+        int(param(p, "since", 0)),
+        int(param(p, "until", 0)),
+        str(param(p, "embedding_format", "")),
+        int(param(p, "batch_size", 500)),
+    ),
+    "quantize": each_shard(
+        lambda conn, p: quantize_memories(conn, str(param(p, "quant", "int8")), int(param(p, "rerank", 0)))
+    ),
+    "sidecar-build": each_shard(lambda conn, p: build_sidecar(conn)),
+    "ann-build": each_shard(
+        lambda conn, p: build_ivf(
+            conn,
+            int(param(p, "nlist", 0)),
+            int(param(p, "sample", 50000)),
+            int(param(p, "iterations", 10)),
+        )
+    ),
+    "add-batch": lambda conn, p: {"ok": True, "results": add_memories(conn, list(p.get("items") or []))},
+    "search-batch": lambda conn, p: {"ok": True, "results": sharded_search_batch(conn, list(p.get("items") or []))},
+    "stats": each_shard(lambda conn, p: stats(conn)),
+    "checkpoint": each_shard(
+        lambda conn, p: checkpoint(
+            conn,
+            str(param(p, "mode", "PASSIVE")),
+            str(param(p, "optimize", "1")).lower() not in ("0", "false", "no"),
+        )
+    ),
+    "migrate-embeddings": each_shard(
+        lambda conn, p: migrate_embeddings(
+            conn,
+            int(param(p, "batch_size", 500)),
+            str(param(p, "vacuum", "1")).lower() not in ("0", "false", "no"),
+        )
+    ),
+    "upsert-skill": lambda conn, p: upsert_skill(
+        conn,
+        str(param(p, "name", "")),
+        str(param(p, "provider", "tool")),
+        int(param(p, "enabled", 1)),
+        int(param(p, "updated_at", 0)),
+    ),
+}
+
+
+# Batch commands read NDJSON items from stdin on the CLI (or an "items" array in
+# serve mode) and print one JSON result per input line.
+BATCH_COMMANDS = ("add-batch", "search-batch", "append-messages")
+
+
+def run_command(
+    conn: MemoryConnection, command: str, params: Dict[str, Any], profile: Optional[CommandProfile] = None
+) -> Tuple[Dict[str, Any], CommandProfile]:
+    """Run one command under a phase profile; --profile-dump also writes a cProfile file."""
+    handler = COMMANDS.get(command)
+    profile = profile or CommandProfile()
+    if handler is None:
+        return {"ok": False, "error": f"unknown command: {command}"}, profile
+    dump_path = str(param(params, "profile_dump", ""))
+    conn.profile = profile
+    try:
+        if dump_path:
+            profiler = cProfile.Profile()
+            try:
+                result = profiler.runcall(handler, conn, params)
+            finally:
+                profiler.dump_stats(dump_path)
+        else:
+            result = handler(conn, params)
+    finally:
+        conn.profile = None
+    return result, profile
+
+
+SERVE_POOL_SIZE = 4
+
+
+class MemoryStore:
+    """In-process API over a memory database, safe to share between threads.
+
+    Commands run on a small pool of connections (opened lazily, up to
+    pool_size), so concurrent readers do not queue behind each other; SQLite
+    WAL lets them proceed while one writer commits. Every command has a sync
+    method and an *_async twin that runs it on the store's worker threads.
+
+        with MemoryStore("db/memory.sqlite") as store:
+            store.add("telegram:42", "turn_ingest", "prefers tea", embedding)
+            rows = store.search("telegram:42", embedding)["rows"]
+
+    execute() accepts any CLI command with its flags as keyword arguments
+    (dashes become underscores), e.g. store.execute("retain", max_age_days=90).
+    """
+
+    def __init__(
+        self, db_path: str, vec_ext_path: str = "", pool_size: int = SERVE_POOL_SIZE, initialize: bool = True
+    ) -> None:
+        self.db_path = db_path
+        self.pool_size = max(1, int(pool_size))
+        self.pool: "queue.LifoQueue[MemoryConnection]" = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+        self.timings = TimingStats()
+        self.executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        if initialize:
+            result = self.execute("init", vec_ext=vec_ext_path)
+            if not result.get("ok"):
+                raise RuntimeError(result.get("error") or "memory init failed")
+
+    def open_connection(self, profile: Optional[CommandProfile]) -> MemoryConnection:
+        with profile.phase("connect") if profile is not None else NO_PHASE:
+            conn = connect(self.db_path, check_same_thread=False)
+            try:
+                load_configured_vec_extension(conn)
+                load_configured_shards(conn)
+            except Exception:
+                conn.close()
+                raise
+        conn.timings = self.timings
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self, profile: Optional[CommandProfile] = None) -> Iterator[MemoryConnection]:
+        """Borrow a pooled connection; an open transaction is rolled back if the caller raises.
+
+        A reused connection re-reads shard_count from meta, so a reshard run by
+        another pooled connection or another process takes effect on the next
+        command instead of leaving this one routing to the old shard files.
+        """
+        try:
+            conn = self.pool.get_nowait()
+            reused = True
+        except queue.Empty:
+            reused = False
+            with self.lock:
+                grow = self.opened < self.pool_size
+                if grow:
+                    self.opened += 1
+            if grow:
+                try:
+                    conn = self.open_connection(profile)
+                except Exception:
+                    with self.lock:
+                        self.opened -= 1
+                    raise
+            else:
+                conn = self.pool.get()
+                reused = True
+        if reused:
+            try:
+                refresh_configured_shards(conn)
+            except Exception:
+                self.pool.put(conn)
+                raise
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.put(conn)
+
+    def run(
+        self, command: str, params: Dict[str, Any], profile: Optional[CommandProfile] = None
+    ) -> Tuple[Dict[str, Any], CommandProfile]:
+        """Run a command without recording it; the CLI and server time serialization first."""
+        profile = profile or CommandProfile()
+        with self.connection(profile) as conn:
+            result, profile = run_command(conn, command, params, profile)
+        return result, profile
+
+    def record(self, command: str, profile: CommandProfile) -> Dict[str, Any]:
+        report = profile.report()
+        if command in COMMANDS:
+            self.timings.record(command, report)
+        return report
+
+    def execute(self, command: str, **params: Any) -> Dict[str, Any]:
+        result, profile = self.run(command, params)
+        self.record(command, profile)
+        return result
+
+    async def execute_async(self, command: str, **params: Any) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.worker_pool(), functools.partial(self.execute, command, **params))
+
+    def worker_pool(self) -> concurrent.futures.ThreadPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.pool_size, thread_name_prefix="tiger-memory"
+                )
+            return self.executor
+
+    def add(
+        self, conversation_id: str, source: str, content: str, embedding: List[float], created_at: int = 0
+    ) -> Dict[str, Any]:
+        return self.execute(
+            "add",
+            conversation_id=conversation_id,
+            source=source,
+            content=content,
+            embedding_json=embedding,
+            created_at=created_at or now_ms(),
+        )
+
+    async def add_async(
+        self, conversation_id: str, source: str, content: str, embedding: List[float], created_at: int = 0
+    ) -> Dict[str, Any]:
+        return await self.execute_async(
+            "add",
+            conversation_id=conversation_id,
+            source=source,
+            content=content,
+            embedding_json=embedding,
+            created_at=created_at or now_ms(),
+        )
+
+    def search(self, conversation_id: str, embedding: List[float], limit: int = 6, **options: Any) -> Dict[str, Any]:
+        return self.execute(
+            "search", conversation_id=conversation_id, query_embedding_json=embedding, limit=limit, **options
+        )
+
+    async def search_async(
+        self, conversation_id: str, embedding: List[float], limit: int = 6, **options: Any
+    ) -> Dict[str, Any]:
+        return await self.execute_async(
+            "search", conversation_id=conversation_id, query_embedding_json=embedding, limit=limit, **options
+        )
+
+    def hybrid_search(
+        self,
+        conversation_id: str,
+        query_text: str = "",
+        embedding: Optional[List[float]] = None,
+        limit: int = 6,
+        **options: Any,
+    ) -> Dict[str, Any]:
+        return self.execute(
+            "hybrid-search",
+            conversation_id=conversation_id,
+            query_text=query_text,
+            query_embedding_json=embedding or [],
+            limit=limit,
+            **options,
+        )
+
+    async def hybrid_search_async(
+        self,
+        conversation_id: str,
+        query_text: str = "",
+        embedding: Optional[List[float]] = None,
+        limit: int = 6,
+        **options: Any,
+    ) -> Dict[str, Any]:
+        return await self.execute_async(
+            "hybrid-search",
+            conversation_id=conversation_id,
+            query_text=query_text,
+            query_embedding_json=embedding or [],
+            limit=limit,
+            **options,
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return self.execute("stats")
+
+    async def stats_async(self) -> Dict[str, Any]:
+        return await self.execute_async("stats")
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        while True:
+            try:
+                conn = self.pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+        self.opened = 0
+
+    def __enter__(self) -> "MemoryStore":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    async def __aenter__(self) -> "MemoryStore":
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        self.close()
+
+
+def render_result(
+    store: MemoryStore,
+    command: str,
+    params: Dict[str, Any],
+    result: Dict[str, Any],
+    profile: CommandProfile,
+    render: Callable[[Dict[str, Any]], str],
+) -> str:
+    """Serialize a result, fold its timings into the store and attach them when --profile is set."""
+    with profile.phase("serialize"):
+        text = render(result)
+    report = store.record(command, profile)
+    if str(param(params, "profile", "0")).lower() in ("1", "true", "yes"):
+        result["profile"] = report
+        text = render(result)
+    return text
+
+
+def handle_request_line(store: MemoryStore, line: str) -> str:
+    request_id = None
+    command = ""
+    params: Dict[str, Any] = {}
+    profile = CommandProfile()
+    try:
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise ValueError("request must be a JSON object")
+        request_id = request.get("id")
+        command = str(request.get("command") or "")
+        params = request.get("args") or {}
+        if not isinstance(params, dict):
+            raise ValueError("args must be a JSON object")
+        if params.get("file") == "-":
+            raise ValueError("file - (stdin/stdout) is only available on the CLI")
+        result, profile = store.run(command, params, profile)
+    except Exception as err:
+        result = {"ok": False, "error": str(err)}
+    return render_result(store, command, params, result, profile, lambda r: json.dumps({"id": request_id, "result": r}))
+
+
+def serve_stream(store: MemoryStore, reader: Iterable[str], writer: Any) -> None:
+    for line in reader:
+        if not line.strip():
+            continue
+        writer.write(handle_request_line(store, line) + "\n")
+        writer.flush()
+
+
+def serve(db_path: str, vec_ext_path: str, socket_path: str, pool_size: int) -> int:
+    """Answer newline-delimited JSON requests from long-lived connections.
+
+    Requests look like {"id": 1, "command": "search", "args": {...}} and each
+    response is {"id": 1, "result": {...}} with the same payload the one-shot
+    CLI would print. Without --socket the server speaks on stdin/stdout over
+    one connection and exits at EOF; with --socket it accepts any number of
+    Unix socket clients and runs their requests on a pool of pool_size
+    connections.
+    """
+    store = MemoryStore(db_path, vec_ext_path, pool_size if socket_path else 1)
+    try:
+        if not socket_path:
+            serve_stream(store, sys.stdin, sys.stdout)
+            return 0
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                reader = (raw.decode("utf-8") for raw in self.rfile)
+                writer = _SocketWriter(self.wfile)
+                serve_stream(store, reader, writer)
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as server:
+            server.daemon_threads = True
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+        return 0
+    finally:
+        store.close()
+        if socket_path and os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def read_ndjson(reader: Iterable[str]) -> List[Any]:
+    """Parse one JSON value per non-empty line; bad lines become errors reported in place."""
+    items: List[Any] = []
+    for number, line in enumerate(reader, start=1):
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError as err:
+            items.append(ValueError(f"line {number}: {err}"))
+    return items
+
+
+class _SocketWriter:
+    def __init__(self, wfile: Any) -> None:
+        self.wfile = wfile
+
+    def write(self, text: str) -> None:
+        self.wfile.write(text.encode("utf-8"))
+
+    def flush(self) -> None:
+        self.wfile.flush()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=[*COMMANDS.keys(), "serve"])
+    parser.add_argument("--db", required=True)
+    parser.add_argument("--vec-ext", default="")
+    parser.add_argument("--socket", default="", help="serve: listen on this Unix socket instead of stdin/stdout")
+    parser.add_argument("--pool-size", default=str(SERVE_POOL_SIZE), help="serve --socket: connections shared by clients")
+    parser.add_argument("--conversation-id", default="")
+    parser.add_argument("--source", default="")
+    parser.add_argument("--content", default="")
+    parser.add_argument("--embedding-json", default="[]")
+    parser.add_argument("--query-embedding-json", default="[]")
+    parser.add_argument("--query-text", default="", help="hybrid-search: free-text query matched with FTS5")
+    parser.add_argument("--created-at", default="0")
+    parser.add_argument("--limit", default="6")
+    parser.add_argument("--min-score", default="0.1")
+    parser.add_argument("--window", default="600", help="scan search: newest rows read from the conversation")
+    parser.add_argument(
+        "--shared-window", default="0", help="scan search: newest global and self_reflection rows each (0 = --window)"
+    )
+    parser.add_argument("--half-life-days", default="0", help="search: recency bonus half-life in days (0 = off)")
+    parser.add_argument("--recency-weight", default="0.1", help="search: recency bonus for a brand-new memory")
+    parser.add_argument("--role", default="")
+    parser.add_argument("--platform", default="")
+    parser.add_argument("--user-id", default="")
+    parser.add_argument(
+        "--since", default="0", help="recent-messages: messages created after this; export/import: created_at lower bound"
+    )
+    parser.add_argument("--until", default="0", help="export/import: created_at upper bound (exclusive)")
+    parser.add_argument("--file", default="", help="export/import: NDJSON path, - for stdout/stdin")
+    parser.add_argument(
+        "--embedding-format",
+        default="",
+        help="export: f32 (base64 float32, default), json or none; import: expected encoding (default: either) or none",
+    )
+    parser.add_argument("--max-messages", default="200", help="compaction-range: compact once a conversation exceeds this")
+    parser.add_argument("--keep-recent", default="40", help="compaction-range: newest messages left uncompacted")
+    parser.add_argument("--max-id", default="0", help="delete-up-to: delete messages with id <= this")
+    parser.add_argument("--model", default="", help="cache-get/cache-put: embedding model the vector came from")
+    parser.add_argument(
+        "--max-entries", default=str(EMBEDDING_CACHE_MAX_ENTRIES), help="cache-put: LRU cap on cached embeddings"
+    )
+    parser.add_argument("--profile", default="0", help="attach per-phase timings to the result")
+    parser.add_argument("--profile-dump", default="", help="write a cProfile dump of the command to this path")
+    parser.add_argument("--shards", default="0", help="init/reshard: conversation shard files (0 = single file)")
+    parser.add_argument("--name", default="")
+    parser.add_argument("--provider", default="")
+    parser.add_argument("--enabled", default="1")
+    parser.add_argument("--updated-at", default="0")
+    parser.add_argument("--nprobe", default="8", help="search: IVF lists to probe when an ANN index exists (0 = exact)")
+    parser.add_argument("--max-candidates", default="4096", help="search: cap on IVF candidates scored exactly")
+    parser.add_argument(
+        "--quant",
+        default="",
+        help="quantize: int8, binary or none; search: 'none' forces full-precision scoring",
+    )
+    parser.add_argument("--rerank", default="0", help="quantized search: candidates re-ranked exactly (0 = auto)")
+    parser.add_argument("--nlist", default="0", help="ann-build: number of IVF lists (0 = sqrt(memories))")
+    parser.add_argument("--sample", default="50000", help="ann-build: rows sampled to train centroids")
+    parser.add_argument("--iterations", default="10", help="ann-build: k-means iterations")
+    parser.add_argument("--candidates", default="50", help="hybrid-search: results taken from each ranking before fusion")
+    parser.add_argument("--rrf-k", default="60", help="hybrid-search: reciprocal rank fusion constant")
+    parser.add_argument("--threshold", default="0.95", help="consolidate: cosine similarity that counts as a duplicate")
+    parser.add_argument("--max-rows", default="0", help="consolidate: new memories compared per run (0 = all)")
+    parser.add_argument("--archive", default="1", help="consolidate: copy merged rows to the archive file (0 = delete)")
+    parser.add_argument("--archive-db", default="", help="retain: archive file (default: <db>.archive.sqlite)")
+    parser.add_argument("--include-archive", default="0", help="search: also scan archived memories")
+    parser.add_argument("--max-age-days", default="0", help="retain: archive memories older than this")
+    parser.add_argument("--max-per-conversation", default="0", help="retain: newest memories kept per conversation")
+    parser.add_argument("--max-per-source", default="0", help="retain: newest memories kept per source")
+    parser.add_argument("--message-max-age-days", default="0", help="retain: archive messages older than this")
+    parser.add_argument("--max-messages-per-conversation", default="0", help="retain: newest messages kept per conversation")
+    parser.add_argument("--mode", default="PASSIVE", help="checkpoint: PASSIVE, FULL, RESTART or TRUNCATE")
+    parser.add_argument("--optimize", default="1", help="checkpoint: also run PRAGMA optimize")
+    parser.add_argument("--batch-size", default="500")
+    parser.add_argument("--vacuum", default="1", help="migrate-embeddings: VACUUM afterwards to reclaim space")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        return serve(args.db, args.vec_ext, args.socket, int(args.pool_size))
+
+    def render(result: Dict[str, Any]) -> str:
+        if args.command in BATCH_COMMANDS and result.get("ok"):
+            lines = [json.dumps(item) + "\n" for item in result["results"]]
+            if "profile" in result:
+                lines.append(json.dumps({"profile": result["profile"]}) + "\n")
+            return "".join(lines)
+        return json.dumps(result)
+
+    try:
+        with MemoryStore(args.db, pool_size=1, initialize=False) as store:
+            params = vars(args)
+            if args.command in BATCH_COMMANDS:
+                params["items"] = read_ndjson(sys.stdin)
+            result, profile = store.run(args.command, params)
+            # export - streams records on stdout, so its summary goes to stderr.
+            out = sys.stderr if args.command == "export" and args.file == "-" else sys.stdout
+            out.write(render_result(store, args.command, params, result, profile, render))
+        return 0
+    except Exception as err:
+        sys.stdout.write(json.dumps({"ok": False, "error": str(err)}))
+        return 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
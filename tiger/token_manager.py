@@ -3,8 +3,12 @@ Tiger Bot - Token Management System
 Rate limiting, multi-key rotation, and circuit breaker
 """
 import time
+import asyncio
 import random
 import sqlite3
+import threading
+import atexit
+import collections
 import yaml
 import os
 from datetime import datetime, timedelta
@@ -14,33 +18,286 @@ import logging
 logger = logging.getLogger(__name__)
 
 class TokenBucket:
-    """Token bucket algorithm for rate limiting"""
+    """Token bucket algorithm for rate limiting
+    
+    Safe to share between threads and event loops. acquire()/acquire_async()
+    queue callers FIFO and sleep until the head of the queue can be served.
+    """
+    
+    # Subclasses whose _take_tokens blocks on I/O set this so the head of the
+    # queue takes tokens with self.lock released
+    take_outside_lock = False
     
     def __init__(self, rate: int = 60, per: int = 60):
         self.rate = rate  # requests allowed
         self.per = per    # per seconds
         self.allowance = rate
-        self.last_check = time.time()
-        self.lock = False
+        self.last_check = time.monotonic()
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.waiters = collections.deque()
     
-    def consume(self, tokens: int = 1) -> bool:
-        now = time.time()
+    def _refill(self):
+        now = time.monotonic()
         time_passed = now - self.last_check
         self.last_check = now
         
         self.allowance += time_passed * (self.rate / self.per)
         self.allowance = min(self.allowance, self.rate)
-        
-        if self.allowance >= tokens:
-            self.allowance -= tokens
-            return True
-        return False
     
-    def get_wait_time(self, tokens: int = 1) -> float:
+    def _wait_for(self, tokens: int) -> float:
         if self.allowance >= tokens:
             return 0
         needed = tokens - self.allowance
         return needed * (self.per / self.rate)
+    
+    def _check(self, tokens: int):
+        if tokens > self.rate:
+            raise ValueError(f"Cannot acquire {tokens} tokens from a bucket of {self.rate}")
+    
+    def _take_tokens(self, tokens: int, deadline: Optional[float] = None) -> float:
+        # Caller holds self.lock unless take_outside_lock; returns 0 once taken,
+        # else seconds until they refill. deadline (time.monotonic) bounds how
+        # long a shared backend may block
+        self._refill()
+        if self.allowance >= tokens:
+            self.allowance -= tokens
+            return 0
+        return self._wait_for(tokens)
+    
+    def _peek_wait(self, tokens: int) -> float:
+        # Caller holds self.lock unless take_outside_lock
+        self._refill()
+        return self._wait_for(tokens)
+    
+    def _take(self, waiter, tokens: int, deadline: Optional[float] = None) -> Optional[float]:
+        # Caller holds self.lock; only the head of the queue may take tokens,
+        # everyone else sleeps (None) until the head leaves
+        if self.waiters[0] is not waiter:
+            return None
+        if self.take_outside_lock:
+            # Later waiters cannot pass the head, so the queue needs no lock meanwhile
+            self.lock.release()
+            try:
+                delay = self._take_tokens(tokens, deadline)
+            finally:
+                self.lock.acquire()
+        else:
+            delay = self._take_tokens(tokens, deadline)
+        # A cancelled async waiter may have left while its executor call ran
+        if delay == 0 and waiter in self.waiters:
+            self._leave(waiter)
+        return delay
+    
+    def _take_locked(self, waiter, tokens: int, deadline: Optional[float] = None) -> Optional[float]:
+        with self.lock:
+            return self._take(waiter, tokens, deadline)
+    
+    def _leave(self, waiter):
+        # Caller holds self.lock
+        was_head = self.waiters[0] is waiter
+        self.waiters.remove(waiter)
+        if was_head and self.waiters:
+            self.cond.notify_all()
+            if isinstance(self.waiters[0], tuple):
+                loop, event = self.waiters[0]
+                loop.call_soon_threadsafe(event.set)
+    
+    def consume(self, tokens: int = 1) -> bool:
+        with self.lock:
+            # Queued callers go first
+            if self.waiters:
+                return False
+            if not self.take_outside_lock:
+                return self._take_tokens(tokens) == 0
+        return self._take_tokens(tokens) == 0
+    
+    def get_wait_time(self, tokens: int = 1) -> float:
+        if self.take_outside_lock:
+            return self._peek_wait(tokens)
+        with self.lock:
+            return self._peek_wait(tokens)
+    
+    def acquire(self, tokens: int = 1, timeout: Optional[float] = None) -> bool:
+        """Block until tokens are available; False if timeout expires first"""
+        self._check(tokens)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waiter = object()  # thread waiters are woken through self.cond
+        with self.cond:
+            self.waiters.append(waiter)
+            try:
+                while True:
+                    delay = self._take(waiter, tokens, deadline)
+                    if delay == 0:
+                        return True
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._leave(waiter)
+                            return False
+                        delay = remaining if delay is None else min(delay, remaining)
+                    self.cond.wait(delay)
+            except BaseException:
+                if waiter in self.waiters:
+                    self._leave(waiter)
+                raise
+    
+    async def acquire_async(self, tokens: int = 1, timeout: Optional[float] = None) -> bool:
+        """asyncio version of acquire(); sleeps without blocking the event loop"""
+        self._check(tokens)
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        take_deadline = None if timeout is None else time.monotonic() + timeout
+        event = asyncio.Event()
+        waiter = (loop, event)
+        with self.lock:
+            self.waiters.append(waiter)
+        try:
+            while True:
+                # Cleared first: a wake-up scheduled during the take is kept
+                event.clear()
+                if self.take_outside_lock:
+                    delay = await loop.run_in_executor(None, self._take_locked, waiter, tokens, take_deadline)
+                else:
+                    delay = self._take_locked(waiter, tokens, take_deadline)
+                if delay == 0:
+                    return True
+                if deadline is not None:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        with self.lock:
+                            self._leave(waiter)
+                        return False
+                    delay = remaining if delay is None else min(delay, remaining)
+                try:
+                    await asyncio.wait_for(event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self.lock:
+                if waiter in self.waiters:
+                    self._leave(waiter)
+            raise
+
+
+class SharedTokenBucket(TokenBucket):
+    """TokenBucket whose allowance lives in SQLite, shared by every process on the host
+    
+    One row per (api_name, key_id) in the token_usage database is read and
+    updated inside BEGIN IMMEDIATE, so concurrent processes draw from the
+    same budget. acquire() stays FIFO within a process; across processes
+    waiters simply retry when their refill is due. The round-trip runs
+    outside the queue lock (acquire_async() hands it to an executor), and
+    SQLite waits at most lock_timeout for another process's write lock
+    before the attempt counts as a short wait. The database is switched to
+    WAL, so only opt in with limiter: shared.
+    """
+    
+    LOCK_RETRY_DELAY = 0.01
+    take_outside_lock = True
+    
+    def __init__(self, db_path: str, api_name: str, key_id: str = "*", rate: int = 60, per: int = 60,
+                 lock_timeout: float = 0.05):
+        super().__init__(rate=rate, per=per)
+        self.api_name = api_name
+        self.key_id = key_id
+        self.lock_timeout = lock_timeout
+        self.busy_timeout_ms = None
+        # Serializes use of self.conn; the queue lock is not held meanwhile
+        self.db_lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False, timeout=5)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS rate_limit_state (
+                api_name TEXT NOT NULL,
+                key_id TEXT NOT NULL,
+                allowance REAL NOT NULL,
+                last_check REAL NOT NULL,
+                PRIMARY KEY (api_name, key_id)
+            )
+        """)
+        self.conn.execute("""
+            INSERT OR IGNORE INTO rate_limit_state (api_name, key_id, allowance, last_check)
+            VALUES (?, ?, ?, ?)
+        """, (api_name, key_id, rate, time.time()))
+        self._set_busy_timeout(lock_timeout)
+    
+    def _set_busy_timeout(self, seconds: float):
+        busy_timeout_ms = max(0, int(seconds * 1000))
+        if busy_timeout_ms != self.busy_timeout_ms:
+            self.conn.execute(f"PRAGMA busy_timeout = {busy_timeout_ms}")
+            self.busy_timeout_ms = busy_timeout_ms
+    
+    @staticmethod
+    def _is_busy(error: sqlite3.OperationalError) -> bool:
+        message = str(error)
+        return "locked" in message or "busy" in message
+    
+    def _load(self):
+        row = self.conn.execute("""
+            SELECT allowance, last_check FROM rate_limit_state
+            WHERE api_name = ? AND key_id = ?
+        """, (self.api_name, self.key_id)).fetchone()
+        now = time.time()
+        allowance, last_check = row if row else (self.rate, now)
+        # Wall clock is shared across processes; ignore it stepping backwards
+        self.allowance = min(allowance + max(0.0, now - last_check) * (self.rate / self.per), self.rate)
+        self.last_check = now
+    
+    def _take_tokens(self, tokens: int, deadline: Optional[float] = None) -> float:
+        with self.db_lock:
+            return self._take_row(tokens, deadline)
+    
+    def _take_row(self, tokens: int, deadline: Optional[float] = None) -> float:
+        lock_timeout = self.lock_timeout
+        if deadline is not None:
+            lock_timeout = min(lock_timeout, deadline - time.monotonic())
+        self._set_busy_timeout(lock_timeout)
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as e:
+            if self._is_busy(e):
+                return self.LOCK_RETRY_DELAY
+            raise
+        try:
+            self._load()
+            if self.allowance < tokens:
+                self.conn.execute("COMMIT")
+                return self._wait_for(tokens)
+            self.allowance -= tokens
+            self.conn.execute("""
+                UPDATE rate_limit_state SET allowance = ?, last_check = ?
+                WHERE api_name = ? AND key_id = ?
+            """, (self.allowance, self.last_check, self.api_name, self.key_id))
+            self.conn.execute("COMMIT")
+            return 0
+        except sqlite3.OperationalError as e:
+            self._rollback()
+            if self._is_busy(e):
+                return self.LOCK_RETRY_DELAY
+            raise
+        except BaseException:
+            self._rollback()
+            raise
+    
+    def _rollback(self):
+        if self.conn.in_transaction:
+            self.conn.execute("ROLLBACK")
+    
+    def _peek_wait(self, tokens: int) -> float:
+        with self.db_lock:
+            try:
+                self._load()
+            except sqlite3.OperationalError as e:
+                if self._is_busy(e):
+                    return self.LOCK_RETRY_DELAY
+                raise
+            return self._wait_for(tokens)
+    
+    def close(self):
+        with self.db_lock:
+            self.conn.close()
 
 
 class CircuitBreaker:
@@ -68,6 +325,13 @@ class CircuitBreaker:
             self._on_failure()
             raise e
     
+    def record(self, success: bool):
+        """Feed an outcome observed outside call()"""
+        if success:
+            self._on_success()
+        else:
+            self._on_failure()
+    
     def _on_success(self):
         self.failures = 0
         self.state = "CLOSED"
@@ -96,6 +360,247 @@ class CircuitOpenError(Exception):
     pass
 
 
+class RollingWindow:
+    """Sliding (requests, tokens, failures) totals over span seconds, kept in fixed slots
+    
+    add() and totals() are O(1) amortised: expired slots are subtracted from
+    the running totals as the clock moves past them.
+    """
+    
+    def __init__(self, span: int, slots: int):
+        self.width = span / slots
+        self.slots = slots
+        self.counts = [[0, 0, 0] for _ in range(slots)]
+        self.sums = [0, 0, 0]
+        self.head = None  # absolute number of the newest slot
+    
+    def _advance(self, slot: int):
+        if self.head is None:
+            self.head = slot
+            return
+        if slot <= self.head:
+            return
+        for step in range(1, min(slot - self.head, self.slots) + 1):
+            expired = self.counts[(self.head + step) % self.slots]
+            for i in range(3):
+                self.sums[i] -= expired[i]
+                expired[i] = 0
+        self.head = slot
+    
+    def add(self, timestamp: float, requests: int = 1, tokens: int = 0, failures: int = 0):
+        slot = int(timestamp // self.width)
+        self._advance(slot)
+        if slot <= self.head - self.slots:
+            return
+        counts = self.counts[slot % self.slots]
+        for i, value in enumerate((requests, tokens, failures)):
+            counts[i] += value
+            self.sums[i] += value
+    
+    def totals(self, now: float) -> tuple:
+        self._advance(int(now // self.width))
+        return tuple(self.sums)
+
+
+class UsageCounters:
+    """Minute, hour and day RollingWindows for one api_name"""
+    
+    WINDOWS = {"minute": (60, 60), "hour": (3600, 60), "day": (86400, 144)}
+    
+    def __init__(self):
+        self.windows = {name: RollingWindow(span, slots) for name, (span, slots) in self.WINDOWS.items()}
+    
+    def add(self, timestamp: float, requests: int = 1, tokens: int = 0, failures: int = 0):
+        for window in self.windows.values():
+            window.add(timestamp, requests, tokens, failures)
+    
+    def load(self, db_path: str, api_name: str, key_windows: Optional[Dict[str, RollingWindow]] = None):
+        """Rehydrate from the last day of token_usage rows (and per-key day windows)"""
+        key_windows = key_windows or {}
+        with sqlite3.connect(db_path) as conn:
+            cursor = conn.execute("""
+                SELECT CAST(strftime('%s', timestamp) AS INTEGER) AS second, key_id,
+                       SUM(request_count), SUM(tokens_used),
+                       SUM(CASE WHEN success = 1 THEN 0 ELSE 1 END)
+                FROM token_usage
+                WHERE api_name = ? AND timestamp > datetime('now', '-1 day')
+                GROUP BY second, key_id
+                ORDER BY second
+            """, (api_name,))
+            for second, key_id, requests, tokens, failures in cursor:
+                self.add(second, requests or 0, tokens or 0, failures or 0)
+                if key_id in key_windows:
+                    key_windows[key_id].add(second, requests or 0, tokens or 0, failures or 0)
+    
+    def totals(self, name: str, now: Optional[float] = None) -> Dict:
+        requests, tokens, failures = self.windows[name].totals(time.time() if now is None else now)
+        return {"requests": requests, "tokens": tokens, "failures": failures}
+
+
+class KeyState:
+    """Per-key bucket, breaker and EWMA latency/error state"""
+    
+    def __init__(self, key: Optional[str], key_id: str, bucket: TokenBucket, breaker: CircuitBreaker,
+                 alpha: float = 0.2):
+        self.key = key
+        self.key_id = key_id
+        self.bucket = bucket
+        self.breaker = breaker
+        self.alpha = alpha
+        self.latency_ms = None  # None until the first response is observed
+        self.error_rate = 0.0
+        self.requests = 0
+        self.day = RollingWindow(86400, 144)  # feeds the least_used strategy
+    
+    def observe(self, response_time_ms: float, success: bool, timestamp: Optional[float] = None):
+        self.requests += 1
+        self.day.add(time.time() if timestamp is None else timestamp, 1, 0, 0 if success else 1)
+        if success:
+            if self.latency_ms is None:
+                self.latency_ms = float(response_time_ms)
+            else:
+                self.latency_ms += self.alpha * (response_time_ms - self.latency_ms)
+        self.error_rate += self.alpha * ((0.0 if success else 1.0) - self.error_rate)
+        self.breaker.record(success)
+    
+    def healthy(self) -> bool:
+        return not self.breaker.is_open()
+    
+    def score(self) -> float:
+        # Expected latency per successful call; unmeasured keys score 0 so they get probed
+        if self.latency_ms is None:
+            return 0.0
+        return self.latency_ms / max(0.05, 1.0 - self.error_rate)
+    
+    def stats(self) -> Dict:
+        return {
+            "key_id": self.key_id,
+            "requests": self.requests,
+            "latency_ms": None if self.latency_ms is None else round(self.latency_ms, 1),
+            "error_rate": round(self.error_rate, 3),
+            "circuit_state": self.breaker.state
+        }
+
+
+class UsageBuffer:
+    """Write-behind buffer for token_usage rows
+    
+    record() only appends to an in-memory queue; a daemon thread writes batches
+    with executemany when flush_batch rows are pending, every flush_interval
+    seconds, and at exit. Once max_pending rows are queued, overflow picks
+    drop_oldest (default), drop_newest, or block until the writer catches up.
+    """
+    
+    OVERFLOW_POLICIES = ("drop_oldest", "drop_newest", "block")
+    
+    def __init__(self, db_path: str, flush_batch: int = 100, flush_interval: float = 1.0,
+                 max_pending: int = 10000, overflow: str = "drop_oldest"):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"overflow must be one of {', '.join(self.OVERFLOW_POLICIES)}")
+        self.db_path = db_path
+        self.flush_batch = max(1, int(flush_batch))
+        self.flush_interval = max(0.01, float(flush_interval))
+        self.max_pending = max(self.flush_batch, int(max_pending))
+        self.overflow = overflow
+        self.pending = collections.deque()
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.conn = None
+        self.thread = threading.Thread(target=self._run, name="token-usage-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+    
+    def record(self, row: tuple) -> bool:
+        """Queue one token_usage row; returns False if it was dropped"""
+        with self.cond:
+            if self.closed:
+                return self._write([row]) == 1
+            if len(self.pending) >= self.max_pending:
+                if self.overflow == "drop_newest":
+                    self._note_drop()
+                    return False
+                if self.overflow == "drop_oldest":
+                    self.pending.popleft()
+                    self._note_drop()
+                else:
+                    self.cond.notify_all()
+                    self.cond.wait_for(lambda: len(self.pending) < self.max_pending or self.closed)
+            self.pending.append(row)
+            if len(self.pending) >= self.flush_batch:
+                self.cond.notify_all()
+        return True
+    
+    def _note_drop(self):
+        self.dropped += 1
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            logger.warning(f"Token usage buffer full ({self.max_pending} rows); {self.dropped} rows dropped")
+    
+    def _drain(self) -> list:
+        batch = list(self.pending)
+        self.pending.clear()
+        self.cond.notify_all()
+        return batch
+    
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.pending) >= self.flush_batch or self.closed,
+                                   timeout=self.flush_interval)
+                if self.closed:
+                    return
+                batch = self._drain()
+            self._write(batch)
+    
+    def _write(self, batch: list) -> int:
+        if not batch:
+            return 0
+        with self.write_lock:
+            try:
+                if self.conn is None:
+                    self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                with self.conn:
+                    self.conn.executemany("""
+                        INSERT INTO token_usage
+                        (api_name, key_id, tokens_used, response_time_ms, success, timestamp)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    """, batch)
+                self.written += len(batch)
+                return len(batch)
+            except sqlite3.Error as e:
+                self.failed += len(batch)
+                logger.error(f"Failed to write {len(batch)} token usage rows: {e}")
+                return 0
+    
+    def flush(self) -> int:
+        """Write everything recorded so far before returning"""
+        with self.cond:
+            batch = self._drain()
+        return self._write(batch)
+    
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.flush()
+        with self.write_lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+        atexit.unregister(self.close)
+    
+    def stats(self) -> Dict:
+        with self.cond:
+            pending = len(self.pending)
+        return {"pending": pending, "written": self.written, "dropped": self.dropped, "failed": self.failed}
+
+
 class TokenManager:
     """Main token management class with rotation and rate limiting"""
     
@@ -103,14 +608,24 @@ class TokenManager:
         self.api_name = api_name
         self.db_path = os.path.expanduser(db_path)
         self.config = self._load_config()
-        self.bucket = TokenBucket(
-            rate=self.config.get("rpm_limit", 60),
-            per=60
-        )
-        self.circuit_breaker = CircuitBreaker()
         self.keys = self._load_keys()
         self.current_key_index = 0
         self._init_db()
+        self.lock = threading.Lock()
+        self.states = [self._make_state(key, f"key_{i}") for i, key in enumerate(self.keys)]
+        if not self.states:
+            self.states = [self._make_state(None, "default")]
+        self.by_key = {state.key_id: state for state in self.states}
+        self.current = self.states[0]  # last selection; only for callers that don't pass key=
+        self.counters = UsageCounters()
+        self.counters.load(self.db_path, self.api_name, {state.key_id: state.day for state in self.states})
+        self.usage = UsageBuffer(
+            self.db_path,
+            flush_batch=self.config.get("usage_flush_batch", 100),
+            flush_interval=self.config.get("usage_flush_interval", 1.0),
+            max_pending=self.config.get("usage_max_pending", 10000),
+            overflow=self.config.get("usage_overflow", "drop_oldest")
+        )
     
     def _load_config(self) -> Dict:
         config_path = os.path.join(os.path.dirname(__file__), "config", "tokens.yaml")
@@ -148,86 +663,179 @@ class TokenManager:
                 ON token_usage(api_name, timestamp)
             """)
     
+    def _make_bucket(self, key_id: str = "*") -> TokenBucket:
+        rate = self.config.get("rpm_limit", 60)
+        # "local" limits this process only; "shared" coordinates every process
+        # on this host through token_usage.db (and switches it to WAL)
+        if self.config.get("limiter", "local") != "shared":
+            return TokenBucket(rate=rate, per=60)
+        return SharedTokenBucket(self.db_path, self.api_name, key_id=key_id, rate=rate, per=60,
+                                 lock_timeout=self.config.get("limiter_lock_timeout", 0.05))
+    
+    def _make_state(self, key: Optional[str], key_id: str) -> KeyState:
+        breaker = CircuitBreaker(
+            failure_threshold=self.config.get("breaker_failures", 5),
+            timeout=self.config.get("breaker_timeout", 60)
+        )
+        return KeyState(key, key_id, self._make_bucket(key_id), breaker,
+                        alpha=self.config.get("ewma_alpha", 0.2))
+    
+    @property
+    def bucket(self) -> TokenBucket:
+        return self.current.bucket
+    
+    @property
+    def circuit_breaker(self) -> CircuitBreaker:
+        return self.current.breaker
+    
     def get_current_key(self) -> Optional[str]:
+        """Select the key for the next request
+        
+        Pass the returned key to admit()/acquire() and their result to
+        record_usage(key=...) so concurrent callers are charged to their own key.
+        """
         if not self.keys:
             return None
+        return self.select_key().key
+    
+    def select_key(self) -> KeyState:
         strategy = self.config.get("strategy", "round_robin")
         
-        if strategy == "round_robin":
-            key = self.keys[self.current_key_index]
-            self.current_key_index = (self.current_key_index + 1) % len(self.keys)
+        with self.lock:
+            if strategy == "round_robin":
+                state = self.states[self.current_key_index]
+                self.current_key_index = (self.current_key_index + 1) % len(self.states)
+            elif strategy == "least_used":
+                state = self._get_least_used_state()
+            elif strategy == "fastest":
+                state = self._ranked_states()[0]
+            else:
+                state = self.states[0]
+            self.current = state
+        return state
+    
+    def _resolve(self, key=None) -> KeyState:
+        # key may be a KeyState, a key_id or the raw API key; anything else
+        # (e.g. a key rotated out of the config) falls back to the last selection
+        if isinstance(key, KeyState):
             return key
-        elif strategy == "least_used":
-            return self._get_least_used_key()
-        
-        return self.keys[0]
+        if key is None:
+            return self.current
+        state = self.by_key.get(key)
+        if state is None:
+            state = next((state for state in self.states if state.key == key), None)
+        if state is None:
+            logger.warning(f"Unknown key for {self.api_name}; using {self.current.key_id}")
+            return self.current
+        return state
+    
+    def _ranked_states(self) -> List[KeyState]:
+        # Healthy keys first, fastest first; only in-memory state is consulted
+        return sorted(self.states, key=lambda state: (not state.healthy(), state.score()))
+    
+    def _get_least_used_state(self) -> KeyState:
+        # Find key with least usage over the rolling day (rehydrated at startup)
+        now = time.time()
+        return min(self.states, key=lambda state: state.day.totals(now)[0])
     
     def _get_least_used_key(self) -> str:
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.execute("""
-                SELECT key_id, SUM(request_count) as total
-                FROM token_usage
-                WHERE api_name = ? AND timestamp > datetime('now', '-1 day')
-                GROUP BY key_id
-            """, (self.api_name,))
-            usage = {row[0]: row[1] for row in cursor.fetchall()}
-        
-        # Find key with least usage
-        min_usage = float('inf')
-        selected_key = self.keys[0]
-        for key in self.keys:
-            key_id = f"key_{self.keys.index(key)}"
-            if usage.get(key_id, 0) < min_usage:
-                min_usage = usage.get(key_id, 0)
-                selected_key = key
+        with self.lock:
+            return self._get_least_used_state().key
+    
+    def _fallbacks(self, state: KeyState) -> List[KeyState]:
+        # Under "fastest", a throttled or tripped key hands over to the next healthy one
+        if self.config.get("strategy") != "fastest":
+            return [state]
+        with self.lock:
+            ranked = self._ranked_states()
+        ranked.remove(state)
+        return [state] + [other for other in ranked if other.healthy()]
+    
+    def allow_request(self, key=None) -> bool:
+        return self.admit(key) is not None
+    
+    def admit(self, key=None) -> Optional[KeyState]:
+        """Take a token for key (a key, key_id or KeyState; default the last selection)
         
-        return selected_key
+        Returns the KeyState that admitted the request, or None.
+        """
+        for state in self._fallbacks(self._resolve(key)):
+            if state.healthy() and state.bucket.consume():
+                return state
+        return None
     
-    def allow_request(self) -> bool:
-        if self.circuit_breaker.is_open():
-            return False
-        return self.bucket.consume()
+    def acquire(self, timeout: Optional[float] = None, key=None) -> Optional[KeyState]:
+        state = self._resolve(key)
+        admitted = self.admit(state)
+        if admitted is None and not state.breaker.is_open() and state.bucket.acquire(timeout=timeout):
+            admitted = state
+        return admitted
     
-    def get_wait_time(self) -> float:
-        return self.bucket.get_wait_time()
+    async def acquire_async(self, timeout: Optional[float] = None, key=None) -> Optional[KeyState]:
+        state = self._resolve(key)
+        if state.bucket.take_outside_lock:
+            # consume() on a shared bucket is a database round-trip
+            admitted = await asyncio.get_running_loop().run_in_executor(None, self.admit, state)
+        else:
+            admitted = self.admit(state)
+        if admitted is None and not state.breaker.is_open() and await state.bucket.acquire_async(timeout=timeout):
+            admitted = state
+        return admitted
     
-    def record_usage(self, tokens_used: int = 0, response_time_ms: int = 0, success: bool = True):
-        key_id = f"key_{self.current_key_index}" if self.keys else "default"
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("""
-                INSERT INTO token_usage 
-                (api_name, key_id, tokens_used, response_time_ms, success)
-                VALUES (?, ?, ?, ?, ?)
-            """, (self.api_name, key_id, tokens_used, response_time_ms, int(success)))
+    def get_wait_time(self, key=None) -> float:
+        return self._resolve(key).bucket.get_wait_time()
     
-    def get_usage_stats(self) -> Dict:
-        with sqlite3.connect(self.db_path) as conn:
-            # Last minute usage
-            cursor = conn.execute("""
-                SELECT SUM(request_count) 
-                FROM token_usage 
-                WHERE api_name = ? AND timestamp > datetime('now', '-1 minute')
-            """, (self.api_name,))
-            rpm = cursor.fetchone()[0] or 0
-            
-            # Last day usage
-            cursor = conn.execute("""
-                SELECT SUM(request_count) 
-                FROM token_usage 
-                WHERE api_name = ? AND timestamp > datetime('now', '-1 day')
-            """, (self.api_name,))
-            rpd = cursor.fetchone()[0] or 0
-            
-            # Success rate
-            cursor = conn.execute("""
-                SELECT 
-                    SUM(CASE WHEN success = 1 THEN 1 ELSE 0 END) * 100.0 / COUNT(*),
-                    COUNT(*)
-                FROM token_usage 
-                WHERE api_name = ? AND timestamp > datetime('now', '-1 hour')
-            """, (self.api_name,))
-            row = cursor.fetchone()
-            success_rate = row[0] if row and row[1] > 0 else 100
+    def record_usage(self, tokens_used: int = 0, response_time_ms: int = 0, success: bool = True,
+                     key=None) -> bool:
+        state = self._resolve(key)
+        now = time.time()
+        with self.lock:
+            state.observe(response_time_ms, success, now)
+            self.counters.add(now, 1, tokens_used, 0 if success else 1)
+        # Stamp now rather than at flush time so the time windows stay accurate
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now))
+        return self.usage.record((self.api_name, state.key_id, tokens_used, response_time_ms, int(success), timestamp))
+    
+    def flush_usage(self) -> int:
+        return self.usage.flush()
+    
+    def close(self):
+        self.usage.close()
+        for state in self.states:
+            if isinstance(state.bucket, SharedTokenBucket):
+                state.bucket.close()
+    
+    def get_usage_stats(self, shared: bool = False) -> Dict:
+        """Rolling usage for this api_name
+        
+        By default the totals come from in-memory counters with no disk access:
+        they cover this process only (plus the last day rehydrated at startup),
+        so with several processes rpm/rpd undercount the host. shared=True
+        flushes this process's buffer and rebuilds the windows from
+        token_usage.db, which every process writes to; other processes' rows
+        lag by up to their usage_flush_interval. Per-key stats are always
+        per process.
+        """
+        now = time.time()
+        if shared:
+            self.flush_usage()
+            counters = UsageCounters()
+            counters.load(self.db_path, self.api_name)
+            minute = counters.totals("minute", now)
+            hour = counters.totals("hour", now)
+            day = counters.totals("day", now)
+        else:
+            with self.lock:
+                minute = self.counters.totals("minute", now)
+                hour = self.counters.totals("hour", now)
+                day = self.counters.totals("day", now)
+        rpm = minute["requests"]
+        rpd = day["requests"]
+        # Success rate
+        if hour["requests"] > 0:
+            success_rate = (hour["requests"] - hour["failures"]) * 100.0 / hour["requests"]
+        else:
+            success_rate = 100
         
         return {
             "rpm": rpm,
@@ -235,8 +843,12 @@ class TokenManager:
             "rpd": rpd,
             "rpd_limit": self.config.get("rpd_limit", 1000),
             "success_rate": round(success_rate, 1),
+            "windows": {"minute": minute, "hour": hour, "day": day},
+            "scope": "shared" if shared else "process",
             "active_keys": len(self.keys),
-            "circuit_state": self.circuit_breaker.state
+            "circuit_state": self.circuit_breaker.state,
+            "keys": [state.stats() for state in self.states],
+            "usage_buffer": self.usage.stats()
         }
 
 